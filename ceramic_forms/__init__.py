@@ -1 +1,4 @@
-from ceramic_forms.form import Form, Optional, Or, XOr, If, And, Use, Msg
+from ceramic_forms.form import (
+    Form, Optional, Or, XOr, If, And, Use, Msg, Batched, Cached, Upload,
+    Result, ErrorRecord
+)
@@ -0,0 +1,526 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import builtins
+import itertools
+import linecache
+import weakref
+
+from ceramic_forms.form import (
+    DISCARD,
+    ErrorRecord,
+    FormErr,
+    path_exists,
+    unchanged,
+    MapNode,
+    SequenceNode,
+    UseNode,
+    AndNode,
+    OrNode,
+    MsgNode,
+    TypeNode,
+    CallableNode,
+    LiteralNode,
+    LiteralSetNode,
+    HASH_SAFE_TYPES,
+    KeyNode,
+    OptionalKeyNode,
+    OrKeyNode,
+    XOrKeyNode,
+    IfKeyNode,
+    MsgKeyNode,
+)
+
+#Values of these types are written into the generated source as literals.
+INLINE_TYPES = (int, str, bytes, bool, type(None))
+
+_form_ids = itertools.count()
+
+class Generator:
+    #Turns a compiled node tree into the source of a single module. Maps and
+    #lists each get a function of their own; everything else is written inline
+    #into the function of the container it is in.
+
+    def __init__(self):
+        self.namespace = {
+            'DISCARD': DISCARD,
+            'ErrorRecord': ErrorRecord,
+            'FormErr': FormErr,
+            'HASH_SAFE_TYPES': HASH_SAFE_TYPES,
+            'path_exists': path_exists,
+            'unchanged': unchanged,
+        }
+        self.constants = {}
+        self.functions = {}
+        self.blocks = []
+        self.names = itertools.count()
+
+    def name(self, prefix):
+        return '{}{}'.format(prefix, next(self.names))
+
+    def constant(self, value):
+        if type(value) in INLINE_TYPES:
+            return repr(value)
+        if isinstance(value, type) and \
+                getattr(builtins, value.__name__, None) is value:
+            return value.__name__
+        name = self.constants.get(id(value))
+        if name is None:
+            name = self.name('_c')
+            self.constants[id(value)] = name
+            self.namespace[name] = value
+        return name
+
+    def function(self, node):
+        name = self.functions.get(id(node))
+        if name is not None:
+            return name
+        name = self.name('_map' if isinstance(node, MapNode) else '_seq')
+        self.functions[id(node)] = name
+        lines = []
+        if isinstance(node, MapNode):
+            self.map_body(node, lines)
+        else:
+            self.sequence_body(node, lines)
+        self.blocks.append([
+            'def {}(suspicious, errors, context):'.format(name),
+            lines,
+        ])
+        return name
+
+    def map_body(self, node, out):
+        out.append('all_valid = True')
+        out.append('cleaned = {}')
+        out.append('keys_validated = set()')
+        for key_node in node.keys:
+            valid = self.key(key_node, out, 'errors', 'cleaned', False)
+            out.append('if not {}:'.format(valid))
+            out.append('    if context.fail_fast:')
+            out.append('        return False, cleaned')
+            out.append('    all_valid = False')
+        out.append('extra_keys = suspicious.keys() - keys_validated')
+        out.append('if extra_keys:')
+        out.append('    all_valid = False')
+        out.append('    for extra_key in extra_keys:')
+        out.append('        errors.section_errors.append(')
+        out.append("            ErrorRecord('unexpected', extra_key))")
+        if node.shares:
+            out.append('if all_valid and type(suspicious) is dict:')
+            out.append('    return True, suspicious')
+        elif node.keeps_keys:
+            out.append('if all_valid and type(suspicious) is dict and '
+                       'unchanged(suspicious, cleaned.items()):')
+            out.append('    return True, suspicious')
+        out.append('return all_valid, cleaned')
+
+    def sequence_body(self, node, out):
+        out.append('share = type(suspicious) is list')
+        out.append('all_valid = True')
+        out.append('cleaned = []')
+        out.append('for i, value in enumerate(suspicious):')
+        body = []
+        valid = self.name('valid')
+        clean = self.name('clean')
+        groups = self.dispatch_groups(node)
+        if groups:
+            body.append('item_type = type(value)')
+            keyword = 'if'
+            for types, validators in groups:
+                body.append('{} {}:'.format(keyword, ' or '.join(
+                    'item_type is {}'.format(self.constant(type_))
+                    for type_ in types
+                )))
+                block = []
+                outcomes = self.name('tried')
+                self.alternatives(validators, valid, clean, block, outcomes)
+                #The alternatives ruled out for this type run only now,
+                #through the node, which puts all the errors in order.
+                block.append('if not {}:'.format(valid))
+                block.append(['{}, {} = {}.retry(i, value, errors, '
+                              'context, {})'.format(
+                                  valid, clean, self.constant(node),
+                                  outcomes)])
+                body.append(block)
+                keyword = 'elif'
+            body.append('else:')
+            block = []
+            self.alternatives(node.validators, valid, clean, block)
+            body.append(block)
+        else:
+            self.alternatives(node.validators, valid, clean, body)
+        body.append('if share and {} is not value:'.format(clean))
+        body.append('    share = False')
+        body.append('    cleaned = suspicious[:i]')
+        body.append('if not share:')
+        body.append('    cleaned.append({})'.format(clean))
+        if len(node.validators) > 1:
+            body.append('if {} and i in errors:'.format(valid))
+            body.append('    del errors[i]')
+        body.append('if not {}:'.format(valid))
+        body.append('    if context.fail_fast:')
+        body.append('        return False, suspicious[:i + 1] if share '
+                    'else cleaned')
+        body.append('    all_valid = False')
+        out.append(body)
+        out.append('return all_valid, suspicious if share else cleaned')
+
+    def dispatch_groups(self, node):
+        #Element types whose candidate alternatives are fewer than all of
+        #them, grouped by those candidates.
+        if node.dispatch is None:
+            return []
+        groups = []
+        for type_, validators in node.dispatch.items():
+            if len(validators) == len(node.validators):
+                continue
+            for types, candidates in groups:
+                if candidates == validators:
+                    types.append(type_)
+                    break
+            else:
+                groups.append(([type_], validators))
+        return groups
+
+    def alternatives(self, validators, valid, clean, out, outcomes=None):
+        #With outcomes, the name of a dict that takes the clean value and
+        #errors of each alternative that fails, as validate_item does.
+        out.append('{} = False'.format(valid))
+        out.append('{} = None'.format(clean))
+        if outcomes is not None:
+            out.append('{} = {{}}'.format(outcomes))
+        for n, validator in enumerate(validators):
+            block = self.unless(out, n, 'not {}'.format(valid))
+            v, c = self.value(validator, 'i', 'value', 'errors', block)
+            block.append('{}, {} = {}, {}'.format(valid, clean, v, c))
+            if outcomes is not None:
+                block.append('if not {}:'.format(valid))
+                block.append(['{}[{}] = ({}, errors.pop(i, None))'.format(
+                    outcomes, self.constant(validator), clean)])
+
+    def unless(self, out, n, condition):
+        #Each alternative or condition after the first goes in its own
+        #block under condition, one after the other rather than nested, so
+        #long chains don't run into the compiler's nesting limits.
+        if not n:
+            return out
+        block = []
+        out.append('if {}:'.format(condition))
+        out.append(block)
+        return block
+
+    def sink(self, out, cleaned, as_list, key, value):
+        if as_list:
+            out.append('{}.append(({}, {}))'.format(cleaned, key, value))
+        else:
+            out.append('{}[{}] = {}'.format(cleaned, key, value))
+
+    def flush(self, out, pairs, cleaned, as_list):
+        if as_list:
+            out.append('{}.extend({})'.format(cleaned, pairs))
+        else:
+            out.append('for k, v in {}:'.format(pairs))
+            out.append('    {}[k] = v'.format(cleaned))
+
+    def known(self, key, node):
+        #A key node whose presence its parent has just checked.
+        return isinstance(node, KeyNode) and node.key is key
+
+    def key(self, node, out, errors, cleaned, as_list, present=False):
+        valid = self.name('kvalid')
+        if node.is_async:
+            #Coroutine functions refuse to run synchronously; let their
+            #nodes say so.
+            pairs = self.name('pairs')
+            out.append('{}, {} = {}.validate(suspicious, {}, '
+                       'context, keys_validated)'.format(
+                           valid, pairs, self.constant(node), errors))
+            self.flush(out, pairs, cleaned, as_list)
+        elif isinstance(node, KeyNode):
+            key = self.constant(node.key)
+            body = []
+            body.append('keys_validated.add({})'.format(key))
+            value = self.name('value')
+            body.append('{} = suspicious[{}]'.format(value, key))
+            v, c = self.value(node.value, key, value, errors, body)
+            body.append('{} = {}'.format(valid, v))
+            body.append('if {}:'.format(valid))
+            inner = []
+            self.sink(inner, cleaned, as_list, key, c)
+            body.append(inner)
+            if present:
+                out.extend(body)
+            else:
+                out.append('if {} in suspicious:'.format(key))
+                out.append(body)
+                out.append('else:')
+                out.append(['{}.section_errors.append({})'.format(
+                    errors, self.constant(node.missing)),
+                    '{} = False'.format(valid)])
+        elif isinstance(node, OptionalKeyNode):
+            out.append('if {} in suspicious:'.format(self.constant(node.key)))
+            body = []
+            v = self.key(node.inner, body, errors, cleaned, as_list,
+                         self.known(node.key, node.inner))
+            body.append('{} = {}'.format(valid, v))
+            out.append(body)
+            out.append('else:')
+            out.append(['{} = True'.format(valid)])
+        elif isinstance(node, (OrKeyNode, XOrKeyNode)) and \
+                node.position is None:
+            exclusive = isinstance(node, XOrKeyNode)
+            out.append('{} = {}'.format(valid, 0 if exclusive else True))
+            found = self.name('found')
+            if not exclusive:
+                out.append('{} = False'.format(found))
+            for orkey, alternative in node.alternatives:
+                out.append('if {} in suspicious:'.format(
+                    self.constant(orkey)))
+                body = []
+                if not exclusive:
+                    body.append('{} = True'.format(found))
+                if isinstance(alternative, KeyNode):
+                    v = self.key(alternative, body, errors, cleaned, as_list,
+                                 self.known(orkey, alternative))
+                    pairs = None
+                else:
+                    pairs = self.name('pairs')
+                    body.append('{} = []'.format(pairs))
+                    v = self.key(alternative, body, errors, pairs, True)
+                if exclusive:
+                    body.append('if {}:'.format(v))
+                    inner = ['{} += 1'.format(valid)]
+                    if pairs:
+                        self.flush(inner, pairs, cleaned, as_list)
+                    body.append(inner)
+                else:
+                    if pairs:
+                        body.append('if {}:'.format(v))
+                        inner = []
+                        self.flush(inner, pairs, cleaned, as_list)
+                        body.append(inner)
+                    body.append('if not {}:'.format(v))
+                    body.append(['{} = False'.format(valid)])
+                out.append(body)
+            section = '{}.section_errors.append'.format(errors)
+            if exclusive:
+                out.append('if {} == 0:'.format(valid))
+                out.append(['{}({})'.format(
+                    section, self.constant(node.missing))])
+                out.append('elif {} > 1:'.format(valid))
+                out.append(['{}({})'.format(
+                    section, self.constant(node.too_many))])
+                out.append('{0} = {0} == 1'.format(valid))
+            else:
+                out.append('if not {}:'.format(found))
+                out.append(['{}({})'.format(
+                    section, self.constant(node.missing)),
+                    '{} = False'.format(valid)])
+        elif isinstance(node, IfKeyNode):
+            if node.condition is not None:
+                condition = 'context.holds({})'.format(
+                    self.constant(node.condition))
+            else:
+                condition = ' and '.join(
+                    'path_exists({}, context.entire_structure)'.format(
+                        self.constant(path))
+                    for path in node.paths
+                ) or 'True'
+            out.append('if {}:'.format(condition))
+            body = []
+            v = self.key(node.inner, body, errors, cleaned, as_list)
+            body.append('{} = {}'.format(valid, v))
+            out.append(body)
+            out.append('else:')
+            out.append(['{} = True'.format(valid)])
+        elif isinstance(node, MsgKeyNode):
+            pairs = self.name('pairs')
+            out.append('{} = []'.format(pairs))
+            v = self.key(node.inner, out, 'DISCARD', pairs, True)
+            out.append('{} = {}'.format(valid, v))
+            out.append('if {}:'.format(valid))
+            inner = []
+            self.flush(inner, pairs, cleaned, as_list)
+            out.append(inner)
+            out.append('else:')
+            out.append(['{}.section_errors.append({})'.format(
+                errors, self.constant(node.errmsg))])
+        else:
+            #And as a key validates every submitted key, and large Or and
+            #XOr groups look theirs up through an index, so they keep
+            #their compiled nodes.
+            pairs = self.name('pairs')
+            out.append('{}, {} = {}.validate(suspicious, {}, '
+                       'context, keys_validated)'.format(
+                           valid, pairs, self.constant(node), errors))
+            self.flush(out, pairs, cleaned, as_list)
+        return valid
+
+    def value(self, node, key, value, errors, out):
+        valid = self.name('valid')
+        clean = self.name('clean')
+        if node.is_async:
+            out.append('{}, {} = {}.validate({}, {}, {}, context)'
+                       .format(valid, clean, self.constant(node), key, value,
+                               errors))
+        elif isinstance(node, (MapNode, SequenceNode)):
+            function = self.function(node)
+            nested = self.name('err')
+            out.append('{} = {}.child()'.format(nested, errors))
+            out.append('{}, {} = {}({}, {}, context)'.format(
+                valid, clean, function, value, nested))
+            out.append('if not {}:'.format(valid))
+            out.append(['{}[{}] = {}'.format(errors, key, nested)])
+        elif isinstance(node, UseNode):
+            out.append('try:')
+            out.append(['{} = {}({})'.format(
+                clean, self.constant(node.fn), value),
+                '{} = True'.format(valid)])
+            out.append('except Exception as e:')
+            out.append([
+                "{}.add({}, ErrorRecord('error', {}, (), str(e)))".format(
+                    errors, key, value),
+                '{} = False'.format(valid),
+                '{} = None'.format(clean),
+            ])
+        elif isinstance(node, AndNode):
+            out.append('{} = True'.format(valid))
+            out.append('{} = None'.format(clean))
+            for n, condition in enumerate(node.conditions):
+                block = self.unless(out, n, valid)
+                v, c = self.value(condition, key, value, errors, block)
+                block.append('{} = {}'.format(valid, v))
+                block.append('{} = {}'.format(clean, c))
+                value = c
+        elif isinstance(node, OrNode):
+            out.append('{} = False'.format(valid))
+            out.append('{} = None'.format(clean))
+            for n, condition in enumerate(node.conditions):
+                block = self.unless(out, n, 'not {}'.format(valid))
+                v, c = self.value(condition, key, value, 'DISCARD', block)
+                block.append('{} = {}'.format(valid, v))
+                block.append('{} = {}'.format(clean, c))
+            out.append('if not {}:'.format(valid))
+            out.append([
+                "{}.add({}, ErrorRecord('or', {}, ({},)))".format(
+                    errors, key, value, self.constant(node.raw_conditions))
+            ])
+        elif isinstance(node, MsgNode):
+            v, c = self.value(node.validator, key, value, 'DISCARD', out)
+            out.append('{}, {} = {}, {}'.format(valid, clean, v, c))
+            out.append('if not {}:'.format(valid))
+            out.append(['{}.add({}, {})'.format(
+                errors, key, self.constant(node.errmsg))])
+        elif isinstance(node, TypeNode):
+            out.append('if type({}) is {}:'.format(
+                value, self.constant(node.type)))
+            out.append([
+                '{} = True'.format(valid),
+                '{} = {}'.format(clean, value),
+            ])
+            out.append('else:')
+            out.append([
+                "{}.add({}, ErrorRecord('type', {}, ({},)))".format(
+                    errors, key, value, self.constant(node.type.__name__)),
+                '{} = False'.format(valid),
+                '{} = None'.format(clean),
+            ])
+        elif isinstance(node, CallableNode):
+            fn = self.constant(node.fn)
+            result = self.name('result')
+            out.append('try:')
+            out.append(['{} = {}({})'.format(result, fn, value)])
+            out.append('except Exception as e:')
+            out.append([
+                "{}.add({}, ErrorRecord('error', {}, (), str(e)))".format(
+                    errors, key, value),
+                '{} = False'.format(valid),
+                '{} = None'.format(clean),
+            ])
+            out.append('else:')
+            out.append([
+                'if {}:'.format(result),
+                ['{} = True'.format(valid), '{} = {}'.format(clean, value)],
+                'else:',
+                [
+                    "{}.add({}, ErrorRecord('match', {}, "
+                    "({}.__name__,)))".format(errors, key, value, fn),
+                    '{} = False'.format(valid),
+                    '{} = None'.format(clean),
+                ],
+            ])
+        elif isinstance(node, LiteralNode):
+            literal = self.constant(node.literal)
+            out.append('if {} == {}:'.format(value, literal))
+            out.append([
+                '{} = True'.format(valid),
+                '{} = {}'.format(clean, value),
+            ])
+            out.append('else:')
+            out.append([
+                "{}.add({}, ErrorRecord('literal', {}, ({},)))".format(
+                    errors, key, value, literal),
+                '{} = False'.format(valid),
+                '{} = None'.format(clean),
+            ])
+        elif isinstance(node, LiteralSetNode):
+            out.append('if type({}) in HASH_SAFE_TYPES:'.format(value))
+            out.append([
+                '{} = {} in {}'.format(valid, value,
+                                       self.constant(node.lookup)),
+                '{} = {} if {} else None'.format(clean, value, valid),
+            ])
+            out.append('else:')
+            out.append(['{}, {} = {}.validate({}, {}, {}, context)'.format(
+                valid, clean, self.constant(node), key, value, 'DISCARD')])
+            out.append('if not {}:'.format(valid))
+            out.append(["{}.add({}, ErrorRecord('or', {}, ({},)))".format(
+                errors, key, value, self.constant(tuple(node.literals)))])
+        else:
+            out.append('{}, {} = {}.validate({}, {}, {}, context)'
+                       .format(valid, clean, self.constant(node), key, value,
+                               errors))
+        return valid, clean
+
+    def entry(self, node):
+        lines = []
+        if isinstance(node, (MapNode, SequenceNode)):
+            lines.append('return {}(suspicious, errors, context)'.format(
+                self.function(node)))
+        else:
+            lines.append('err = FormErr()')
+            v, c = self.value(node, '0', 'suspicious', 'err', lines)
+            lines.append('errors.section_errors.extend(err[0])')
+            lines.append('return {}, {}'.format(v, c))
+        self.blocks.append([
+            'def validate(suspicious, errors, context):',
+            lines,
+        ])
+
+    def source(self):
+        return '\n\n'.join(
+            '\n'.join(flatten(block)) for block in self.blocks) + '\n'
+
+def flatten(lines, depth=0):
+    for line in lines:
+        if isinstance(line, str):
+            yield '    ' * depth + line
+        else:
+            for nested in flatten(line, depth + 1):
+                yield nested
+
+def generate(node):
+    #The source and compiled validate(suspicious, errors, context) function
+    #for a node tree, which does what validating the tree would.
+    generator = Generator()
+    generator.entry(node)
+    source = generator.source()
+    filename = '<ceramic_forms codegen {}>'.format(next(_form_ids))
+    linecache.cache[filename] = (
+        len(source), None, source.splitlines(True), filename)
+    namespace = dict(generator.namespace)
+    exec(compile(source, filename, 'exec'), namespace)
+    validate = namespace['validate']
+    #The source is kept for tracebacks only as long as the code is around.
+    weakref.finalize(validate, linecache.cache.pop, filename, None)
+    return source, validate
@@ -0,0 +1,427 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice, repeat
+from multiprocessing import shared_memory
+from operator import is_, is_not
+
+import ceramic_forms.form
+from ceramic_forms.form import (
+    ErrorRecord,
+    FormErr,
+    NO_ERRORS,
+    Result,
+    result_errors,
+    HASH_SAFE_TYPES,
+    init_worker,
+    worker_payload,
+    MapNode,
+    UseNode,
+    OrNode,
+    TypeNode,
+    LiteralNode,
+    LiteralSetNode,
+    KeyNode,
+    OptionalKeyNode,
+)
+
+def load_numpy():
+    try:
+        import numpy
+    except ImportError as e:
+        raise ImportError('The columnar engine needs NumPy: '
+                          'pip install ceramic_forms[columnar]') from e
+    return numpy
+
+class Column:
+    #A field whose values can all be checked at once. kind is 'type',
+    #'literals' (a literal or an Or of them) or 'convert' (Use(int) or
+    #Use(float)).
+
+    def __init__(self, key, required, kind, arg):
+        self.key = key
+        self.required = required
+        self.kind = kind
+        self.arg = arg
+
+def column_kind(node):
+    if isinstance(node, TypeNode):
+        return 'type', node.type
+    if isinstance(node, UseNode) and node.fn in (int, float):
+        return 'convert', node.fn
+    literals = []
+    conditions = node.conditions if isinstance(node, OrNode) else [node]
+    for condition in conditions:
+        if isinstance(condition, LiteralSetNode):
+            literals.extend(condition.literals)
+        elif isinstance(condition, LiteralNode):
+            literals.append(condition.literal)
+        else:
+            return None, None
+    if not all(type(literal) in HASH_SAFE_TYPES for literal in literals):
+        return None, None
+    return 'literals', frozenset(literals)
+
+def plan_columns(node):
+    #The columns of a flat map schema, or None if any of it needs Python
+    #level validation.
+    if not isinstance(node, MapNode):
+        return None
+    columns = []
+    for key_node in node.keys:
+        required = isinstance(key_node, KeyNode)
+        if not required:
+            if not isinstance(key_node, OptionalKeyNode) or \
+                    not isinstance(key_node.inner, KeyNode):
+                return None
+            key_node = key_node.inner
+        kind, arg = column_kind(key_node.value)
+        if kind is None:
+            return None
+        columns.append(Column(key_node.key, required, kind, arg))
+    return columns
+
+MISSING = object()
+
+#The only types astype converts the way int() and float() do; it turns
+#None into nan, for one, where float(None) raises.
+CONVERTIBLE_TYPES = frozenset((str, bytes, int, float, bool))
+
+class ColumnarValidator:
+    #Checks every field of a chunk of flat records at once with NumPy.
+    #Records that fail, and all records of a schema the columns can't express,
+    #go through Form.run so their errors are the ones validate_many gives.
+
+    def __init__(self, form):
+        self.np = load_numpy()
+        self.form = form
+        self.columns = None
+        #Size limits are only checked record by record by Form.run.
+        if not form.batched and form.limits is None:
+            self.columns = plan_columns(form.node)
+        if self.columns is not None:
+            self.keys = frozenset(column.key for column in self.columns)
+            self.required = frozenset(
+                column.key for column in self.columns if column.required)
+            self.converts = any(
+                column.kind == 'convert' for column in self.columns)
+
+    def check(self, column, values):
+        #Which values pass, as a boolean array or None when they all do,
+        #and their cleaned values where they differ from the values.
+        np = self.np
+        types = set(map(type, values))
+        if column.kind == 'type':
+            if types == {column.arg}:
+                return None, None
+            kinds = np.array(list(map(type, values)), dtype=object)
+            return kinds == column.arg, None
+        if column.kind == 'literals':
+            lookup = column.arg
+            if types <= HASH_SAFE_TYPES and lookup.issuperset(values):
+                return None, None
+            kinds = np.array(list(map(type, values)), dtype=object)
+            passed = np.zeros(len(values), bool)
+            safe = np.flatnonzero(np.isin(kinds, list(HASH_SAFE_TYPES)))
+            passed[safe] = [values[i] in lookup for i in safe.tolist()]
+            return passed, None
+        if types <= CONVERTIBLE_TYPES:
+            objects = np.empty(len(values), dtype=object)
+            objects[:] = values
+            target = np.int64 if column.arg is int else np.float64
+            try:
+                return None, objects.astype(target).tolist()
+            except (ValueError, TypeError, OverflowError):
+                pass
+        #Some value doesn't convert, so find out which one by one.
+        passed = np.ones(len(values), bool)
+        cleaned = [None] * len(values)
+        for i, value in enumerate(values):
+            try:
+                cleaned[i] = column.arg(value)
+            except Exception:
+                passed[i] = False
+        return passed, cleaned
+
+    def validate_chunk(self, rows):
+        np = self.np
+        count = len(rows)
+        passed = np.ones(count, bool)
+        if set(map(type, rows)) != {dict}:
+            passed &= np.fromiter((type(row) is dict for row in rows), bool,
+                                  count)
+            maps = [row if type(row) is dict else {} for row in rows]
+        else:
+            maps = rows
+        #How many of its keys the schema has a column for, so that rows
+        #with any other key fail below.
+        found = np.zeros(count, np.intp)
+        columns = []
+        sparse = False
+        for column in self.columns:
+            values = list(map(dict.get, maps, repeat(column.key),
+                              repeat(MISSING)))
+            present = None
+            if any(map(is_, values, repeat(MISSING))):
+                present = np.fromiter(map(is_not, values, repeat(MISSING)),
+                                      bool, count)
+                if column.required:
+                    passed &= present
+                present = np.flatnonzero(present)
+            sparse = sparse or present is not None
+            if present is None:
+                found += 1
+                ok, clean = self.check(column, values)
+                if ok is not None:
+                    passed &= ok
+            else:
+                found[present] += 1
+                checked = [values[i] for i in present.tolist()]
+                ok, clean = self.check(column, checked)
+                if ok is not None:
+                    passed[present[~ok]] = False
+                if clean is not None:
+                    for i, value in zip(present.tolist(), clean):
+                        values[i] = value
+                    clean = values
+            columns.append(values if clean is None else clean)
+        passed &= found == np.fromiter(map(len, maps), np.intp, count)
+        valid = np.flatnonzero(passed).tolist()
+        everything = len(valid) == count
+        if not everything:
+            rows_valid = [rows[i] for i in valid]
+            columns = [[values[i] for i in valid] for values in columns]
+        else:
+            rows_valid = rows
+        if not self.converts:
+            #Nothing changes a valid row, so it is its own cleaned value.
+            cleaned = rows_valid
+        else:
+            #Cleaned maps list their keys in schema order, as validate_map
+            #builds them.
+            keys = [column.key for column in self.columns]
+            if sparse:
+                cleaned = [
+                    {key: value for key, value in zip(keys, row)
+                     if value is not MISSING}
+                    for row in zip(*columns)
+                ]
+            else:
+                cleaned = list(map(dict, map(zip, repeat(keys),
+                                             zip(*columns))))
+        #Built with tuple.__new__ directly to skip the Python level
+        #constructor namedtuple gives Result.
+        results = list(map(tuple.__new__, repeat(Result),
+                           zip(repeat(True), cleaned, repeat(NO_ERRORS))))
+        if everything:
+            return results
+        merged = [None] * count
+        for i, result in zip(valid, results):
+            merged[i] = result
+        for i in np.flatnonzero(~passed).tolist():
+            errors = FormErr()
+            valid, clean = self.form.run(rows[i], errors)
+            merged[i] = Result(valid, clean, result_errors(errors))
+        return merged
+
+    def validate(self, records, chunksize):
+        if self.columns is None:
+            for result in self.form.validate_many(records,
+                                                  chunksize=chunksize):
+                yield result
+            return
+        records = iter(records)
+        for chunk in iter(lambda: list(islice(records, chunksize)), []):
+            for result in self.validate_chunk(chunk):
+                yield result
+
+def validate_columns(form, records, chunksize=65536):
+    #validate_many a column at a time. NumPy is only imported when this is
+    #called.
+    return ColumnarValidator(form).validate(records, chunksize)
+
+ArrayResult = namedtuple('ArrayResult', ['valid', 'cleaned', 'errors'])
+
+#Array dtype kinds for booleans, signed and unsigned integers and floats.
+NUMERIC_KINDS = 'biuf'
+TYPE_KINDS = {bool: 'b', int: 'iu', float: 'f'}
+NUMBER_TYPES = (bool, int, float)
+
+def check_array(np, column, values):
+    #check for a numeric array instead of a list of values.
+    kind = values.dtype.kind
+    if column.kind == 'type':
+        accepted = kind in TYPE_KINDS.get(column.arg, '')
+        return np.full(len(values), accepted), None
+    if column.kind == 'literals':
+        numbers = [literal for literal in column.arg
+                   if type(literal) in NUMBER_TYPES]
+        if not numbers:
+            return np.zeros(len(values), bool), None
+        return np.isin(values, numbers), None
+    if column.arg is float:
+        return None, values.astype(np.float64)
+    if kind == 'f':
+        #int() fails on nan and infinities, and the result has to fit.
+        passed = np.isfinite(values) & (np.abs(values) < 2.0 ** 63)
+        return passed, np.where(passed, values, 0).astype(np.int64)
+    if kind == 'u':
+        passed = values <= np.iinfo(np.int64).max
+        return passed, np.where(passed, values, 0).astype(np.int64)
+    return None, values.astype(np.int64)
+
+def converted_type(column):
+    if column.kind == 'convert':
+        return 'i8' if column.arg is int else 'f8'
+    return None
+
+def check_slice(form, inputs, outputs, valid, start, stop):
+    #Checks rows start to stop of the columns in inputs, writes the
+    #converted columns to outputs and which rows passed to valid, and
+    #returns the errors of the rows that didn't.
+    np = load_numpy()
+    columns = plan_columns(form.node)
+    passed = np.ones(stop - start, bool)
+    for column in columns:
+        values = inputs.get(column.key)
+        if values is None:
+            if column.required:
+                passed[:] = False
+            continue
+        ok, clean = check_array(np, column, values[start:stop])
+        if ok is not None:
+            passed &= ok
+        if clean is not None:
+            outputs[column.key][start:stop] = clean
+    errors = {}
+    for i in np.flatnonzero(~passed).tolist():
+        row = start + i
+        record = {key: values[row].item() for key, values in inputs.items()}
+        err = FormErr()
+        ok, clean = form.run(record, err)
+        if ok:
+            try:
+                for key, out in outputs.items():
+                    out[row] = clean[key]
+            except OverflowError as e:
+                err.add(key, ErrorRecord('error', clean[key], (), str(e)))
+                ok = False
+        if not ok:
+            errors[row] = err.render()
+        passed[i] = ok
+    valid[start:stop] = passed
+    return errors
+
+def attach(np, spec, blocks):
+    name, dtype, count = spec
+    block = shared_memory.SharedMemory(name=name)
+    blocks.append(block)
+    return np.ndarray((count,), dtype, buffer=block.buf)
+
+def check_shared(task):
+    #Runs check_slice in a worker on columns held in shared memory.
+    np = load_numpy()
+    inputs, outputs, valid, start, stop = task
+    blocks = []
+    try:
+        inputs = {key: attach(np, spec, blocks)
+                  for key, spec in inputs.items()}
+        outputs = {key: attach(np, spec, blocks)
+                   for key, spec in outputs.items()}
+        valid = attach(np, valid, blocks)
+        return check_slice(ceramic_forms.form.worker_form, inputs, outputs,
+                           valid, start, stop)
+    finally:
+        #The views must be gone before their blocks can be closed.
+        inputs = outputs = valid = None
+        for block in blocks:
+            block.close()
+
+class SharedArrays:
+    #Shared memory blocks holding arrays for worker processes.
+
+    def __init__(self, np):
+        self.np = np
+        self.blocks = []
+        self.views = []
+
+    def share(self, count, dtype, values=None):
+        dtype = self.np.dtype(dtype)
+        block = shared_memory.SharedMemory(
+            create=True, size=max(count * dtype.itemsize, 1))
+        self.blocks.append(block)
+        view = self.np.ndarray((count,), dtype, buffer=block.buf)
+        if values is not None:
+            view[:] = values
+        self.views.append(view)
+        return (block.name, dtype.str, count), view
+
+    def release(self):
+        del self.views[:]
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+
+def validate_arrays(form, arrays, workers=None, chunksize=65536):
+    #Validates records given as a numeric array per key without building
+    #them. With workers the arrays are copied once into shared memory and each
+    #process checks its rows in place, so only the errors are pickled.
+    np = load_numpy()
+    columns = None if form.batched else plan_columns(form.node)
+    if columns is None:
+        raise ValueError("Schema can't be checked a column at a time")
+    keys = {column.key for column in columns}
+    unknown = arrays.keys() - keys
+    if unknown:
+        #Every row would fail with the same error, one row at a time.
+        raise ValueError('Schema has no key {!r}'.format(unknown.pop()))
+    arrays = {key: np.asarray(values) for key, values in arrays.items()}
+    lengths = set()
+    for key, values in arrays.items():
+        if values.ndim != 1 or values.dtype.kind not in NUMERIC_KINDS:
+            raise TypeError('{!r} is not a one-dimensional numeric array'
+                            .format(key))
+        lengths.add(len(values))
+    if len(lengths) > 1:
+        raise ValueError('The arrays differ in length')
+    count = lengths.pop() if lengths else 0
+    converted = {
+        column.key: converted_type(column) for column in columns
+        if column.key in arrays and converted_type(column) is not None
+    }
+    if not workers:
+        outputs = {key: np.empty(count, dtype)
+                   for key, dtype in converted.items()}
+        valid = np.empty(count, bool)
+        errors = check_slice(form, arrays, outputs, valid, 0, count)
+    else:
+        errors = {}
+        shared = SharedArrays(np)
+        try:
+            inputs = {key: shared.share(count, values.dtype, values)[0]
+                      for key, values in arrays.items()}
+            views = {key: shared.share(count, dtype)
+                     for key, dtype in converted.items()}
+            valid_spec, valid_view = shared.share(count, bool)
+            tasks = [
+                (inputs, {key: spec for key, (spec, view) in views.items()},
+                 valid_spec, start, min(start + chunksize, count))
+                for start in range(0, count, chunksize)
+            ]
+            with ProcessPoolExecutor(
+                    workers,
+                    initializer=init_worker,
+                    initargs=(worker_payload(form),)) as pool:
+                for part in pool.map(check_shared, tasks):
+                    errors.update(part)
+            outputs = {key: view.copy() for key, (spec, view) in views.items()}
+            valid = valid_view.copy()
+            views = valid_view = None
+        finally:
+            shared.release()
+    cleaned = {key: outputs.get(key, values)
+               for key, values in arrays.items()}
+    return ArrayResult(valid, cleaned, errors)
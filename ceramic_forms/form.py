@@ -2,6 +2,16 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import asyncio
+import hashlib
+import inspect
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
 class Optional:
     def __init__(self, key):
         self.key = key
@@ -32,7 +42,187 @@ class Msg:
         self.validator = validator
         self.errmsg = errmsg
 
+class Batched:
+    def __init__(self, fn):
+        self.fn = fn
+
+class Cached:
+    def __init__(self, validator, maxsize=128):
+        self.validator = validator
+        self.cache = LRUCache(maxsize)
+
+    def cache_info(self):
+        return self.cache.info()
+
+    def cache_clear(self):
+        self.cache.clear()
+
+class Upload:
+    def __init__(self, max_size=None, content_types=None, magic=None,
+                 checksum=None, spool_size=1024 * 1024, chunk_size=65536):
+        self.max_size = max_size
+        self.content_types = content_types
+        if isinstance(magic, bytes):
+            magic = (magic,)
+        self.magic = magic
+        self.checksum = checksum
+        self.spool_size = spool_size
+        self.chunk_size = chunk_size
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+class LRUCache:
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            if self.maxsize is not None and len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def info(self):
+        with self.lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize,
+                             len(self.data))
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __reduce__(self):
+        #Worker processes start with an empty cache of their own.
+        return (LRUCache, (self.maxsize,))
+
+class ErrorRecord:
+    #An error kept as a code, the offending value and the parameters of
+    #its message. The text is only formatted when the record is read, and
+    #the record compares equal to that text.
+    __slots__ = ('code', 'value', 'params', 'message')
+
+    templates = {
+        'type': '{0!r} must be of type {1}',
+        'literal': '{0!r} should equal {1!r}',
+        'or': '{0} is not valid for any {1}',
+        'match': '{1} did not match {0}',
+        'missing': 'Missing {0}',
+        'missing_any': 'Missing any of {0}',
+        'missing_one': 'Missing one of {0}',
+        'too_many': 'Only one of {0} permitted',
+        'unexpected': 'Unexpected key {0}',
+        'not_file': '{0!r} is not a file',
+        'content_type': 'Content type {1} is not allowed',
+        'magic': 'File contents are not of an allowed type',
+        'too_large': 'File is larger than {1} bytes',
+        'checksum': 'File does not match its {1} checksum',
+        'too_deep': 'Nested more than {1} levels deep',
+        'too_long': 'Longer than {1} {2}',
+        'too_many_keys': 'More than {1} keys',
+        'key_too_long': 'Key longer than {1} {2}',
+        'too_many_values': 'More than {1} values in total',
+    }
+
+    def __init__(self, code, value=None, params=(), message=None):
+        self.code = code
+        self.value = value
+        self.params = params
+        self.message = message
+
+    def __str__(self):
+        if self.message is None:
+            self.message = self.templates[self.code].format(
+                self.value, *self.params)
+        return self.message
+
+    def __repr__(self):
+        return repr(str(self))
+
+    def __eq__(self, other):
+        if isinstance(other, ErrorRecord):
+            other = str(other)
+        return str(self) == other
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def __lt__(self, other):
+        return str(self) < str(other)
+
+    def __gt__(self, other):
+        return str(self) > str(other)
+
+    def __len__(self):
+        return len(str(self))
+
+    def __iter__(self):
+        return iter(str(self))
+
+    def __contains__(self, text):
+        return text in str(self)
+
+    def __getitem__(self, index):
+        return str(self)[index]
+
+    def __add__(self, other):
+        return str(self) + other
+
+    def __radd__(self, other):
+        return other + str(self)
+
+    def __format__(self, spec):
+        return format(str(self), spec)
+
+    def __getattr__(self, name):
+        #str methods such as startswith or upper.
+        return getattr(str(self), name)
+
+    def render(self):
+        return ErrorMessage(str(self), self.code, self.value, self.params)
+
+    def __reduce__(self):
+        #The value may not pickle, and the text already says what it was.
+        return (ErrorRecord, (self.code, None, (), str(self)))
+
+class ErrorMessage(str):
+    #What an ErrorRecord becomes once a form's errors are read: the text
+    #itself, with the code, value and params still attached.
+
+    def __new__(cls, text, code=None, value=None, params=()):
+        message = str.__new__(cls, text)
+        message.code = code
+        message.value = value
+        message.params = params
+        return message
+
+    def __reduce__(self):
+        return (ErrorMessage, (str(self), self.code))
+
+def render_messages(errors):
+    for i, error in enumerate(errors):
+        if type(error) is ErrorRecord:
+            list.__setitem__(errors, i, error.render())
+
 class SectionErrors(list):
+    __slots__ = ('parent',)
+
     def __init__(self, parent):
         self.parent = parent
 
@@ -40,21 +230,382 @@ class SectionErrors(list):
         self.parent['__section_errors__'] = self
         list.append(self, *args, **kwargs)
 
+class FieldErrors(list):
+    #Returned when reading a key that has no errors. It only becomes part
+    #of its parent once something is added to it, and if something else
+    #was stored under its key by then, what is added goes there instead.
+    __slots__ = ('parent', 'key', 'stored')
+
+    def __init__(self, parent, key):
+        self.parent = parent
+        self.key = key
+
+    def attach(self):
+        if self.parent is not None:
+            stored = dict.get(self.parent, self.key)
+            if stored is None:
+                self.parent[self.key] = stored = self
+            self.stored = stored
+            self.parent = None
+        return self.stored
+
+    def append(self, error):
+        list.append(self.attach(), error)
+
+    def extend(self, errors):
+        list.extend(self.attach(), errors)
+
+    def insert(self, index, error):
+        list.insert(self.attach(), index, error)
+
+    def __iadd__(self, errors):
+        return list.__iadd__(self.attach(), errors)
 
 class FormErr(dict):
+    #Nothing is allocated for a FormErr beyond the empty dict until an error
+    #is added to it.
+    __slots__ = ('sections',)
+
     def __init__(self, *args, **kwargs):
-        self.section_errors = SectionErrors(self)
+        self.sections = None
         dict.__init__(self, *args, **kwargs)
 
+    @property
+    def section_errors(self):
+        if self.sections is None:
+            self.sections = SectionErrors(self)
+        return self.sections
+
     def __getitem__(self, key):
         value = self.get(key)
         if value is None:
-            value = []
-            self[key] = value
+            return FieldErrors(self, key)
         return value
 
+    def add(self, key, error):
+        errors = self.get(key)
+        if errors is None:
+            self[key] = [error]
+        else:
+            errors.append(error)
+
+    def child(self):
+        return FormErr()
+
+    def clear(self):
+        dict.clear(self)
+        self.sections = None
+
+    def iter_errors(self, path=()):
+        for error in self.section_errors:
+            yield path, error
+        for key, value in dict.items(self):
+            if key == '__section_errors__':
+                continue
+            if isinstance(value, FormErr):
+                for nested in value.iter_errors(path + (key,)):
+                    yield nested
+            else:
+                for error in value:
+                    yield path + (key,), error
+
+    def render(self):
+        #Replaces the records in this FormErr and the ones in it with their
+        #messages, so what is read from a form or a result holds real str.
+        for value in dict.values(self):
+            if isinstance(value, FormErr):
+                value.render()
+            else:
+                render_messages(value)
+        if self.sections:
+            render_messages(self.sections)
+        return self
+
+    def messages(self):
+        #A copy made of plain dicts, lists and strings, e.g. for json.
+        rendered = {}
+        if self.sections and '__section_errors__' not in self:
+            rendered['__section_errors__'] = list(map(str, self.sections))
+        for key, value in dict.items(self):
+            if isinstance(value, FormErr):
+                rendered[key] = value.messages()
+            else:
+                rendered[key] = [
+                    str(error) if isinstance(error, (ErrorRecord, ErrorMessage))
+                    else error
+                    for error in value
+                ]
+        return rendered
+
     #TODO: len should calculate all errors recursively? at least include section_errors?
 
+def read_only(self, *args, **kwargs):
+    raise TypeError('NoErrors is read-only')
+
+class NoFieldErrors(list):
+    #The errors NoErrors has for every field and for its section.
+    __slots__ = ()
+
+    append = extend = insert = remove = pop = clear = read_only
+    sort = reverse = __setitem__ = __delitem__ = read_only
+    __iadd__ = __imul__ = read_only
+
+NO_FIELD_ERRORS = NoFieldErrors()
+
+class NoErrors(FormErr):
+    #Shared by every result that has nothing to report, so it can't be
+    #written to.
+    __slots__ = ()
+
+    @property
+    def section_errors(self):
+        return NO_FIELD_ERRORS
+
+    def __getitem__(self, key):
+        return NO_FIELD_ERRORS
+
+    __setitem__ = __delitem__ = add = update = setdefault = read_only
+    pop = popitem = clear = __ior__ = read_only
+
+    def render(self):
+        return self
+
+    def __reduce__(self):
+        return 'NO_ERRORS'
+
+NO_ERRORS = NoErrors()
+
+class DiscardErrors(FormErr):
+    #Takes the errors of Or attempts, Msg wrapped validators and the like,
+    #whose errors are never looked at, without keeping any of them.
+    __slots__ = ()
+
+    @property
+    def section_errors(self):
+        return []
+
+    def __getitem__(self, key):
+        return []
+
+    def __setitem__(self, key, value):
+        pass
+
+    def add(self, key, error):
+        pass
+
+    def child(self):
+        return self
+
+    def clear(self):
+        pass
+
+    def __reduce__(self):
+        return 'DISCARD'
+
+DISCARD = DiscardErrors()
+
+class Result(namedtuple('Result', ['valid', 'cleaned', 'errors'])):
+    #The errors are turned into str messages when they are first read.
+    __slots__ = ()
+
+    @property
+    def errors(self):
+        return tuple.__getitem__(self, 2).render()
+
+    def __getitem__(self, index):
+        self.errors
+        return tuple.__getitem__(self, index)
+
+    def __iter__(self):
+        self.errors
+        return tuple.__iter__(self)
+
+def result_errors(errors):
+    #Section errors added with extend aren't in the dict itself, so an
+    #empty FormErr can still have something to report.
+    if errors or errors.sections:
+        return errors
+    return NO_ERRORS
+
+class Context:
+    #State of a single validation, shared by every node it passes through.
+    __slots__ = ('entire_structure', 'pending', 'verdicts', 'fail_fast',
+                 'executor', 'paths', 'conditions', 'copies')
+
+    def __init__(self, entire_structure, pending=None, verdicts=None,
+                 fail_fast=False, executor=None, copies=None):
+        self.entire_structure = entire_structure
+        self.pending = pending
+        self.verdicts = verdicts
+        self.fail_fast = fail_fast
+        self.executor = executor
+        #The uploads copied by the first of two passes, by id of the file,
+        #for the second pass to take up.
+        if copies is None and pending is not None:
+            copies = {}
+        self.copies = copies
+        self.paths = None
+        self.conditions = None
+
+    def serial(self):
+        #The same validation for a task running in the executor. It doesn't
+        #hand work on to the executor again, so no task in the pool ever
+        #waits on another.
+        return Context(self.entire_structure, self.pending, self.verdicts,
+                       self.fail_fast, copies=self.copies)
+
+    def holds(self, condition):
+        #Whether every path of an If exists. Paths and whole conditions are
+        #looked up once per validation and shared by every If using them.
+        if self.conditions is None:
+            self.conditions = {}
+            self.paths = {}
+        found = self.conditions.get(condition)
+        if found is None:
+            found = all(self.exists(path) for path in condition)
+            self.conditions[condition] = found
+        return found
+
+    def exists(self, path):
+        found = self.paths.get(path)
+        if found is None:
+            found = path_exists(path, self.entire_structure)
+            self.paths[path] = found
+        return found
+
+class Limits:
+    #Bounds on the size of submitted data, checked in a single pass before
+    #any validator runs.
+    __slots__ = ('max_depth', 'max_length', 'max_keys', 'max_string',
+                 'max_nodes')
+
+    def __init__(self, max_depth=None, max_length=None, max_keys=None,
+                 max_string=None, max_nodes=None):
+        self.max_depth = max_depth
+        self.max_length = max_length
+        self.max_keys = max_keys
+        self.max_string = max_string
+        self.max_nodes = max_nodes
+
+    def args(self):
+        return (self.max_depth, self.max_length, self.max_keys,
+                self.max_string, self.max_nodes)
+
+    def allow(self, structure, errors, path=(), depth=1):
+        #Walks structure with a stack of its own, so no depth of nesting
+        #can exhaust the interpreter's. Stops at the first value over a
+        #limit, whose error goes where the value's own errors would. The
+        #outermost container is at depth 1.
+        found = self.exceeded(structure, depth)
+        if found is not None:
+            return self.reject(errors, path, structure, found)
+        unbounded = float('inf')
+        max_depth = unbounded if self.max_depth is None else self.max_depth
+        max_length = unbounded if self.max_length is None \
+            else self.max_length
+        max_keys = unbounded if self.max_keys is None else self.max_keys
+        max_string = unbounded if self.max_string is None \
+            else self.max_string
+        max_nodes = unbounded if self.max_nodes is None else self.max_nodes
+        nodes = 1
+        #Each entry is a container, its depth, the entry it is in and its
+        #key there.
+        stack = [(structure, depth, None, None)]
+        while stack:
+            entry = stack.pop()
+            container, depth = entry[:2]
+            keyed = isinstance(container, dict)
+            if keyed:
+                items = container.items()
+            elif isinstance(container, (list, tuple)):
+                items = enumerate(container)
+            else:
+                continue
+            nodes += len(container)
+            if nodes > max_nodes:
+                errors.section_errors.append(
+                    ErrorRecord('too_many_values', None, (max_nodes,)))
+                return False
+            for key, value in items:
+                if keyed and isinstance(key, (str, bytes)) and \
+                        len(key) > max_string:
+                    return self.reject_key(errors, path + self.path(entry),
+                                           key)
+                kind = type(value)
+                if kind in NUMBER_TYPES or value is None:
+                    continue
+                if kind is str or kind is bytes or \
+                        isinstance(value, (str, bytes)):
+                    if len(value) <= max_string:
+                        continue
+                elif isinstance(value, (dict, list, tuple)):
+                    stack.append((value, depth + 1, entry, key))
+                    if depth < max_depth and len(value) <= (
+                            max_keys if isinstance(value, dict)
+                            else max_length):
+                        continue
+                else:
+                    continue
+                return self.reject(
+                    errors, path + self.path(entry) + (key,), value,
+                    self.exceeded(value, depth + 1))
+        return True
+
+    def exceeded(self, value, depth):
+        #The error of a single value over a limit, None if it isn't.
+        if isinstance(value, (str, bytes)):
+            if self.max_string is not None and len(value) > self.max_string:
+                return ('too_long', self.max_string, 'characters'
+                        if isinstance(value, str) else 'bytes')
+        elif isinstance(value, (dict, list, tuple)):
+            if self.max_depth is not None and depth > self.max_depth:
+                return ('too_deep', self.max_depth)
+            if isinstance(value, dict):
+                if self.max_keys is not None and len(value) > self.max_keys:
+                    return ('too_many_keys', self.max_keys)
+            elif self.max_length is not None and \
+                    len(value) > self.max_length:
+                return ('too_long', self.max_length, 'items')
+        return None
+
+    def path(self, entry):
+        keys = []
+        while entry[2] is not None:
+            keys.append(entry[3])
+            entry = entry[2]
+        return tuple(reversed(keys))
+
+    def key_exceeded(self, key):
+        if isinstance(key, (str, bytes)) and self.max_string is not None \
+                and len(key) > self.max_string:
+            return ('key_too_long', self.max_string, 'characters'
+                    if isinstance(key, str) else 'bytes')
+        return None
+
+    def reject(self, errors, path, value, found):
+        record = ErrorRecord(found[0], value, found[1:])
+        if not path:
+            errors.section_errors.append(record)
+            return False
+        self.errors_at(errors, path[:-1]).add(path[-1], record)
+        return False
+
+    def reject_key(self, errors, path, key):
+        #A key too long to be named in an error goes to the section errors
+        #of its map, like an unexpected key.
+        found = self.key_exceeded(key)
+        record = ErrorRecord(found[0], key, found[1:])
+        self.errors_at(errors, path).section_errors.append(record)
+        return False
+
+    def errors_at(self, errors, path):
+        for key in path:
+            child = errors.get(key)
+            if not isinstance(child, FormErr):
+                child = errors[key] = errors.child()
+            errors = child
+        return errors
+
 def path_exists(path, structure):
     place = structure
     for key in path:
@@ -64,318 +615,1826 @@ def path_exists(path, structure):
             return False
     return True
 
-def validate_key(
-        key,
-        suspicious,
-        reference_value,
-        errors,
-        entire_structure,
-        validated_keys):
-    validated = False
-    cleaned = []
-    if isinstance(key, Optional):
-        validated = True
-        key = key.key
-        if key in suspicious:
-            validated, clean = validate_key(
-                key,
-                suspicious,
-                reference_value,
-                errors,
-                entire_structure,
-                validated_keys
-            )
-            cleaned.extend(clean)
-    elif key == Or:
-        validated = True
-        none_exist = True
-        for orkey, orvalue in reference_value.items():
-            if orkey in suspicious:
-                none_exist = False
-                cleaned_key = orkey
-                valid, clean = validate_key(
-                    orkey,
-                    suspicious,
-                    orvalue,
-                    errors,
-                    entire_structure,
-                    validated_keys
-                )
-                if valid:
-                    cleaned.extend(clean)
-                validated = validated and valid
-        if none_exist:
-            validated = False
-            errors.section_errors.append(
-                "Missing any of {}".format(reference_value.keys()))
-    elif key == XOr:
-        validated = 0
-        for orkey, orvalue in reference_value.items():
-            if orkey in suspicious:
-                valid, clean = validate_key(
-                    orkey,
-                    suspicious,
-                    orvalue,
-                    errors,
-                    entire_structure,
-                    validated_keys
-                )
-                if valid:
-                    cleaned.extend(clean)
-                    validated += 1
-        if validated == 0:
-            errors.section_errors.append(
-                "Missing one of {}".format(reference_value.keys()))
-            validated = False
-        elif validated > 1:
-            errors.section_errors.append(
-                "Only one of {} permitted".format(reference_value.keys()))
-            validated = False
-        else:
-            validated = True
-    elif isinstance(key, And):
-        validated = True
-        for raw_key in suspicious:
-            err = FormErr()
-            valid_key, clean_key = validate_value(
-                0,
-                raw_key,
-                key,
-                err,
-                entire_structure
-            )
-            validated = validated and valid_key
-            if not valid_key:
-                errors.section_errors.extend(err[0])
-            valid_value, clean = validate_value(
-                raw_key,
-                suspicious[raw_key],
-                reference_value,
-                errors,
-                entire_structure
-            )
-            validated = validated and valid_value
-            validated_keys.add(raw_key)
-            if valid_key and valid_value:
-                cleaned.append((clean_key, clean))
-    elif isinstance(key, If):
-        exists = True
-        validated = True
-        for path in key.paths:
-            if not path_exists(path, entire_structure):
-                exists = False
-                break
-        if exists:
-            validated, clean = validate_key(
-                key.key,
-                suspicious,
-                reference_value,
-                errors,
-                entire_structure,
-                validated_keys
-            )
-            cleaned.extend(clean)
-        #TODO: what happens if the key exists, but paths weren't found?
-    elif isinstance(key, Msg):
-        validated, clean = validate_key(
-            key.validator,
-            suspicious,
-            reference_value,
-            FormErr(),
-            entire_structure,
-            validated_keys
-        )
-        if not validated:
-            errors.section_errors.append(key.errmsg)
-        else:
-            cleaned.extend(clean)
-    elif key in suspicious:
-        validated_keys.add(key)
-        validated, clean = validate_value(
-            key,
-            suspicious[key],
-            reference_value,
-            errors,
-            entire_structure
-        )
-        if validated:
-            cleaned.append((key, clean))
-    else:
-        errors.section_errors.append("Missing {}".format(key))
-        validated = False
-    return validated, cleaned
-
 def append_dict_or_list(collection, key, val):
     try:
         collection[key] = val
     except IndexError:
         collection.append(val)
 
-def validate_value(key, value, reference_value, errors, entire_structure):
-    valid = False
-    clean = None
-    if isinstance(reference_value, dict):
-        next_level_errors = FormErr()
-        valid, clean = validate_map(
-            reference_value,
+def merge_errors(errors, other):
+    #Section errors added with extend are only in other.sections, and only
+    #ones added with append make the parent list part of the dict.
+    if other.sections:
+        if '__section_errors__' in other:
+            for error in other.sections:
+                errors.section_errors.append(error)
+        else:
+            errors.section_errors.extend(other.sections)
+    for key, value in other.items():
+        if key == '__section_errors__':
+            continue
+        elif isinstance(value, list) and isinstance(errors.get(key), list):
+            errors.get(key).extend(value)
+        else:
+            errors[key] = value
+
+async def gather_in_order(calls):
+    #Run (node, args) calls, awaiting the asynchronous ones concurrently,
+    #and return their outcomes in call order.
+    outcomes = []
+    tasks = []
+    for node, args in calls:
+        if node.is_async:
+            outcome = asyncio.ensure_future(node.avalidate(*args))
+            tasks.append(outcome)
+        else:
+            outcome = node.validate(*args)
+        outcomes.append(outcome)
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return [
+        outcome.result() if isinstance(outcome, asyncio.Future) else outcome
+        for outcome in outcomes
+    ]
+
+class Node:
+    is_async = False
+    #Whether a valid value always comes back as the very same object, in
+    #which case whole maps and lists of such values need no copy.
+    preserves = False
+
+    async def avalidate(self, *args):
+        return self.validate(*args)
+
+    def children(self):
+        return ()
+
+    def may_accept(self, type_):
+        #False only when no value of exactly this type can be valid.
+        return True
+
+def iter_nodes(node):
+    yield node
+    for child in node.children():
+        for descendant in iter_nodes(child):
+            yield descendant
+
+def calls_out(node):
+    #Whether validating with node runs any user code, the only work worth
+    #handing to an executor.
+    return any(isinstance(n, (UseNode, CallableNode, CachedNode, UploadNode))
+               for n in iter_nodes(node))
+
+#Elements of a list validated by each task when running in an executor.
+PARALLEL_CHUNK = 64
+
+def unchanged(suspicious, pairs):
+    #Whether the cleaned pairs of a dict are its very own items.
+    count = 0
+    for key, value in pairs:
+        if key not in suspicious or suspicious[key] is not value:
+            return False
+        count += 1
+    return count == len(suspicious)
+
+class MapNode(Node):
+    type_name = 'dict'
+
+    def __init__(self, schema):
+        self.keys = [compile_key(key, value) for key, value in schema.items()]
+        self.is_async = any(key_node.is_async for key_node in self.keys)
+        self.shares = all(key_node.preserves for key_node in self.keys)
+        #Without And keys that clean keys into other ones, a valid dict whose
+        #values all came back as themselves can still be its own cleaned
+        #value, which is checked once validation is done.
+        self.keeps_keys = not any(
+            isinstance(node, AndKeyNode) and not node.key.preserves
+            for key_node in self.keys for node in iter_nodes(key_node))
+        self.costly = [calls_out(key_node) for key_node in self.keys]
+        self.concurrent = sum(self.costly) > 1
+
+    def children(self):
+        return self.keys
+
+    def may_accept(self, type_):
+        return type_ is dict
+
+    def validate(self, key, value, errors, context):
+        next_level_errors = errors.child()
+        valid, clean = self.validate_map(
             value,
             next_level_errors,
-            entire_structure
+            context
         )
         if not valid:
             errors[key] = next_level_errors
-    elif isinstance(reference_value, list):
-        next_level_errors = FormErr()
-        valid, clean = validate_sequence(reference_value, value,
-                             next_level_errors, entire_structure)
+        return valid, clean
+
+    def validate_map(self, suspicious, errors, context):
+        #A valid dict whose values all come back unchanged is its own
+        #cleaned value. The pairs are only turned into a new dict if it
+        #turns out otherwise.
+        if self.concurrent and context.executor is not None:
+            return self.validate_map_concurrently(suspicious, errors,
+                                                  context)
+        share = self.keeps_keys and type(suspicious) is dict
+        all_valid = True
+        cleaned = {}
+        found = []
+        keys_validated = set()
+        for key_node in self.keys:
+            valid, clean = key_node.validate(
+                suspicious,
+                errors,
+                context,
+                keys_validated
+            )
+            if share:
+                found.extend(clean)
+            else:
+                for key, value in clean:
+                    cleaned[key] = value
+            if not valid and context.fail_fast:
+                return False, dict(found) if share else cleaned
+            all_valid = all_valid and valid
+        all_valid = self.check_extra(suspicious, errors, keys_validated) \
+            and all_valid
+        if share:
+            if all_valid and (self.shares or unchanged(suspicious, found)):
+                return True, suspicious
+            return all_valid, dict(found)
+        return all_valid, cleaned
+
+    def validate_map_concurrently(self, suspicious, errors, context):
+        #Keys calling out to user code run in the executor, each with errors
+        #and validated keys of its own. Everything is merged back in schema
+        #order so the outcome is the one validate_map gives.
+        share = self.keeps_keys and type(suspicious) is dict
+        calls = []
+        for key_node, costly in zip(self.keys, self.costly):
+            err = errors.child()
+            keys = set()
+            if costly:
+                outcome = context.executor.submit(
+                    key_node.validate, suspicious, err, context.serial(), keys)
+            else:
+                outcome = None
+            calls.append((key_node, err, keys, outcome))
+        all_valid = True
+        cleaned = {}
+        found = []
+        keys_validated = set()
+        for n, (key_node, err, keys, outcome) in enumerate(calls):
+            if outcome is None:
+                valid, clean = key_node.validate(suspicious, err, context,
+                                                 keys)
+            else:
+                valid, clean = outcome.result()
+            merge_errors(errors, err)
+            keys_validated |= keys
+            if share:
+                found.extend(clean)
+            else:
+                for key, value in clean:
+                    cleaned[key] = value
+            if not valid and context.fail_fast:
+                for call in calls[n + 1:]:
+                    if call[3] is not None:
+                        call[3].cancel()
+                return False, dict(found) if share else cleaned
+            all_valid = all_valid and valid
+        all_valid = self.check_extra(suspicious, errors, keys_validated) \
+            and all_valid
+        if share:
+            if all_valid and (self.shares or unchanged(suspicious, found)):
+                return True, suspicious
+            return all_valid, dict(found)
+        return all_valid, cleaned
+
+    def check_extra(self, suspicious, errors, keys_validated):
+        extra_keys = suspicious.keys() - keys_validated
+        if extra_keys:
+            for extra_key in extra_keys:
+                errors.section_errors.append(
+                    ErrorRecord('unexpected', extra_key))
+            return False
+        return True
+
+    async def avalidate(self, key, value, errors, context):
+        if not self.is_async:
+            return self.validate(key, value, errors, context)
+        next_level_errors = errors.child()
+        valid, clean = await self.avalidate_map(
+            value,
+            next_level_errors,
+            context
+        )
         if not valid:
             errors[key] = next_level_errors
-    elif isinstance(reference_value, Use):
-        valid = True
-        try:
-            result = reference_value.fn(value)
-        except Exception as e:
-            errors[key].append(str(e))
-            return False, None
-        clean = result
-    elif isinstance(reference_value, And):
-        valid = True
-        for condition in reference_value.conditions:
-            _valid, clean = validate_value(key, value, condition,
-                                  errors, entire_structure)
-            value = clean
-            valid = valid and _valid
+        return valid, clean
+
+    async def avalidate_map(self, suspicious, errors, context):
+        #Every key gets its own errors while running concurrently; they are
+        #merged in schema order so the result matches validate_map.
+        if not self.is_async:
+            return self.validate_map(suspicious, errors, context)
+        all_valid = True
+        cleaned = {}
+        keys_validated = set()
+        key_errors = [errors.child() for key_node in self.keys]
+        outcomes = await gather_in_order(
+            (key_node, (suspicious, err, context, keys_validated))
+            for key_node, err in zip(self.keys, key_errors)
+        )
+        for (valid, clean), err in zip(outcomes, key_errors):
+            merge_errors(errors, err)
+            for key, value in clean:
+                cleaned[key] = value
+            all_valid = all_valid and valid
+        all_valid = self.check_extra(suspicious, errors, keys_validated) \
+            and all_valid
+        if all_valid and self.keeps_keys and type(suspicious) is dict and \
+                unchanged(suspicious, cleaned.items()):
+            return True, suspicious
+        return all_valid, cleaned
+
+#Exact types the alternatives of a sequence are sorted by ahead of time.
+DISPATCH_TYPES = (str, bytes, int, float, bool, type(None), dict, list, tuple)
+
+class SequenceNode(Node):
+    type_name = 'list'
+
+    def __init__(self, schema):
+        self.validators = [compile_value(validator) for validator in schema]
+        self.is_async = any(v.is_async for v in self.validators)
+        self.costly = any(calls_out(v) for v in self.validators)
+        self.dispatch = None
+        if len(self.validators) > 1:
+            self.dispatch = {
+                type_: [v for v in self.validators if v.may_accept(type_)]
+                for type_ in DISPATCH_TYPES
+            }
+
+    def children(self):
+        return self.validators
+
+    def may_accept(self, type_):
+        return type_ in (list, tuple, str, bytes, dict)
+
+    def candidates(self, value):
+        if self.dispatch is None:
+            return self.validators
+        return self.dispatch.get(type(value), self.validators)
+
+    def validate(self, key, value, errors, context):
+        next_level_errors = errors.child()
+        valid, clean = self.validate_sequence(
+            value,
+            next_level_errors,
+            context
+        )
+        if not valid:
+            errors[key] = next_level_errors
+        return valid, clean
+
+    def validate_sequence(self, suspicious, errors, context):
+        #A list stays its own cleaned value for as long as every element
+        #comes back as the same object.
+        if context.executor is not None and self.costly and \
+                type(suspicious) in (list, tuple) and \
+                len(suspicious) > PARALLEL_CHUNK:
+            return self.validate_chunks(suspicious, errors, context)
+        share = type(suspicious) is list
+        all_valid = True
+        cleaned = []
+        for i, value in enumerate(suspicious):
+            valid, clean = self.validate_element(i, value, errors, context)
+            if share and clean is not value:
+                share = False
+                cleaned = suspicious[:i]
+            if not share:
+                cleaned.append(clean)
+            if not valid and context.fail_fast:
+                return False, suspicious[:i + 1] if share else cleaned
+            all_valid = all_valid and valid
+        return all_valid, suspicious if share else cleaned
+
+    def validate_chunks(self, suspicious, errors, context):
+        #Runs chunks of the list in the executor, each with errors of its
+        #own, and merges them back in index order so the outcome is the one
+        #validate_sequence gives.
+        share = type(suspicious) is list
+        chunks = []
+        for start in range(0, len(suspicious), PARALLEL_CHUNK):
+            err = errors.child()
+            outcome = context.executor.submit(
+                self.validate_range, suspicious, start,
+                min(start + PARALLEL_CHUNK, len(suspicious)), err,
+                context.serial())
+            chunks.append((start, err, outcome))
+        all_valid = True
+        cleaned = None
+        for n, (start, err, outcome) in enumerate(chunks):
+            valid, clean, stop = outcome.result()
+            merge_errors(errors, err)
+            if cleaned is None and (clean is not None or not share):
+                cleaned = list(suspicious[:start])
+            if cleaned is not None:
+                cleaned.extend(suspicious[start:stop] if clean is None
+                               else clean)
+            if not valid and context.fail_fast:
+                for chunk in chunks[n + 1:]:
+                    chunk[2].cancel()
+                return False, suspicious[:stop] if cleaned is None \
+                    else cleaned
+            all_valid = all_valid and valid
+        return all_valid, suspicious if cleaned is None else cleaned
+
+    def validate_range(self, suspicious, start, stop, errors, context):
+        #validate_sequence for suspicious[start:stop]. The cleaned elements
+        #are None while every one of them is the element itself, and the
+        #index validation stopped at comes along with them.
+        all_valid = True
+        cleaned = None
+        for i in range(start, stop):
+            value = suspicious[i]
+            valid, clean = self.validate_element(i, value, errors, context)
+            if cleaned is None and clean is not value:
+                cleaned = list(suspicious[start:i])
+            if cleaned is not None:
+                cleaned.append(clean)
+            if not valid and context.fail_fast:
+                return False, cleaned, i + 1
+            all_valid = all_valid and valid
+        return all_valid, cleaned, stop
+
+    def validate_element(self, i, value, errors, context):
+        validators = self.candidates(value)
+        if validators is self.validators:
+            valid, clean = self.validate_item(i, value, errors, context,
+                                              validators)
+        else:
+            outcomes = {}
+            valid, clean = self.validate_item(i, value, errors, context,
+                                              validators, outcomes)
             if not valid:
-                break
-    elif isinstance(reference_value, Or):
+                valid, clean = self.retry(i, value, errors, context,
+                                          outcomes)
+        if valid and i in errors:
+            del errors[i]
+        return valid, clean
+
+    def validate_item(self, i, value, errors, context, validators,
+                      outcomes=None):
+        #With outcomes, the clean value and errors of every alternative
+        #that fails are taken aside into it.
         valid = False
-        dummy_err = FormErr()
-        for condition in reference_value.conditions:
-            valid, clean = validate_value(key, value, condition,
-                                  dummy_err, entire_structure)
+        clean = None
+        for validator in validators:
+            valid, clean = validator.validate(
+                i,
+                value,
+                errors,
+                context
+            )
             if valid:
                 break
-        if not valid:
-            errors[key].append('{} is not valid for any {}'.format(
-                value,
-                reference_value.conditions
-            ))
-    elif isinstance(reference_value, Msg):
-        valid, clean = validate_value(key, value, reference_value.validator,
-                                  FormErr(), entire_structure)
-        if not valid:
-            errors[key].append(reference_value.errmsg)
-    elif type(reference_value) is type:
-        if type(value) is reference_value:
-            valid = True
-            clean = value
-        else:
-            errors[key].append("{} must be of type {}".format(
-                repr(value), reference_value.__name__
-            ))
-            valid = False
-    elif callable(reference_value):
-        try:
-            result = reference_value(value)
-        except Exception as e:
-            #Bug hunting might have just gotten harder with a catchall Exception.
-            errors[key].append(str(e))
-            return False, None
-        if result:
-            valid = True
-            clean = value
+            if outcomes is not None:
+                outcomes[validator] = (clean, errors.pop(i, None))
+        return valid, clean
+
+    def retry(self, i, value, errors, context, outcomes):
+        #The alternatives the dispatch ruled out only run once the others
+        #failed, and each alternative runs once. Their errors are then put
+        #back in schema order, as if every one had been tried in turn.
+        rest = self.rule_out(value, outcomes)
+        valid, clean = self.validate_item(i, value, errors, context, rest,
+                                          outcomes)
+        if valid:
+            return valid, clean
+        return False, self.merge_outcomes(i, errors, outcomes)
+
+    def rule_out(self, value, outcomes):
+        #The alternatives not tried yet. Maps and lists would raise on a
+        #value of a type they ruled out, so they get a type error instead.
+        rest = []
+        for validator in self.validators:
+            if validator in outcomes:
+                continue
+            if isinstance(validator, (MapNode, SequenceNode)):
+                outcomes[validator] = (None, [ErrorRecord(
+                    'type', value, (validator.type_name,))])
+            else:
+                rest.append(validator)
+        return rest
+
+    def merge_outcomes(self, i, errors, outcomes):
+        #An alternative that went into the element reports on what is inside
+        #it, and that report is kept over the messages of the others.
+        clean = None
+        nested = None
+        messages = []
+        for validator in self.validators:
+            clean, report = outcomes[validator]
+            if isinstance(report, FormErr):
+                nested = report
+            elif report is not None:
+                messages.extend(report)
+        if nested is not None:
+            errors[i] = nested
         else:
-            valid = False
-            errors[key].append("{} did not match {}".format(
-                reference_value.__name__,
-                value
-            ))
-    else:
-        valid = value == reference_value
-        clean = value
+            for error in messages:
+                errors.add(i, error)
+        return clean
+
+    async def avalidate(self, key, value, errors, context):
+        if not self.is_async:
+            return self.validate(key, value, errors, context)
+        next_level_errors = errors.child()
+        valid, clean = await self.avalidate_sequence(
+            value,
+            next_level_errors,
+            context
+        )
         if not valid:
-            errors[key].append('{} should equal {}'.format(
-                    repr(value), repr(reference_value)
-            ))
-            clean = None
-    return valid, clean
-
-def validate_sequence(schema, suspicious, errors, entire_structure):
-    all_valid = True
-    cleaned = []
-    for i, value in enumerate(suspicious):
+            errors[key] = next_level_errors
+        return valid, clean
+
+    async def avalidate_item(self, i, value, errors, context):
+        validators = self.candidates(value)
+        if validators is self.validators:
+            return await self.avalidate_alternatives(i, value, errors,
+                                                     context, validators)
+        outcomes = {}
+        valid, clean = await self.avalidate_alternatives(
+            i, value, errors, context, validators, outcomes)
+        if valid:
+            return valid, clean
+        rest = self.rule_out(value, outcomes)
+        valid, clean = await self.avalidate_alternatives(
+            i, value, errors, context, rest, outcomes)
+        if valid:
+            return valid, clean
+        return False, self.merge_outcomes(i, errors, outcomes)
+
+    async def avalidate_alternatives(self, i, value, errors, context,
+                                     validators, outcomes=None):
         valid = False
-        for validator in schema:
-            valid, clean = validate_value(
+        clean = None
+        for validator in validators:
+            valid, clean = await validator.avalidate(
                 i,
                 value,
-                validator,
                 errors,
-                entire_structure
+                context
             )
-            cleaned.append(clean)
             if valid:
                 break
-        if valid and i in errors:
-            del errors[i]
-        all_valid = all_valid and valid
-    return all_valid, cleaned
-
-def validate_map(schema, suspicious, errors, entire_structure):
-    all_valid = True
-    cleaned = {}
-    keys_validated = set()
-    for key, reference_value in schema.items():
-        valid, clean = validate_key(
-            key,
-            suspicious,
-            reference_value,
-            errors,
-            entire_structure,
-            keys_validated
-        )
-        for key, value in clean:
-            cleaned[key] = value
-        all_valid = all_valid and valid
+            if outcomes is not None:
+                outcomes[validator] = (clean, errors.pop(i, None))
+        return valid, clean
 
-    extra_keys = suspicious.keys() - keys_validated
-    if extra_keys:
-        all_valid = False
-        for extra_key in extra_keys:
-            errors.section_errors.append('Unexpected key {}'.format(extra_key))
-    return all_valid, cleaned
+    async def avalidate_sequence(self, suspicious, errors, context):
+        if not self.is_async:
+            return self.validate_sequence(suspicious, errors,
+                                          context)
+        items = list(enumerate(suspicious))
+        item_errors = [errors.child() for item in items]
+        outcomes = await asyncio.gather(*(
+            self.avalidate_item(i, value, err, context)
+            for (i, value), err in zip(items, item_errors)
+        ), return_exceptions=True)
+        all_valid = True
+        cleaned = []
+        for (i, value), err, outcome in zip(items, item_errors, outcomes):
+            if isinstance(outcome, BaseException):
+                raise outcome
+            valid, clean = outcome
+            cleaned.append(clean)
+            if not valid and i in err:
+                errors[i] = dict.__getitem__(err, i)
+            all_valid = all_valid and valid
+        return all_valid, cleaned
 
-#TODO: Optional, If as key.
-#TODO: Optional should check existence, not validation.
+class UseNode(Node):
+    def __init__(self, fn):
+        self.fn = fn
+
+    def validate(self, key, value, errors, context):
+        try:
+            clean = self.fn(value)
+        except Exception as e:
+            errors.add(key, ErrorRecord('error', value, (), str(e)))
+            return False, None
+        return True, clean
+
+class AsyncUseNode(UseNode):
+    is_async = True
+
+    def validate(self, key, value, errors, context):
+        raise TypeError('{} is a coroutine function, use Form.acheck'.format(
+            self.fn.__name__))
+
+    async def avalidate(self, key, value, errors, context):
+        try:
+            clean = await self.fn(value)
+        except Exception as e:
+            errors.add(key, ErrorRecord('error', value, (), str(e)))
+            return False, None
+        return True, clean
+
+class AndNode(Node):
+    def __init__(self, conditions):
+        self.conditions = [compile_value(c) for c in conditions]
+        self.is_async = any(c.is_async for c in self.conditions)
+        self.preserves = bool(self.conditions) and \
+            all(c.preserves for c in self.conditions)
+
+    def children(self):
+        return self.conditions
+
+    def may_accept(self, type_):
+        return not self.conditions or self.conditions[0].may_accept(type_)
+
+    def validate(self, key, value, errors, context):
+        valid = True
+        clean = None
+        for condition in self.conditions:
+            valid, clean = condition.validate(key, value, errors,
+                                              context)
+            if not valid:
+                break
+            value = clean
+        return valid, clean
+
+    async def avalidate(self, key, value, errors, context):
+        valid = True
+        clean = None
+        for condition in self.conditions:
+            valid, clean = await condition.avalidate(key, value, errors,
+                                                     context)
+            if not valid:
+                break
+            value = clean
+        return valid, clean
+
+class OrNode(Node):
+    def __init__(self, conditions):
+        self.raw_conditions = conditions
+        self.conditions = group_literals(
+            [compile_value(c) for c in conditions])
+        self.is_async = any(c.is_async for c in self.conditions)
+        self.preserves = all(c.preserves for c in self.conditions)
+
+    def children(self):
+        return self.conditions
+
+    def may_accept(self, type_):
+        return any(c.may_accept(type_) for c in self.conditions)
+
+    def validate(self, key, value, errors, context):
+        valid = False
+        clean = None
+        dummy_err = DISCARD
+        for condition in self.conditions:
+            valid, clean = condition.validate(key, value, dummy_err,
+                                              context)
+            if valid:
+                break
+        if not valid:
+            self.fail(key, value, errors)
+        return valid, clean
+
+    async def avalidate(self, key, value, errors, context):
+        valid = False
+        clean = None
+        dummy_err = DISCARD
+        for condition in self.conditions:
+            valid, clean = await condition.avalidate(key, value, dummy_err,
+                                                     context)
+            if valid:
+                break
+        if not valid:
+            self.fail(key, value, errors)
+        return valid, clean
+
+    def fail(self, key, value, errors):
+        errors.add(key, ErrorRecord('or', value, (self.raw_conditions,)))
+
+class MsgNode(Node):
+    def __init__(self, validator, errmsg):
+        self.validator = compile_value(validator)
+        self.errmsg = errmsg
+        self.is_async = self.validator.is_async
+        self.preserves = self.validator.preserves
+
+    def children(self):
+        return (self.validator,)
+
+    def may_accept(self, type_):
+        return self.validator.may_accept(type_)
+
+    def validate(self, key, value, errors, context):
+        valid, clean = self.validator.validate(key, value, DISCARD,
+                                               context)
+        if not valid:
+            errors.add(key, self.errmsg)
+        return valid, clean
+
+    async def avalidate(self, key, value, errors, context):
+        valid, clean = await self.validator.avalidate(key, value, DISCARD,
+                                                      context)
+        if not valid:
+            errors.add(key, self.errmsg)
+        return valid, clean
+
+class TypeNode(Node):
+    preserves = True
+
+    def __init__(self, type_):
+        self.type = type_
+
+    def may_accept(self, type_):
+        return type_ is self.type
+
+    def validate(self, key, value, errors, context):
+        if type(value) is self.type:
+            return True, value
+        errors.add(key,
+                   ErrorRecord('type', value, (self.type.__name__,)))
+        return False, None
+
+class CallableNode(Node):
+    preserves = True
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def validate(self, key, value, errors, context):
+        try:
+            result = self.fn(value)
+        except Exception as e:
+            #Bug hunting might have just gotten harder with a catchall Exception.
+            errors.add(key, ErrorRecord('error', value, (), str(e)))
+            return False, None
+        return self.verdict(key, value, errors, result)
+
+    def verdict(self, key, value, errors, result):
+        if result:
+            return True, value
+        errors.add(key,
+                   ErrorRecord('match', value, (self.fn.__name__,)))
+        return False, None
+
+class AsyncCallableNode(CallableNode):
+    is_async = True
+
+    def validate(self, key, value, errors, context):
+        raise TypeError('{} is a coroutine function, use Form.acheck'.format(
+            self.fn.__name__))
+
+    async def avalidate(self, key, value, errors, context):
+        try:
+            result = await self.fn(value)
+        except Exception as e:
+            errors.add(key, ErrorRecord('error', value, (), str(e)))
+            return False, None
+        return self.verdict(key, value, errors, result)
+
+class LiteralNode(Node):
+    preserves = True
+
+    def __init__(self, literal):
+        self.literal = literal
+
+    def may_accept(self, type_):
+        return comparable(self.literal, type_)
+
+    def validate(self, key, value, errors, context):
+        if value == self.literal:
+            return True, value
+        errors.add(key, ErrorRecord('literal', value, (self.literal,)))
+        return False, None
+
+#Types whose hash agrees with == against each other, so set membership
+#finds exactly the literals == would.
+HASH_SAFE_TYPES = frozenset([str, bytes, int, float, bool, type(None)])
+
+class LiteralSetNode(Node):
+    #Consecutive literal alternatives of an Or, checked in one lookup.
+    preserves = True
+
+    def __init__(self, literals):
+        self.literals = literals
+        self.lookup = frozenset(literals)
+
+    def may_accept(self, type_):
+        return any(comparable(literal, type_) for literal in self.literals)
+
+    def validate(self, key, value, errors, context):
+        if type(value) in HASH_SAFE_TYPES:
+            found = value in self.lookup
+        else:
+            found = any(value == literal for literal in self.literals)
+        if found:
+            return True, value
+        errors.add(key, ErrorRecord('or', value, (tuple(self.literals),)))
+        return False, None
+
+NUMBER_TYPES = frozenset([int, float, bool])
+
+def comparable(literal, type_):
+    #Whether a value of exactly type_ could equal the literal.
+    if type(literal) not in HASH_SAFE_TYPES:
+        return True
+    if type(literal) in NUMBER_TYPES:
+        return type_ in NUMBER_TYPES
+    return type_ is type(literal)
+
+def set_literal(node):
+    return type(node) is LiteralNode and \
+        type(node.literal) in HASH_SAFE_TYPES and \
+        node.literal == node.literal
+
+def group_literals(nodes):
+    grouped = []
+    run = []
+    for node in nodes + [None]:
+        if node is not None and set_literal(node):
+            run.append(node)
+            continue
+        if len(run) > 1:
+            grouped.append(LiteralSetNode([n.literal for n in run]))
+        else:
+            grouped.extend(run)
+        run = []
+        if node is not None:
+            grouped.append(node)
+    return grouped
+
+class BatchedNode(Node):
+    #Validation runs in two passes when a schema has Batched validators.
+    #The first collects the values reaching each one, which are then
+    #decided with a single call to fn; the second reports the verdicts.
+    preserves = True
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.is_async = inspect.iscoroutinefunction(fn)
+
+    def validate(self, key, value, errors, context):
+        if context.verdicts is None:
+            context.pending.setdefault(self, []).append(value)
+            return True, value
+        verdict = lookup_verdict(context.verdicts[self], value)
+        if verdict is UNDECIDED:
+            verdict = self.decide([value])[0]
+        return self.verdict(key, value, errors, verdict)
+
+    async def avalidate(self, key, value, errors, context):
+        if context.verdicts is None:
+            context.pending.setdefault(self, []).append(value)
+            return True, value
+        verdict = lookup_verdict(context.verdicts[self], value)
+        if verdict is UNDECIDED:
+            verdict = (await self.adecide([value]))[0]
+        return self.verdict(key, value, errors, verdict)
+
+    def verdict(self, key, value, errors, verdict):
+        if accepted(verdict):
+            return True, value
+        if isinstance(verdict, str):
+            errors.add(key, verdict)
+        else:
+            errors.add(key,
+                       ErrorRecord('match', value, (self.fn.__name__,)))
+        return False, None
+
+    def decide(self, values):
+        if self.is_async:
+            raise TypeError(
+                '{} is a coroutine function, use Form.acheck'.format(
+                    self.fn.__name__))
+        try:
+            verdicts = list(self.fn(values))
+        except Exception as e:
+            return [str(e)] * len(values)
+        return self.check_count(values, verdicts)
+
+    async def adecide(self, values):
+        try:
+            if self.is_async:
+                verdicts = list(await self.fn(values))
+            else:
+                verdicts = list(self.fn(values))
+        except Exception as e:
+            return [str(e)] * len(values)
+        return self.check_count(values, verdicts)
+
+    def check_count(self, values, verdicts):
+        if len(verdicts) != len(values):
+            raise ValueError('{} returned {} verdicts for {} values'.format(
+                self.fn.__name__, len(verdicts), len(values)))
+        return verdicts
+
+    def split(self, values):
+        #Equal hashable values of the same type are decided once; anything
+        #unhashable is remembered by identity for the second pass.
+        unique = {}
+        unhashable = []
+        for value in values:
+            cache_key = value_key(value)
+            if cache_key is None:
+                unhashable.append(value)
+            elif cache_key not in unique:
+                unique[cache_key] = value
+        return unique, unhashable
+
+    def table(self, unique, unhashable, verdicts):
+        return (
+            dict(zip(unique, verdicts)),
+            {id(v): verdict
+             for v, verdict in zip(unhashable, verdicts[len(unique):])}
+        )
+
+    def decide_all(self, values):
+        unique, unhashable = self.split(values)
+        return self.table(unique, unhashable,
+                          self.decide(list(unique.values()) + unhashable))
+
+    async def adecide_all(self, values):
+        unique, unhashable = self.split(values)
+        return self.table(
+            unique, unhashable,
+            await self.adecide(list(unique.values()) + unhashable))
+
+class CachedNode(Node):
+    def __init__(self, validator, cache):
+        self.validator = compile_value(validator)
+        self.cache = cache
+        self.is_async = self.validator.is_async
+        #Batched verdicts differ between the two validation passes, so
+        #anything containing them is never memoized.
+        self.pure = not any(
+            isinstance(node, BatchedNode)
+            for node in iter_nodes(self.validator)
+        )
+
+    def children(self):
+        return (self.validator,)
+
+    def may_accept(self, type_):
+        return self.validator.may_accept(type_)
+
+    def validate(self, key, value, errors, context):
+        cache_key = self.cache_key(value)
+        if cache_key is None:
+            return self.validator.validate(key, value, errors, context)
+        entry = self.cache.get(cache_key)
+        if entry is None:
+            scratch = FormErr()
+            valid, clean = self.validator.validate(key, value, scratch,
+                                                   context)
+            entry = self.store(cache_key, valid, clean, scratch.get(key))
+        return self.replay(key, errors, entry)
+
+    async def avalidate(self, key, value, errors, context):
+        cache_key = self.cache_key(value)
+        if cache_key is None:
+            return await self.validator.avalidate(key, value, errors,
+                                                  context)
+        entry = self.cache.get(cache_key)
+        if entry is None:
+            scratch = FormErr()
+            valid, clean = await self.validator.avalidate(key, value, scratch,
+                                                          context)
+            entry = self.store(cache_key, valid, clean, scratch.get(key))
+        return self.replay(key, errors, entry)
+
+    def cache_key(self, value):
+        if not self.pure:
+            return None
+        return value_key(value)
+
+    def store(self, cache_key, valid, clean, messages):
+        entry = (valid, clean, messages)
+        if messages is None or type(messages) is list:
+            self.cache.put(cache_key, entry)
+        return entry
+
+    def replay(self, key, errors, entry):
+        valid, clean, messages = entry
+        if type(messages) is list:
+            for message in messages:
+                errors.add(key, message)
+        elif messages is not None:
+            errors[key] = messages
+        return valid, clean
+
+def value_key(value):
+    #What a cache remembers value by, or None if it can't be hashed. The
+    #type is part of the key so that 1, 1.0 and True are validated
+    #separately.
+    cache_key = (type(value), value)
+    try:
+        hash(cache_key)
+    except TypeError:
+        return None
+    return cache_key
+
+def accepted(verdict):
+    return verdict is True or (bool(verdict) and not isinstance(verdict, str))
+
+#What lookup_verdict gives for a value the first pass never reached,
+#since None is a verdict like any other.
+UNDECIDED = object()
+
+def lookup_verdict(table, value):
+    cache_key = value_key(value)
+    if cache_key is None:
+        return table[1].get(id(value), UNDECIDED)
+    return table[0].get(cache_key, UNDECIDED)
+
+def collect_pending(contexts):
+    collected = {}
+    for context in contexts:
+        for node, values in context.pending.items():
+            collected.setdefault(node, []).extend(values)
+    return collected
+
+def discard_copies(copies):
+    #Closes the copies of a first pass the second didn't take up.
+    for made in copies.values():
+        for spooled, error in made:
+            if spooled is not None:
+                spooled.close()
+
+def settled(context, verdicts):
+    #Whether every Batched value of a first pass was accepted, in which
+    #case the first pass already gave the final outcome.
+    for node, values in context.pending.items():
+        for value in values:
+            if not accepted(lookup_verdict(verdicts[node], value)):
+                return False
+    return True
+
+class UploadNode(Node):
+    #Reads a file field in chunks into a spooled temporary file and gives
+    #up as soon as it breaks a limit, so an upload is never held in memory
+    #whole. The temporary file, rewound, is the cleaned value.
+    def __init__(self, upload):
+        self.upload = upload
+        self.content_types = None
+        if upload.content_types is not None:
+            self.content_types = frozenset(upload.content_types)
+        self.magic = None
+        self.head_size = 0
+        if upload.magic is not None:
+            self.magic = tuple(upload.magic)
+            self.head_size = max(len(magic) for magic in self.magic)
+
+    def may_accept(self, type_):
+        return hasattr(type_, 'read')
+
+    def validate(self, key, value, errors, context):
+        if not hasattr(value, 'read'):
+            errors.add(key, ErrorRecord('not_file', value))
+            return False, None
+        content_type = getattr(value, 'content_type', None)
+        if self.content_types is not None and \
+                content_type not in self.content_types:
+            errors.add(key, ErrorRecord('content_type', value,
+                                        (content_type,)))
+            return False, None
+        spooled, error = self.spool(value, context)
+        if error is not None:
+            errors.add(key, error)
+            return False, None
+        return True, spooled
+
+    def spool(self, value, context):
+        #Forms with Batched validators validate everything twice, but a
+        #file may only be read once, so the second pass takes up what the
+        #first made of it.
+        copies = context.copies
+        if copies is not None and context.verdicts is not None:
+            made = copies.get(id(value))
+            if made:
+                spooled, error = made.pop(0)
+                if spooled is not None:
+                    spooled.seek(0)
+                return spooled, error
+        spooled = tempfile.SpooledTemporaryFile(
+            max_size=self.upload.spool_size)
+        try:
+            error = self.copy(value, spooled)
+        except Exception as e:
+            error = ErrorRecord('error', value, (), str(e))
+        if error is not None:
+            spooled.close()
+            spooled = None
+        else:
+            spooled.seek(0)
+        if copies is not None and context.pending is not None:
+            copies.setdefault(id(value), []).append((spooled, error))
+        return spooled, error
+
+    def copy(self, value, spooled):
+        upload = self.upload
+        digest = None
+        if upload.checksum is not None:
+            digest = hashlib.new(upload.checksum[0])
+        head = b''
+        size = 0
+        while True:
+            chunk = value.read(upload.chunk_size)
+            if not chunk:
+                break
+            size += len(chunk)
+            if upload.max_size is not None and size > upload.max_size:
+                return ErrorRecord('too_large', value, (upload.max_size,))
+            if len(head) < self.head_size:
+                head += chunk[:self.head_size - len(head)]
+                if len(head) == self.head_size and \
+                        not head.startswith(self.magic):
+                    return ErrorRecord('magic', value)
+            if digest is not None:
+                digest.update(chunk)
+            spooled.write(chunk)
+        if self.magic is not None and not head.startswith(self.magic):
+            return ErrorRecord('magic', value)
+        if digest is not None and \
+                digest.hexdigest() != upload.checksum[1].lower():
+            return ErrorRecord('checksum', value, (upload.checksum[0],))
+        return None
+
+def compile_value(reference_value):
+    if isinstance(reference_value, dict):
+        return MapNode(reference_value)
+    elif isinstance(reference_value, list):
+        return SequenceNode(reference_value)
+    elif isinstance(reference_value, Use):
+        if inspect.iscoroutinefunction(reference_value.fn):
+            return AsyncUseNode(reference_value.fn)
+        return UseNode(reference_value.fn)
+    elif isinstance(reference_value, And):
+        return AndNode(reference_value.conditions)
+    elif isinstance(reference_value, Or):
+        return OrNode(reference_value.conditions)
+    elif isinstance(reference_value, Msg):
+        return MsgNode(reference_value.validator, reference_value.errmsg)
+    elif isinstance(reference_value, Batched):
+        return BatchedNode(reference_value.fn)
+    elif isinstance(reference_value, Cached):
+        return CachedNode(reference_value.validator, reference_value.cache)
+    elif isinstance(reference_value, Upload):
+        return UploadNode(reference_value)
+    elif type(reference_value) is type:
+        return TypeNode(reference_value)
+    elif inspect.iscoroutinefunction(reference_value):
+        return AsyncCallableNode(reference_value)
+    elif callable(reference_value):
+        return CallableNode(reference_value)
+    return LiteralNode(reference_value)
+
+class KeyNode(Node):
+    def __init__(self, key, reference_value):
+        self.key = key
+        self.value = compile_value(reference_value)
+        self.missing = ErrorRecord('missing', key)
+        self.is_async = self.value.is_async
+        self.preserves = self.value.preserves
+
+    def children(self):
+        return (self.value,)
+
+    def validate(self, suspicious, errors, context, validated_keys):
+        key = self.key
+        if key not in suspicious:
+            errors.section_errors.append(self.missing)
+            return False, []
+        validated_keys.add(key)
+        validated, clean = self.value.validate(
+            key,
+            suspicious[key],
+            errors,
+            context
+        )
+        if validated:
+            return True, [(key, clean)]
+        return False, []
+
+    async def avalidate(self, suspicious, errors, context,
+                        validated_keys):
+        key = self.key
+        if key not in suspicious:
+            errors.section_errors.append(self.missing)
+            return False, []
+        validated_keys.add(key)
+        validated, clean = await self.value.avalidate(
+            key,
+            suspicious[key],
+            errors,
+            context
+        )
+        if validated:
+            return True, [(key, clean)]
+        return False, []
+
+class OptionalKeyNode(Node):
+    def __init__(self, key, reference_value):
+        self.key = key
+        self.inner = compile_key(key, reference_value)
+        self.is_async = self.inner.is_async
+        self.preserves = self.inner.preserves
+
+    def children(self):
+        return (self.inner,)
+
+    def validate(self, suspicious, errors, context, validated_keys):
+        if self.key in suspicious:
+            return self.inner.validate(
+                suspicious,
+                errors,
+                context,
+                validated_keys
+            )
+        return True, []
+
+    async def avalidate(self, suspicious, errors, context,
+                        validated_keys):
+        if self.key in suspicious:
+            return await self.inner.avalidate(
+                suspicious,
+                errors,
+                context,
+                validated_keys
+            )
+        return True, []
+
+#Or and XOr groups with more alternatives than this find the submitted ones
+#with a set intersection instead of looking each one up.
+INDEX_THRESHOLD = 8
+
+class KeyGroupNode(Node):
+    def __init__(self, reference_value):
+        self.alternatives = [
+            (orkey, compile_key(orkey, orvalue))
+            for orkey, orvalue in reference_value.items()
+        ]
+        self.is_async = any(
+            key_node.is_async for orkey, key_node in self.alternatives)
+        self.position = None
+        if len(self.alternatives) > INDEX_THRESHOLD:
+            self.position = {
+                orkey: i for i, (orkey, key_node)
+                in enumerate(self.alternatives)
+            }
+
+    def children(self):
+        return [key_node for orkey, key_node in self.alternatives]
+
+    def present(self, suspicious):
+        #The alternatives found in suspicious, in schema order.
+        if self.position is None or type(suspicious) is not dict:
+            return [
+                (orkey, key_node) for orkey, key_node in self.alternatives
+                if orkey in suspicious
+            ]
+        found = suspicious.keys() & self.position.keys()
+        return [
+            self.alternatives[i]
+            for i in sorted(self.position[orkey] for orkey in found)
+        ]
+
+class OrKeyNode(KeyGroupNode):
+    def __init__(self, reference_value):
+        KeyGroupNode.__init__(self, reference_value)
+        self.missing = ErrorRecord('missing_any', reference_value.keys())
+        self.preserves = all(
+            key_node.preserves for orkey, key_node in self.alternatives)
+
+    def validate(self, suspicious, errors, context, validated_keys):
+        present = self.present(suspicious)
+        if not present:
+            errors.section_errors.append(self.missing)
+            return False, []
+        validated = True
+        cleaned = []
+        for orkey, key_node in present:
+            valid, clean = key_node.validate(
+                suspicious,
+                errors,
+                context,
+                validated_keys
+            )
+            if valid:
+                cleaned.extend(clean)
+            elif context.fail_fast:
+                return False, cleaned
+            validated = validated and valid
+        return validated, cleaned
+
+    async def avalidate(self, suspicious, errors, context,
+                        validated_keys):
+        present = self.present(suspicious)
+        if not present:
+            errors.section_errors.append(self.missing)
+            return False, []
+        validated = True
+        cleaned = []
+        for orkey, key_node in present:
+            valid, clean = await key_node.avalidate(
+                suspicious,
+                errors,
+                context,
+                validated_keys
+            )
+            if valid:
+                cleaned.extend(clean)
+            validated = validated and valid
+        return validated, cleaned
+
+class XOrKeyNode(KeyGroupNode):
+    def __init__(self, reference_value):
+        KeyGroupNode.__init__(self, reference_value)
+        self.missing = ErrorRecord('missing_one', reference_value.keys())
+        self.too_many = ErrorRecord('too_many', reference_value.keys())
+
+    def validate(self, suspicious, errors, context, validated_keys):
+        validated = 0
+        cleaned = []
+        for orkey, key_node in self.present(suspicious):
+            valid, clean = key_node.validate(
+                suspicious,
+                errors,
+                context,
+                validated_keys
+            )
+            if valid:
+                cleaned.extend(clean)
+                validated += 1
+                if validated > 1 and context.fail_fast:
+                    break
+        return self.count(validated, errors), cleaned
+
+    async def avalidate(self, suspicious, errors, context,
+                        validated_keys):
+        validated = 0
+        cleaned = []
+        for orkey, key_node in self.present(suspicious):
+            valid, clean = await key_node.avalidate(
+                suspicious,
+                errors,
+                context,
+                validated_keys
+            )
+            if valid:
+                cleaned.extend(clean)
+                validated += 1
+        return self.count(validated, errors), cleaned
+
+    def count(self, validated, errors):
+        if validated == 0:
+            errors.section_errors.append(self.missing)
+            return False
+        elif validated > 1:
+            errors.section_errors.append(self.too_many)
+            return False
+        return True
+
+#How many raw keys each And key remembers the verdict of its key
+#validator for.
+KEY_CACHE_SIZE = 1024
+
+class AndKeyNode(Node):
+    def __init__(self, key, reference_value):
+        self.key = compile_value(key)
+        self.value = compile_value(reference_value)
+        self.is_async = self.key.is_async or self.value.is_async
+        self.preserves = self.key.preserves and self.value.preserves
+        #Submitted maps tend to repeat the same keys, so the key validator
+        #runs once per distinct key across validations. Batched verdicts
+        #depend on the pass, so they are never remembered.
+        self.cache = None
+        if not any(isinstance(node, BatchedNode)
+                   for node in iter_nodes(self.key)):
+            self.cache = LRUCache(KEY_CACHE_SIZE)
+
+    def children(self):
+        return (self.key, self.value)
+
+    def cached(self, raw_key):
+        if self.cache is None:
+            return None, None
+        cache_key = value_key(raw_key)
+        if cache_key is None:
+            return None, None
+        return cache_key, self.cache.get(cache_key)
+
+    def remember(self, cache_key, valid_key, clean_key, err):
+        entry = (valid_key, clean_key, err.get(0) or [])
+        if cache_key is not None:
+            self.cache.put(cache_key, entry)
+        return entry
+
+    def validate(self, suspicious, errors, context, validated_keys):
+        validated = True
+        cleaned = []
+        for raw_key in suspicious:
+            cache_key, entry = self.cached(raw_key)
+            if entry is None:
+                err = FormErr()
+                valid_key, clean_key = self.key.validate(
+                    0,
+                    raw_key,
+                    err,
+                    context
+                )
+                entry = self.remember(cache_key, valid_key, clean_key, err)
+            valid_key, clean_key, messages = entry
+            validated = validated and valid_key
+            if not valid_key:
+                errors.section_errors.extend(messages)
+            valid_value, clean = self.value.validate(
+                raw_key,
+                suspicious[raw_key],
+                errors,
+                context
+            )
+            validated = validated and valid_value
+            validated_keys.add(raw_key)
+            if valid_key and valid_value:
+                cleaned.append((clean_key, clean))
+            elif context.fail_fast:
+                break
+        return validated, cleaned
+
+    async def avalidate(self, suspicious, errors, context,
+                        validated_keys):
+        validated = True
+        cleaned = []
+        for raw_key in suspicious:
+            cache_key, entry = self.cached(raw_key)
+            if entry is None:
+                err = FormErr()
+                valid_key, clean_key = await self.key.avalidate(
+                    0,
+                    raw_key,
+                    err,
+                    context
+                )
+                entry = self.remember(cache_key, valid_key, clean_key, err)
+            valid_key, clean_key, messages = entry
+            validated = validated and valid_key
+            if not valid_key:
+                errors.section_errors.extend(messages)
+            valid_value, clean = await self.value.avalidate(
+                raw_key,
+                suspicious[raw_key],
+                errors,
+                context
+            )
+            validated = validated and valid_value
+            validated_keys.add(raw_key)
+            if valid_key and valid_value:
+                cleaned.append((clean_key, clean))
+            elif context.fail_fast:
+                break
+        return validated, cleaned
+
+class IfKeyNode(Node):
+    def __init__(self, paths, key, reference_value):
+        self.paths = paths
+        self.condition = hashable_condition(paths)
+        self.inner = compile_key(key, reference_value)
+        self.is_async = self.inner.is_async
+        self.preserves = self.inner.preserves
+
+    def children(self):
+        return (self.inner,)
+
+    def applies(self, context):
+        if self.condition is not None:
+            return context.holds(self.condition)
+        for path in self.paths:
+            if not path_exists(path, context.entire_structure):
+                return False
+        return True
+        #TODO: what happens if the key exists, but paths weren't found?
+
+    def validate(self, suspicious, errors, context, validated_keys):
+        if not self.applies(context):
+            return True, []
+        return self.inner.validate(
+            suspicious,
+            errors,
+            context,
+            validated_keys
+        )
+
+    async def avalidate(self, suspicious, errors, context,
+                        validated_keys):
+        if not self.applies(context):
+            return True, []
+        return await self.inner.avalidate(
+            suspicious,
+            errors,
+            context,
+            validated_keys
+        )
+
+class MsgKeyNode(Node):
+    def __init__(self, validator, errmsg, reference_value):
+        self.inner = compile_key(validator, reference_value)
+        self.errmsg = errmsg
+        self.is_async = self.inner.is_async
+        self.preserves = self.inner.preserves
+
+    def children(self):
+        return (self.inner,)
+
+    def validate(self, suspicious, errors, context, validated_keys):
+        validated, clean = self.inner.validate(
+            suspicious,
+            DISCARD,
+            context,
+            validated_keys
+        )
+        return self.verdict(validated, clean, errors)
+
+    async def avalidate(self, suspicious, errors, context,
+                        validated_keys):
+        validated, clean = await self.inner.avalidate(
+            suspicious,
+            DISCARD,
+            context,
+            validated_keys
+        )
+        return self.verdict(validated, clean, errors)
+
+    def verdict(self, validated, clean, errors):
+        if not validated:
+            errors.section_errors.append(self.errmsg)
+            return False, []
+        return True, clean
+
+def hashable_condition(paths):
+    #The paths of an If as a tuple of tuples, or None if they can't be
+    #hashed and so can't be shared.
+    try:
+        condition = tuple(tuple(path) for path in paths)
+        hash(condition)
+    except TypeError:
+        return None
+    return condition
+
+def compile_key(key, reference_value):
+    if isinstance(key, Optional):
+        return OptionalKeyNode(key.key, reference_value)
+    elif key == Or:
+        return OrKeyNode(reference_value)
+    elif key == XOr:
+        return XOrKeyNode(reference_value)
+    elif isinstance(key, And):
+        return AndKeyNode(key, reference_value)
+    elif isinstance(key, If):
+        return IfKeyNode(key.paths, key.key, reference_value)
+    elif isinstance(key, Msg):
+        return MsgKeyNode(key.validator, key.errmsg, reference_value)
+    return KeyNode(key, reference_value)
+
+def sequence_at(node, path):
+    #The list schema found by following plain keys down from node.
+    for key in path:
+        found = None
+        if isinstance(node, MapNode):
+            for key_node in node.keys:
+                if isinstance(key_node, OptionalKeyNode):
+                    key_node = key_node.inner
+                if isinstance(key_node, KeyNode) and key_node.key == key:
+                    found = key_node.value
+                    break
+        if found is None:
+            raise ValueError('Schema has no key {!r} in {}'.format(key, path))
+        node = found
+    if not isinstance(node, SequenceNode):
+        raise ValueError('Schema at {} is not a list'.format(path))
+    #If paths point into the whole structure, which a stream never holds.
+    if any(isinstance(n, IfKeyNode) for n in iter_nodes(node)):
+        raise ValueError("Schema at {} has If keys, which can't be "
+                         "streamed".format(path))
+    return node
+
+def stream_sequence(node, items, chunksize, limits=None, depth=2):
+    #Elements are validated one by one as validate_sequence would. With
+    #limits, each element at depth in the submitted data is checked against
+    #them before any validator runs.
+    items = iter(items)
+    if not any(isinstance(n, BatchedNode) for n in iter_nodes(node)):
+        context = Context({})
+        for i, value in enumerate(items):
+            errors = FormErr()
+            if limits is not None and \
+                    not limits.allow(value, errors, (i,), depth):
+                yield i, False, None, errors.render()
+                continue
+            valid, clean = node.validate_element(i, value, errors, context)
+            yield i, valid, clean, result_errors(errors).render()
+        return
+    start = 0
+    for chunk in iter(lambda: list(islice(items, chunksize)), []):
+        indexed = list(enumerate(chunk, start))
+        errors = [FormErr() for value in chunk]
+        allowed = [
+            limits is None or limits.allow(value, err, (i,), depth)
+            for (i, value), err in zip(indexed, errors)
+        ]
+        contexts = [Context({}, pending={}) for value in chunk]
+        outcomes = [
+            node.validate_element(i, value, err, context) if ok
+            else (False, None)
+            for (i, value), err, context, ok in zip(
+                indexed, errors, contexts, allowed)
+        ]
+        verdicts = {
+            n: n.decide_all(values)
+            for n, values in collect_pending(contexts).items()
+        }
+        for (i, value), err, context, (valid, clean) in zip(
+                indexed, errors, contexts, outcomes):
+            if not settled(context, verdicts):
+                err = FormErr()
+                valid, clean = node.validate_element(
+                    i, value, err,
+                    Context({}, verdicts=verdicts, copies=context.copies))
+                discard_copies(context.copies)
+            yield i, valid, clean, result_errors(err).render()
+        start += len(chunk)
+
+def validate_records(form, records, chunksize):
+    if form.batched:
+        records = iter(records)
+        for chunk in iter(lambda: list(islice(records, chunksize)), []):
+            pairs = [(suspicious, FormErr()) for suspicious in chunk]
+            outcomes = form.run_batch(pairs)
+            for (suspicious, errors), (valid, clean) in zip(pairs, outcomes):
+                yield Result(valid, clean, result_errors(errors))
+        return
+    run = form.run
+    errors = FormErr()
+    for suspicious in records:
+        valid, clean = run(suspicious, errors)
+        if errors or errors.sections:
+            yield Result(valid, clean, errors)
+            errors = FormErr()
+        else:
+            yield Result(valid, clean, NO_ERRORS)
+
+def worker_payload(form):
+    try:
+        return pickle.dumps(form)
+    except (pickle.PicklingError, AttributeError, TypeError) as e:
+        raise TypeError(
+            "Schema can't be sent to worker processes ({}). Use "
+            "module-level functions instead of lambdas or nested "
+            "functions in the schema.".format(e)
+        ) from e
+
+worker_form = None
+
+def init_worker(payload):
+    global worker_form
+    worker_form = pickle.loads(payload)
+
+def validate_chunk(chunk):
+    return list(validate_records(worker_form, chunk, len(chunk)))
+
+def validate_in_processes(payload, records, workers, chunksize):
+    records = iter(records)
+    chunks = iter(lambda: list(islice(records, chunksize)), [])
+    with ProcessPoolExecutor(workers, initializer=init_worker,
+                             initargs=(payload,)) as executor:
+        #Keep a couple of chunks per worker in flight and hand results
+        #back in submission order.
+        pending = deque()
+        try:
+            for chunk in chunks:
+                pending.append(executor.submit(validate_chunk, chunk))
+                if len(pending) >= 2 * workers:
+                    for result in pending.popleft().result():
+                        yield result
+            while pending:
+                for result in pending.popleft().result():
+                    yield result
+        finally:
+            for future in pending:
+                future.cancel()
+
+#TODO: Optional, If as key.
+#TODO: Optional should check existence, not validation.
 class Form:
-    def __init__(self, schema):
+    def __init__(self, schema, engine='tree', executor=None, max_depth=None,
+                 max_length=None, max_keys=None, max_string=None,
+                 max_nodes=None):
         self.schema = schema
+        self.engine = engine
+        self.executor = executor
+        self.limits = Limits(max_depth, max_length, max_keys, max_string,
+                             max_nodes)
+        if not any(bound is not None for bound in self.limits.args()):
+            self.limits = None
+        self.node = compile_value(schema)
+        self.batched = [
+            node for node in iter_nodes(self.node)
+            if isinstance(node, BatchedNode)
+        ]
+        self.source = None
+        self.found_errors = None
+        if engine == 'codegen':
+            from ceramic_forms.codegen import generate
+            self.source, self.walk = generate(self.node)
+        elif engine != 'tree':
+            raise ValueError('Unknown engine {}'.format(engine))
+        if executor is not None and engine != 'tree':
+            raise ValueError('An executor needs the tree engine')
+
+    def context(self, suspicious, pending=None, verdicts=None,
+                fail_fast=False, copies=None):
+        #Batched validators collect values while walking, which is left to
+        #a single thread.
+        executor = None if self.batched else self.executor
+        if isinstance(self.node, (MapNode, SequenceNode)):
+            return Context(suspicious, pending, verdicts, fail_fast,
+                           executor, copies)
+        return Context(None, pending, verdicts, fail_fast, executor, copies)
 
-    def validate(self, suspicious):
-        self.errors = FormErr()
-        if isinstance(self.schema, dict):
-            valid, clean = validate_map(
-                self.schema,
-                suspicious, 
-                self.errors,
-                suspicious
+    def walk(self, suspicious, errors, context):
+        if isinstance(self.node, MapNode):
+            return self.node.validate_map(
+                suspicious,
+                errors,
+                context
             )
-        elif isinstance(self.schema, list):
-            valid, clean = validate_sequence(
-                self.schema,
+        elif isinstance(self.node, SequenceNode):
+            return self.node.validate_sequence(
                 suspicious,
-                self.errors,
-                suspicious
+                errors,
+                context
             )
-        else:
-            err = FormErr()
-            valid, clean = validate_value(
-                0,
+        err = FormErr()
+        valid, clean = self.node.validate(
+            0,
+            suspicious,
+            err,
+            context
+        )
+        errors.section_errors.extend(err[0])
+        return valid, clean
+
+    async def awalk(self, suspicious, errors, context):
+        if isinstance(self.node, MapNode):
+            return await self.node.avalidate_map(
                 suspicious,
-                self.schema,
-                err,
-                None
+                errors,
+                context
             )
-            self.errors.section_errors.extend(err[0])
+        elif isinstance(self.node, SequenceNode):
+            return await self.node.avalidate_sequence(
+                suspicious,
+                errors,
+                context
+            )
+        err = FormErr()
+        valid, clean = await self.node.avalidate(
+            0,
+            suspicious,
+            err,
+            context
+        )
+        errors.section_errors.extend(err[0])
+        return valid, clean
+
+    def run(self, suspicious, errors, fail_fast=False):
+        if self.limits is not None and \
+                not self.limits.allow(suspicious, errors):
+            return False, None
+        if self.batched:
+            return self.run_batch([(suspicious, errors)], fail_fast)[0]
+        return self.walk(
+            suspicious,
+            errors,
+            self.context(suspicious, fail_fast=fail_fast)
+        )
+
+    def run_batch(self, pairs, fail_fast=False):
+        contexts = [self.context(suspicious, pending={}, fail_fast=fail_fast)
+                    for suspicious, errors in pairs]
+        outcomes = [
+            self.walk(suspicious, errors, context)
+            for (suspicious, errors), context in zip(pairs, contexts)
+        ]
+        #Records that already failed stay failed, so when failing fast
+        #their values are never looked up.
+        undecided = [
+            i for i, (valid, clean) in enumerate(outcomes)
+            if valid or not fail_fast
+        ]
+        verdicts = {
+            node: node.decide_all(values)
+            for node, values in collect_pending(
+                [contexts[i] for i in undecided]).items()
+        }
+        for i in undecided:
+            suspicious, errors = pairs[i]
+            if not settled(contexts[i], verdicts):
+                errors.clear()
+                outcomes[i] = self.walk(
+                    suspicious,
+                    errors,
+                    self.context(suspicious, verdicts=verdicts,
+                                 fail_fast=fail_fast,
+                                 copies=contexts[i].copies)
+                )
+                discard_copies(contexts[i].copies)
+        return outcomes
+
+    async def arun(self, suspicious, errors):
+        if self.limits is not None and \
+                not self.limits.allow(suspicious, errors):
+            return False, None
+        if not self.batched:
+            return await self.awalk(suspicious, errors,
+                                    self.context(suspicious))
+        context = self.context(suspicious, pending={})
+        outcome = await self.awalk(suspicious, errors, context)
+        verdicts = {}
+        for node, values in collect_pending([context]).items():
+            verdicts[node] = await node.adecide_all(values)
+        if settled(context, verdicts):
+            return outcome
+        errors.clear()
+        outcome = await self.awalk(
+            suspicious,
+            errors,
+            self.context(suspicious, verdicts=verdicts,
+                         copies=context.copies)
+        )
+        discard_copies(context.copies)
+        return outcome
+
+    async def acheck(self, suspicious):
+        errors = FormErr()
+        valid, clean = await self.arun(suspicious, errors)
+        return Result(valid, clean, result_errors(errors))
+
+    async def avalidate(self, suspicious):
+        errors = FormErr()
+        valid, clean = await self.arun(suspicious, errors)
+        self.found_errors = errors
+        self.cleaned = clean
+        return valid
+
+    def check(self, suspicious):
+        errors = FormErr()
+        valid, clean = self.run(suspicious, errors)
+        return Result(valid, clean, result_errors(errors))
+
+    def validate_many(self, records, workers=None, chunksize=256):
+        if workers:
+            return validate_in_processes(worker_payload(self), records,
+                                         workers, chunksize)
+        return validate_records(self, records, chunksize)
+
+    def stream(self, items, path=(), chunksize=256):
+        return stream_sequence(sequence_at(self.node, path), items,
+                               chunksize, self.limits, len(path) + 2)
+
+    def revalidate(self, previous, changed_paths, new_data):
+        from ceramic_forms.incremental import revalidate
+        return revalidate(self, previous, changed_paths, new_data)
+
+    def __reduce__(self):
+        if self.limits is None:
+            return (Form, (self.schema, self.engine))
+        return (Form, (self.schema, self.engine, None) + self.limits.args())
+
+    def is_valid(self, suspicious):
+        return self.run(suspicious, DISCARD, fail_fast=True)[0]
+
+    @property
+    def errors(self):
+        #Only there once the form has validated something, as before.
+        if self.found_errors is None:
+            raise AttributeError("'Form' object has no attribute 'errors'")
+        return self.found_errors.render()
+
+    @errors.setter
+    def errors(self, errors):
+        self.found_errors = errors
+
+    def validate(self, suspicious, fail_fast=False):
+        self.found_errors = FormErr()
+        valid, clean = self.run(suspicious, self.found_errors, fail_fast)
         self.cleaned = clean
         return valid
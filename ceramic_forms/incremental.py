@@ -0,0 +1,298 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import copy
+
+from ceramic_forms.form import (
+    FormErr,
+    Result,
+    result_errors,
+    Node,
+    MapNode,
+    SequenceNode,
+    KeyNode,
+    OptionalKeyNode,
+    KeyGroupNode,
+    IfKeyNode,
+    MsgKeyNode,
+    AndKeyNode,
+)
+
+#Stands for every key of a map or index of a list in the path of an If.
+ANY = object()
+
+def mark(tree, path, whole):
+    #Adds path to a tree of changes, where True is a value that changed as
+    #a whole and a dict holds the changes inside one.
+    if tree is True or (not path and whole):
+        return True
+    place = tree
+    for key in path[:-1]:
+        inner = place.get(key)
+        if inner is True:
+            return tree
+        if inner is None:
+            inner = place[key] = {}
+        place = inner
+    if path:
+        if whole:
+            place[path[-1]] = True
+        elif place.get(path[-1]) is None:
+            place[path[-1]] = {}
+    return tree
+
+def condition_sites(node, site=(), sites=None):
+    #The (site, paths) of every If under node, where site is the path of the
+    #map holding it with ANY for list elements and keys matched by an And key.
+    if sites is None:
+        sites = []
+    if isinstance(node, MapNode):
+        for key_node in node.keys:
+            key_sites(key_node, site, sites)
+    elif isinstance(node, SequenceNode):
+        for validator in node.validators:
+            condition_sites(validator, site + (ANY,), sites)
+    else:
+        for child in node.children():
+            condition_sites(child, site, sites)
+    return sites
+
+def key_sites(key_node, site, sites):
+    if isinstance(key_node, KeyNode):
+        condition_sites(key_node.value, site + (key_node.key,), sites)
+    elif isinstance(key_node, AndKeyNode):
+        condition_sites(key_node.value, site + (ANY,), sites)
+    elif isinstance(key_node, KeyGroupNode):
+        for orkey, alternative in key_node.alternatives:
+            key_sites(alternative, site, sites)
+    else:
+        if isinstance(key_node, IfKeyNode):
+            sites.append((site, key_node.paths))
+        key_sites(key_node.inner, site, sites)
+
+def expand(site, structure):
+    #The paths in structure a site stands for.
+    places = [((), structure)]
+    for step in site:
+        found = []
+        for path, value in places:
+            if step is not ANY:
+                try:
+                    found.append((path + (step,), value[step]))
+                except (KeyError, IndexError, TypeError):
+                    pass
+            elif type(value) is dict:
+                found.extend((path + (key,), value[key]) for key in value)
+            elif type(value) is list:
+                found.extend((path + (i,), item)
+                             for i, item in enumerate(value))
+        places = found
+    return [path for path, value in places]
+
+def overlaps(path, changed):
+    #Whether changing changed can change whether path exists.
+    size = min(len(path), len(changed))
+    return tuple(path[:size]) == tuple(changed[:size])
+
+def known_errors(previous):
+    #Errors only say something about what was inside a value when they
+    #were collected in a FormErr for it.
+    return previous if isinstance(previous, FormErr) else None
+
+def known_map(cleaned):
+    return cleaned if type(cleaned) is dict else None
+
+class Revision:
+    #What the previous validation found in one map: its cleaned values (for
+    #the keys whose values were valid) and its errors.
+
+    def __init__(self, changes, cleaned, previous):
+        self.changes = changes
+        self.cleaned = known_map(cleaned)
+        self.previous = known_errors(previous)
+        self.named = set()
+        self.repeated = set()
+
+    def stand_in(self, key_node):
+        #A copy of key_node whose values are taken from the previous
+        #validation where they haven't changed. None when the key node can
+        #take any key, so nothing tells which outcome was whose.
+        if isinstance(key_node, AndKeyNode):
+            return None
+        key_node = copy.copy(key_node)
+        if isinstance(key_node, KeyNode):
+            if key_node.key in self.named:
+                self.repeated.add(key_node.key)
+            self.named.add(key_node.key)
+            key_node.value = Reused(key_node.value, self)
+        elif isinstance(key_node, KeyGroupNode):
+            alternatives = []
+            for orkey, alternative in key_node.alternatives:
+                alternative = self.stand_in(alternative)
+                if alternative is None:
+                    return None
+                alternatives.append((orkey, alternative))
+            key_node.alternatives = alternatives
+        elif isinstance(key_node, (OptionalKeyNode, IfKeyNode, MsgKeyNode)):
+            key_node.inner = self.stand_in(key_node.inner)
+            if key_node.inner is None:
+                return None
+        else:
+            return None
+        return key_node
+
+    def validate(self, node, key, value, errors, context):
+        change = self.changes.get(key)
+        if change is True or key in self.repeated:
+            return node.validate(key, value, errors, context)
+        previous = None
+        if self.previous is not None:
+            previous = dict.get(self.previous, key)
+        if change is not None:
+            cleaned = None
+            if self.cleaned is not None:
+                cleaned = self.cleaned.get(key)
+            return revise_value(node, key, value, change, cleaned, previous,
+                                errors, context)
+        if previous is not None:
+            errors[key] = previous
+            return False, None
+        if self.cleaned is not None and key in self.cleaned:
+            return True, self.cleaned[key]
+        #Not validated last time, e.g. an If that didn't apply, or the
+        #errors went to a Msg.
+        return node.validate(key, value, errors, context)
+
+class Reused(Node):
+    #Stands in for the value node of a key in a map being revised.
+
+    def __init__(self, node, revision):
+        self.node = node
+        self.revision = revision
+
+    def children(self):
+        return (self.node,)
+
+    def validate(self, key, value, errors, context):
+        return self.revision.validate(self.node, key, value, errors,
+                                      context)
+
+def revise_value(node, key, value, changes, cleaned, previous, errors,
+                 context):
+    if not isinstance(node, (MapNode, SequenceNode)):
+        return node.validate(key, value, errors, context)
+    next_level_errors = errors.child()
+    valid, clean = revise(node, value, changes, cleaned, previous,
+                          next_level_errors, context)
+    if not valid:
+        errors[key] = next_level_errors
+    return valid, clean
+
+def revise(node, value, changes, cleaned, previous, errors, context):
+    if isinstance(node, MapNode):
+        return revise_map(node, value, changes, cleaned, previous, errors,
+                          context)
+    return revise_sequence(node, value, changes, cleaned, previous, errors,
+                           context)
+
+def revise_map(node, value, changes, cleaned, previous, errors, context):
+    if type(value) is not dict:
+        return node.validate_map(value, errors, context)
+    revision = Revision(changes, cleaned, previous)
+    keys = []
+    for key_node in node.keys:
+        key_node = revision.stand_in(key_node)
+        if key_node is None:
+            return node.validate_map(value, errors, context)
+        keys.append(key_node)
+    #The map's own rules (missing, unexpected, Or and XOr groups, If
+    #conditions) are checked again with only the values taken as known.
+    revised = copy.copy(node)
+    revised.keys = keys
+    return revised.validate_map(value, errors, context)
+
+def revise_sequence(node, value, changes, cleaned, previous, errors,
+                    context):
+    if type(value) is not list:
+        return node.validate_sequence(value, errors, context)
+    if type(cleaned) is not list or len(cleaned) != len(value):
+        cleaned = None
+    previous = known_errors(previous)
+    single = node.validators[0] if len(node.validators) == 1 else None
+    share = True
+    all_valid = True
+    out = []
+    for i, item in enumerate(value):
+        change = changes.get(i)
+        before = dict.get(previous, i) if previous is not None else None
+        if change is None and before is not None:
+            #What is left of an invalid element only matters as part of a
+            #list whose cleaned value was kept.
+            errors[i] = before
+            valid = False
+            clean = cleaned[i] if cleaned is not None else None
+        elif change is None and cleaned is not None:
+            valid, clean = True, cleaned[i]
+        elif change is not None and change is not True and single:
+            valid, clean = revise_value(
+                single, i, item, change,
+                cleaned[i] if cleaned is not None else None, before,
+                errors, context)
+        else:
+            valid, clean = node.validate_element(i, item, errors, context)
+        share = share and clean is item
+        out.append(clean)
+        all_valid = all_valid and valid
+    return all_valid, value if share else out
+
+def allow_change(limits, structure, path, errors):
+    #Only what a change could have made too big is looked at: the
+    #containers along its path and the value at its end.
+    place = structure
+    for depth, key in enumerate(path, 1):
+        found = limits.exceeded(place, depth)
+        if found is not None:
+            return limits.reject(errors, path[:depth - 1], place, found)
+        if isinstance(place, dict) and \
+                limits.key_exceeded(key) is not None:
+            return limits.reject_key(errors, path[:depth - 1], key)
+        try:
+            place = place[key]
+        except (KeyError, IndexError, TypeError):
+            return True
+    return limits.allow(place, errors, path, len(path) + 1)
+
+def revalidate(form, previous, changed_paths, new_data):
+    #form.check(new_data) for data that only changed at changed_paths since
+    #previous. Everything off these paths is taken from previous, while the
+    #maps and lists along them, and those holding an If on them, check their
+    #own rules again.
+    if form.batched or form.node.is_async or \
+            not isinstance(form.node, (MapNode, SequenceNode)):
+        return form.check(new_data)
+    changed_paths = [tuple(path) for path in changed_paths]
+    changes = {}
+    for path in changed_paths:
+        changes = mark(changes, path, True)
+    if changes is True:
+        return form.check(new_data)
+    for site, paths in condition_sites(form.node):
+        if any(overlaps(path, changed) for path in paths
+               for changed in changed_paths):
+            for path in expand(site, new_data):
+                changes = mark(changes, path, False)
+    errors = FormErr()
+    limits = form.limits
+    if limits is not None:
+        if limits.max_nodes is not None:
+            allowed = limits.allow(new_data, errors)
+        else:
+            allowed = all(allow_change(limits, new_data, path, errors)
+                          for path in changed_paths)
+        if not allowed:
+            return Result(False, None, errors)
+    valid, clean = revise(form.node, new_data, changes, previous.cleaned,
+                          previous.errors, errors,
+                          form.context(new_data))
+    return Result(valid, clean, result_errors(errors))
@@ -0,0 +1,417 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import codecs
+import json
+import re
+
+from ceramic_forms.form import (
+    Context,
+    ErrorRecord,
+    FormErr,
+    Result,
+    result_errors,
+    MapNode,
+    SequenceNode,
+    KeyNode,
+    OptionalKeyNode,
+    OrKeyNode,
+    XOrKeyNode,
+    IfKeyNode,
+    MsgKeyNode,
+)
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+STRING_BODY = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.S)
+NUMBER = re.compile(r'-?(?:0|[1-9][0-9]*)(\.[0-9]+)?([eE][-+]?[0-9]+)?')
+NUMBER_CHARS = frozenset('-+.eE0123456789')
+WORDS = {'t': ('true', 'boolean', True),
+         'f': ('false', 'boolean', False),
+         'n': ('null', 'null', None)}
+
+class JSONError(ValueError):
+    pass
+
+class Tokenizer:
+    #Turns JSON text fed in pieces into (event, value) pairs. A token cut off
+    #at the end of a piece waits for the next one, so only the unparsed tail is
+    #kept.
+
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.offset = 0
+        #While a string goes on past the end of the buffer, the pieces fed
+        #since and whether the last of them ended with a backslash.
+        self.pieces = []
+        self.escaped = None
+        self.stack = []
+        self.state = 'value'
+
+    def feed(self, chunk, final=False):
+        if isinstance(chunk, bytes):
+            chunk = self.decoder.decode(chunk, final)
+        if self.escaped is not None:
+            if not final and not self.closes(chunk):
+                self.pieces.append(chunk)
+                return []
+            self.pieces.append(chunk)
+            chunk = ''.join(self.pieces)
+            self.pieces = []
+            self.escaped = None
+        self.buffer += chunk
+        events = []
+        self.parse(events, final)
+        if final:
+            if self.buffer.strip(' \t\n\r'):
+                self.fail('Unexpected data', len(self.buffer))
+            if self.state != 'end':
+                self.fail('Unexpected end of data', len(self.buffer))
+        return events
+
+    def fail(self, message, pos):
+        raise JSONError('{} at character {}'.format(
+            message, self.offset + pos))
+
+    def after_value(self):
+        return 'comma' if self.stack else 'end'
+
+    def parse(self, events, final):
+        buffer = self.buffer
+        pos = 0
+        state = self.state
+        stack = self.stack
+        while True:
+            pos = WHITESPACE.match(buffer, pos).end()
+            if pos == len(buffer):
+                break
+            char = buffer[pos]
+            if state == 'end':
+                self.fail('Extra data', pos)
+            elif state == 'colon':
+                if char != ':':
+                    self.fail("Expecting ':' delimiter", pos)
+                pos += 1
+                state = 'value'
+            elif state == 'comma':
+                closing = '}' if stack[-1] == 'map' else ']'
+                if char == ',':
+                    pos += 1
+                    state = 'key' if stack[-1] == 'map' else 'value'
+                elif char == closing:
+                    pos += 1
+                    events.append(('end_' + stack.pop(), None))
+                    state = self.after_value()
+                else:
+                    self.fail("Expecting ',' delimiter", pos)
+            elif state in ('key', 'first_key'):
+                if char == '}' and state == 'first_key':
+                    pos += 1
+                    events.append(('end_' + stack.pop(), None))
+                    state = self.after_value()
+                    continue
+                if char != '"':
+                    self.fail('Expecting property name enclosed in double '
+                              'quotes', pos)
+                end = self.string_end(buffer, pos, final)
+                if end is None:
+                    break
+                events.append(('map_key', self.string(buffer, pos)))
+                pos = end
+                state = 'colon'
+            else:
+                if char == ']' and state == 'first_value':
+                    pos += 1
+                    events.append(('end_' + stack.pop(), None))
+                    state = self.after_value()
+                elif char == '{':
+                    pos += 1
+                    stack.append('map')
+                    events.append(('start_map', None))
+                    state = 'first_key'
+                elif char == '[':
+                    pos += 1
+                    stack.append('array')
+                    events.append(('start_array', None))
+                    state = 'first_value'
+                elif char == '"':
+                    end = self.string_end(buffer, pos, final)
+                    if end is None:
+                        break
+                    events.append(('string', self.string(buffer, pos)))
+                    pos = end
+                    state = self.after_value()
+                elif char in WORDS:
+                    word, event, value = WORDS[char]
+                    if buffer.startswith(word, pos):
+                        pos += len(word)
+                    elif not final and word.startswith(buffer[pos:]):
+                        break
+                    else:
+                        self.fail('Expecting value', pos)
+                    events.append((event, value))
+                    state = self.after_value()
+                elif char in NUMBER_CHARS:
+                    match = NUMBER.match(buffer, pos)
+                    if not final and all(
+                            c in NUMBER_CHARS for c in buffer[pos:]):
+                        #The number might carry on in the next piece.
+                        break
+                    if match is None:
+                        self.fail('Expecting value', pos)
+                    text = match.group()
+                    if match.group(1) or match.group(2):
+                        events.append(('number', float(text)))
+                    else:
+                        events.append(('number', int(text)))
+                    pos = match.end()
+                    state = self.after_value()
+                else:
+                    self.fail('Expecting value', pos)
+        self.buffer = buffer[pos:]
+        self.offset += pos
+        self.state = state
+
+    def string_end(self, buffer, pos, final):
+        end = STRING_BODY.match(buffer, pos + 1).end()
+        if end < len(buffer) and buffer[end] == '"':
+            return end + 1
+        if final:
+            self.fail('Unterminated string', pos)
+        #Only the pieces fed next are scanned for the closing quote.
+        self.escaped = end < len(buffer)
+        return None
+
+    def closes(self, chunk):
+        #Whether chunk holds the closing quote of the string left open at
+        #the end of the buffer.
+        if not chunk:
+            return False
+        end = STRING_BODY.match(chunk, 1 if self.escaped else 0).end()
+        if end < len(chunk) and chunk[end] == '"':
+            return True
+        self.escaped = end < len(chunk)
+        return False
+
+    def string(self, buffer, pos):
+        try:
+            return json.decoder.scanstring(buffer, pos + 1)[0]
+        except json.JSONDecodeError as e:
+            self.fail(e.msg, e.pos)
+
+def read_chunks(source, chunk_size):
+    if isinstance(source, (bytes, str)):
+        for start in range(0, len(source), chunk_size):
+            yield source[start:start + chunk_size]
+    elif hasattr(source, 'read'):
+        for chunk in iter(lambda: source.read(chunk_size), source.read(0)):
+            yield chunk
+    else:
+        for chunk in source:
+            yield chunk
+
+def iter_events(source, chunk_size=65536):
+    #The parse events of a JSON document given as bytes or str, a file or an
+    #iterable of pieces. Malformed input raises JSONError as soon as it is
+    #reached.
+    tokenizer = Tokenizer()
+    for chunk in read_chunks(source, chunk_size):
+        for event in tokenizer.feed(chunk):
+            yield event
+    for event in tokenizer.feed(b'', final=True):
+        yield event
+
+def map_fields(node):
+    #The submitted keys a map schema accepts, each with the node checking
+    #its value when a bad value there is sure to fail the map. None when
+    #any key could be accepted.
+    fields = {}
+    for key_node in node.keys:
+        if not add_fields(key_node, fields, True):
+            return None
+    return fields
+
+def add_fields(key_node, fields, checked):
+    if isinstance(key_node, KeyNode):
+        if key_node.key in fields or not checked:
+            fields[key_node.key] = None
+        else:
+            fields[key_node.key] = key_node.value
+    elif isinstance(key_node, OptionalKeyNode):
+        return add_fields(key_node.inner, fields, checked)
+    elif isinstance(key_node, (OrKeyNode, XOrKeyNode)):
+        #Invalid XOr alternatives are dropped rather than failing the map.
+        checked = checked and isinstance(key_node, OrKeyNode)
+        for orkey, alternative in key_node.alternatives:
+            if not add_fields(alternative, fields, checked):
+                return False
+    elif isinstance(key_node, (IfKeyNode, MsgKeyNode)):
+        return add_fields(key_node.inner, fields, False)
+    else:
+        return False
+    return True
+
+class Builder:
+    #Puts the document together from parse events while following the
+    #schema, and stops at the first value the schema is sure to reject.
+
+    def __init__(self, form, errors):
+        self.errors = errors
+        self.check = not form.batched
+        self.limits = form.limits
+        #Values read so far against max_nodes. A repeated key counts again,
+        #as what it held was read all the same.
+        self.nodes = 1
+        self.root = form.node
+        self.stack = []
+        self.fields = {}
+        self.document = None
+
+    def expected(self):
+        #The node for the next value, if it is known to apply there.
+        if not self.stack:
+            return self.root
+        container, node, key = self.stack[-1]
+        if isinstance(node, MapNode):
+            fields = self.fields_of(node)
+            if fields is not None:
+                return fields.get(key)
+        elif isinstance(node, SequenceNode) and len(node.validators) == 1:
+            return node.validators[0]
+        return None
+
+    def fields_of(self, node):
+        fields = self.fields.get(node, False)
+        if fields is False:
+            fields = self.fields[node] = map_fields(node)
+        return fields
+
+    def errors_at(self, depth):
+        errors = self.errors
+        for container, node, key in self.stack[:depth]:
+            child = errors.child()
+            errors[key] = child
+            errors = child
+        return errors
+
+    def add(self, value):
+        #Whether value made its container any larger.
+        if not self.stack:
+            self.document = value
+            return False
+        frame = self.stack[-1]
+        container = frame[0]
+        if type(container) is list:
+            frame[2] = len(container)
+            container.append(value)
+            return True
+        grows = frame[2] not in container
+        container[frame[2]] = value
+        return grows
+
+    def within_limits(self, value, grows):
+        #The form's limits are applied to each value as it arrives, so a
+        #body over them is never read or built in full.
+        limits = self.limits
+        if limits is None:
+            return True
+        path = tuple(frame[2] for frame in self.stack)
+        depth = len(self.stack)
+        if grows:
+            self.nodes += 1
+            if limits.max_nodes is not None and self.nodes > limits.max_nodes:
+                self.errors.section_errors.append(ErrorRecord(
+                    'too_many_values', None, (limits.max_nodes,)))
+                return False
+            container = self.stack[-1][0]
+            found = limits.exceeded(container, depth)
+            if found is not None:
+                return limits.reject(self.errors, path[:-1], container,
+                                     found)
+        found = limits.exceeded(value, depth + 1)
+        if found is not None:
+            return limits.reject(self.errors, path, value, found)
+        return True
+
+    def send(self, event, value):
+        if event == 'map_key':
+            frame = self.stack[-1]
+            frame[2] = value
+            if self.limits is not None and \
+                    self.limits.key_exceeded(value) is not None:
+                path = tuple(frame[2] for frame in self.stack[:-1])
+                return self.limits.reject_key(self.errors, path, value)
+            node = frame[1]
+            if self.check and isinstance(node, MapNode):
+                fields = self.fields_of(node)
+                if fields is not None and value not in fields:
+                    errors = self.errors_at(len(self.stack) - 1)
+                    errors.section_errors.append(
+                        ErrorRecord('unexpected', value))
+                    return False
+            return True
+        if event == 'start_map' or event == 'start_array':
+            container = {} if event == 'start_map' else []
+            node = self.expected()
+            #What is inside is only followed when the container is the
+            #kind the schema describes; a list schema iterates a map's keys.
+            if not isinstance(node, (MapNode, SequenceNode)) or \
+                    isinstance(node, MapNode) != (event == 'start_map'):
+                node = None
+            if not self.within_limits(container, self.add(container)):
+                return False
+            self.stack.append([container, node, None])
+            return True
+        if event == 'end_map' or event == 'end_array':
+            container, node, key = self.stack.pop()
+            return self.complete(container)
+        if not self.within_limits(value, self.add(value)):
+            return False
+        return self.complete(value)
+
+    def complete(self, value):
+        #Values are only judged early where the schema rules them out by
+        #type alone, and then with the very call validation would make.
+        if not self.check or not self.stack:
+            return True
+        container, node, key = self.stack[-1]
+        context = Context({}, fail_fast=True)
+        if isinstance(node, SequenceNode):
+            if any(v.may_accept(type(value)) for v in node.validators):
+                return True
+            errors = self.errors_at(len(self.stack) - 1)
+            if len(node.validators) == 1:
+                self.reject(node.validators[0], key, value, errors, context)
+            else:
+                #The dispatch gives maps and lists a type error.
+                node.validate_element(key, value, errors, context)
+            return False
+        node = self.expected()
+        if node is None or node.may_accept(type(value)):
+            return True
+        self.reject(node, key, value, self.errors_at(len(self.stack) - 1),
+                    context)
+        return False
+
+    def reject(self, node, key, value, errors, context):
+        #Maps and lists would raise on a value of a type they rule out.
+        if isinstance(node, (MapNode, SequenceNode)):
+            errors.add(key, ErrorRecord('type', value, (node.type_name,)))
+        else:
+            node.validate(key, value, errors, context)
+
+def validate_json(form, source, chunk_size=65536):
+    #Validates a JSON document while it is being parsed, stopping at malformed
+    #JSON, a key the schema doesn't accept or a value of a type it rules out.
+    errors = FormErr()
+    builder = Builder(form, errors)
+    try:
+        for event, value in iter_events(source, chunk_size):
+            if not builder.send(event, value):
+                return Result(False, None, errors)
+    except JSONError as e:
+        errors.section_errors.append(ErrorRecord('error', None, (), str(e)))
+        return Result(False, None, errors)
+    valid, clean = form.run(builder.document, errors)
+    return Result(valid, clean, result_errors(errors))
@@ -0,0 +1,111 @@
+import gc
+import linecache
+import unittest
+from ceramic_forms.form import Form, Optional, Or, XOr, If, And, Use, Msg
+
+def even(x):
+    return x % 2 == 0
+
+class TestCodegenEngine(unittest.TestCase):
+
+    schema = {
+        'customer_id': int,
+        'name': str,
+        Optional('phone_numbers'): [
+            {
+                'number': Msg(And(str, lambda x: len(x) > 6),
+                              'Invalid phone number!'),
+                'type': Or('cell', 'home')
+            }
+        ],
+        Or: {
+            'street_address': str,
+            'postal_code': And(str, lambda x: len(x)==6)
+        },
+        XOr: {
+            'email': str,
+            'fax': Use(int)
+        },
+        If([['phone_numbers'], ['postal_code']], 'special_condition'): And(
+            Use(int),
+            even
+        ),
+        Msg(Optional('note'), 'Bad note'): str
+    }
+
+    def assertSameResult(self, schema, data):
+        tree = Form(schema)
+        codegen = Form(schema, engine='codegen')
+        self.assertEqual(tree.validate(data), codegen.validate(data))
+        self.assertEqual(tree.cleaned, codegen.cleaned)
+        self.assertEqual(tree.errors, codegen.errors)
+        self.assertEqual(tree.errors.section_errors,
+                         codegen.errors.section_errors)
+
+    def test_matches_tree_engine(self):
+        for data in [
+            {
+                'customer_id': 9001,
+                'name': 'Eenis',
+                'phone_numbers': [{'number': '6666666', 'type': 'cell'}],
+                'postal_code': '123456',
+                'email': 'a@b.c',
+                'special_condition': '4'
+            },
+            {
+                'customer_id': '9001',
+                'name': 'Eenis',
+                'phone_numbers': [{'number': '666', 'type': 'work'}],
+                'postal_code': '123456',
+                'email': 'a@b.c',
+                'fax': 'x',
+                'note': 3,
+                'extra': 1
+            },
+            {'name': 3}
+        ]:
+            self.assertSameResult(self.schema, data)
+
+    def test_bare_values(self):
+        for schema, data in [
+            (4, 4),
+            (4, 3),
+            (Use(int), '4'),
+            (Use(int), 'four'),
+            (Or(str, even), 3),
+            ([1, '1'], [1, '1', 2]),
+            ([Use(int)], ['1', 'a']),
+            ({And(str, lambda x: x.startswith('x_')): int}, {'x_a': 1}),
+            ({And(str, lambda x: x.startswith('x_')): int}, {'a': 1, 3: 4})
+        ]:
+            self.assertSameResult(schema, data)
+
+    def test_long_chains(self):
+        for schema, data in [
+            (Or(*[(i, i) for i in range(120)]), (119, 119)),
+            (Or(*[(i, i) for i in range(120)]), 3),
+            (And(*[int] * 120), 1),
+            (And(*[int] * 120), 'x'),
+            ([(i, str(i)) for i in range(240)], [(239, '239'), (0, 1)]),
+        ]:
+            self.assertSameResult(schema, data)
+
+    def test_source(self):
+        form = Form({'a': int, 'b': [Use(int)]}, engine='codegen')
+        self.assertIn('def validate(suspicious, errors, context):', form.source)
+        self.assertIn("type(value", form.source)
+        self.assertIsNone(Form({'a': int}).source)
+
+    def test_source_leaves_linecache(self):
+        form = Form({'a': int}, engine='codegen')
+        filename = form.walk.__code__.co_filename
+        self.assertIn(filename, linecache.cache)
+        del form
+        gc.collect()
+        self.assertNotIn(filename, linecache.cache)
+
+    def test_unknown_engine(self):
+        self.assertRaises(ValueError, Form, {}, engine='jit')
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,140 @@
+import sys
+import unittest
+from ceramic_forms.form import Form, Optional, Or, And, Use, NO_ERRORS
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from ceramic_forms.columnar import (
+    validate_columns, validate_arrays, plan_columns, load_numpy
+)
+
+def positive(x):
+    return x > 0
+
+@unittest.skipUnless(numpy, 'NumPy is not installed')
+class TestColumnar(unittest.TestCase):
+
+    schema = {
+        'id': Use(int),
+        'score': Use(float),
+        'kind': Or('a', 'b', None),
+        Optional('ok'): bool
+    }
+
+    def records(self):
+        return [
+            {'id': '1', 'score': '2.5', 'kind': 'a', 'ok': True},
+            {'id': 2, 'score': 3, 'kind': None},
+            {'id': 'x', 'score': '1', 'kind': 'a'},
+            {'id': '4', 'score': '1', 'kind': 'c', 'ok': 1},
+            {'id': '5', 'score': '1', 'kind': 'b', 'extra': 1},
+            {'score': '1', 'kind': 'b'},
+            {'id': 10 ** 30, 'score': [], 'kind': ['a']},
+            {'id': '8', 'score': None, 'kind': 'a'},
+            {'id': None, 'score': '1', 'kind': 'b'}
+        ]
+
+    def test_same_as_validate_many(self):
+        for engine in ('tree', 'codegen'):
+            form = Form(self.schema, engine=engine)
+            for chunksize in (1, 3, 100):
+                results = list(validate_columns(form, self.records(),
+                                                chunksize=chunksize))
+                self.assertEqual(results,
+                                 list(form.validate_many(self.records())))
+        self.assertEqual([r.valid for r in results],
+                         [True, True, False, False, False, False, False,
+                          False, False])
+        self.assertEqual(list(results[0].cleaned), ['id', 'score', 'kind',
+                                                    'ok'])
+        self.assertIs(results[1].errors, NO_ERRORS)
+
+    def test_unchanged_rows_shared(self):
+        form = Form({'a': int, 'b': Or(1, 2)})
+        records = [{'a': 1, 'b': 2}, {'a': True, 'b': 2}]
+        results = list(validate_columns(form, records))
+        self.assertIs(results[0].cleaned, records[0])
+        self.assertFalse(results[1].valid)
+        self.assertEqual(results[1].errors['a'], ['True must be of type int'])
+
+    def test_plans(self):
+        self.assertIsNotNone(plan_columns(Form(self.schema).node))
+        for schema in [
+            {'a': And(int, positive)},
+            {'a': Use(str)},
+            {Or: {'a': int}},
+            {'a': {'b': int}},
+            [int]
+        ]:
+            form = Form(schema)
+            self.assertIsNone(plan_columns(form.node))
+        form = Form({'a': And(int, positive)})
+        results = list(validate_columns(form, [{'a': 1}, {'a': 0}]))
+        self.assertEqual([r.valid for r in results], [True, False])
+
+class TestColumnarImport(unittest.TestCase):
+
+    def test_missing_numpy(self):
+        saved = sys.modules.get('numpy')
+        sys.modules['numpy'] = None
+        try:
+            with self.assertRaises(ImportError) as raised:
+                load_numpy()
+            self.assertIn('ceramic_forms[columnar]', str(raised.exception))
+        finally:
+            if saved is None:
+                del sys.modules['numpy']
+            else:
+                sys.modules['numpy'] = saved
+
+@unittest.skipUnless(numpy, 'NumPy is not installed')
+class TestArrays(unittest.TestCase):
+
+    schema = {'id': int, 'score': Use(int), Optional('kind'): Or(1, 2)}
+
+    def arrays(self):
+        return {
+            'id': numpy.arange(6),
+            'score': numpy.array([1.5, 2.0, numpy.nan, 4.9, numpy.inf, -1]),
+            'kind': numpy.array([1, 2, 1, 3, 2, 1])
+        }
+
+    def test_arrays(self):
+        for workers in (None, 2):
+            result = validate_arrays(Form(self.schema), self.arrays(),
+                                     workers=workers, chunksize=4)
+            self.assertEqual(result.valid.tolist(),
+                             [True, True, False, False, False, True])
+            self.assertEqual(result.cleaned['score'][result.valid].tolist(),
+                             [1, 2, -1])
+            self.assertEqual(result.cleaned['id'].dtype.kind, 'i')
+            self.assertEqual(sorted(result.errors), [2, 3, 4])
+            self.assertEqual(result.errors[3]['kind'],
+                             ['3 is not valid for any (1, 2)'])
+            self.assertEqual(result.errors[2]['score'],
+                             ['cannot convert float NaN to integer'])
+
+    def test_same_as_records(self):
+        form = Form(self.schema)
+        arrays = self.arrays()
+        arrays['id'] = arrays['id'].astype(float)
+        del arrays['kind']
+        result = validate_arrays(form, arrays)
+        for i in range(6):
+            record = {key: values[i].item() for key, values in arrays.items()}
+            self.assertEqual(result.errors.get(i, NO_ERRORS),
+                             form.check(record).errors)
+
+    def test_rejected_input(self):
+        form = Form(self.schema)
+        self.assertRaises(TypeError, validate_arrays, form,
+                          {'id': numpy.array(['a'])})
+        self.assertRaises(ValueError, validate_arrays, form,
+                          {'id': numpy.arange(2), 'score': numpy.arange(3)})
+        self.assertRaises(ValueError, validate_arrays,
+                          Form({'id': And(int, positive)}), {})
+        self.assertRaises(ValueError, validate_arrays, form,
+                          {'id': numpy.arange(2), 'other': numpy.arange(2)})
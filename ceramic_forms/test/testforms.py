@@ -1,5 +1,26 @@
+import asyncio
+import hashlib
+import io
+import itertools
+import json
+import pickle
+import sqlite3
+import tempfile
+import threading
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from ceramic_forms.form import Form, Optional, Or, XOr, If, And, Use, Msg
+from ceramic_forms.form import Batched, Cached, Upload
+from ceramic_forms.form import NO_ERRORS, ErrorRecord
+from ceramic_forms.form import FormErr, DISCARD, LiteralNode
+from ceramic_forms.jsonstream import validate_json
+from ceramic_forms.urlencoded import validate_urlencoded
+
+def even(x):
+    return x % 2 == 0
+
+def isint(x):
+    return isinstance(x, int)
 
 class TestFormValidation(unittest.TestCase):
 
@@ -644,6 +665,1258 @@ class TestMsgWrapper(unittest.TestCase):
         del form.errors['__section_errors__']
         self.assertFalse(form.errors)
 
+class TestCompiledSchema(unittest.TestCase):
+
+    def test_error_messages(self):
+        schema = {
+            'customer_id': int,
+            'name': 'Eenis',
+            'kind': Or('cell', 'home'),
+            'tags': [str],
+            XOr: {'a': 1, 'b': 2}
+        }
+        data = {
+            'customer_id': '9001',
+            'name': 'Teddy',
+            'kind': 'work',
+            'tags': ['x', 2],
+            'extra': 1
+        }
+        form = Form(schema)
+        for _ in range(2):
+            self.assertFalse(form.validate(data))
+            self.assertEqual(form.errors['customer_id'],
+                             ["'9001' must be of type int"])
+            self.assertEqual(form.errors['name'],
+                             ["'Teddy' should equal 'Eenis'"])
+            self.assertEqual(form.errors['kind'],
+                             ["work is not valid for any ('cell', 'home')"])
+            self.assertEqual(form.errors['tags'][1],
+                             ["2 must be of type str"])
+            self.assertEqual(form.errors.section_errors, [
+                "Missing one of dict_keys(['a', 'b'])",
+                "Unexpected key extra"
+            ])
+            self.assertEqual(form.cleaned, {})
+
+    def test_shared_subschema(self):
+        address = {'street': str}
+        schema = {'home': address, 'work': address}
+        form = Form(schema)
+        self.assertTrue(form.validate({
+            'home': {'street': 'a'},
+            'work': {'street': 'b'}
+        }))
+        self.assertFalse(form.validate({
+            'home': {'street': 'a'},
+            'work': {'street': 1}
+        }))
+        self.assertFalse(form.errors['home'])
+        self.assertTrue(form.errors['work']['street'])
+
+class TestCheck(unittest.TestCase):
+
+    def test_result(self):
+        form = Form({'a': Use(int)})
+        result = form.check({'a': '3'})
+        self.assertTrue(result.valid)
+        self.assertEqual(result.cleaned, {'a': 3})
+        self.assertIs(result.errors, NO_ERRORS)
+        result = form.check({'a': 'x'})
+        self.assertFalse(result.valid)
+        self.assertTrue(result.errors['a'])
+        self.assertRaises(AttributeError, setattr, result, 'valid', True)
+        self.assertFalse(hasattr(form, 'errors'))
+        self.assertFalse(hasattr(form, 'cleaned'))
+
+    def test_section_errors_only(self):
+        for engine in ['tree', 'codegen']:
+            cases = [
+                (Form({And(isint): int}, engine=engine), {'c': 1},
+                 ['isint did not match c']),
+                (Form(int, engine=engine), 'x', ["'x' must be of type int"]),
+            ]
+            for form, data, messages in cases:
+                result = form.check(data)
+                self.assertFalse(result.valid)
+                self.assertEqual(result.errors.section_errors, messages)
+                result = asyncio.run(form.acheck(data))
+                self.assertEqual(result.errors.section_errors, messages)
+                first, second = form.validate_many([data, data])
+                self.assertEqual(first.errors.section_errors, messages)
+                self.assertEqual(second.errors.section_errors, messages)
+
+    def test_shared_between_threads(self):
+        for engine in ['tree', 'codegen']:
+            form = Form({
+                'n': Use(int),
+                'tags': [And(str, lambda x: len(x) < 5)]
+            }, engine=engine)
+            records = [
+                {'n': str(i), 'tags': ['t' * (i % 7)] * (i % 4)}
+                for i in range(500)
+            ]
+            with ThreadPoolExecutor(8) as executor:
+                results = list(executor.map(form.check, records))
+            for i, result in enumerate(results):
+                self.assertEqual(result.valid, i % 7 < 5 or i % 4 == 0)
+                if result.valid:
+                    self.assertEqual(result.cleaned['n'], i)
+
+class TestAsyncValidation(unittest.TestCase):
+
+    def test_async_validators(self):
+        taken = {'teddy'}
+
+        async def available(username):
+            await asyncio.sleep(0)
+            return username not in taken
+
+        async def parse_code(code):
+            await asyncio.sleep(0)
+            return int(code)
+
+        schema = {
+            'username': And(str, available),
+            'codes': [Use(parse_code)],
+            'name': str
+        }
+        form = Form(schema)
+        result = asyncio.run(form.acheck(
+            {'username': 'bear', 'codes': ['1', '2'], 'name': 'x'}))
+        self.assertTrue(result.valid)
+        self.assertEqual(result.cleaned,
+                         {'username': 'bear', 'codes': [1, 2], 'name': 'x'})
+        self.assertIs(result.errors, NO_ERRORS)
+
+        data = {'username': 'teddy', 'codes': ['1', 'x'], 'name': 3,
+                'extra': 1}
+        self.assertFalse(asyncio.run(form.avalidate(data)))
+        self.assertEqual(form.errors['username'],
+                         ['available did not match teddy'])
+        self.assertEqual(list(form.errors['codes']), [1])
+        self.assertTrue(form.errors['name'])
+        self.assertEqual(form.errors.section_errors, ['Unexpected key extra'])
+
+    def test_concurrent_fields(self):
+        #Each validator waits for the other one, so this only finishes if
+        #both fields are awaited at the same time.
+        async def run():
+            first, second = asyncio.Event(), asyncio.Event()
+
+            async def wait_first(value):
+                second.set()
+                await first.wait()
+                return True
+
+            async def wait_second(value):
+                first.set()
+                await second.wait()
+                return True
+
+            form = Form({'a': wait_first, 'b': [wait_second]})
+            return await asyncio.wait_for(
+                form.acheck({'a': 1, 'b': [2]}), 1)
+
+        self.assertTrue(asyncio.run(run()).valid)
+
+    def test_matches_sync_errors(self):
+        schema = {
+            'a': int,
+            Or: {'b': Use(int), 'c': str},
+            'd': [1, '1'],
+            'e': {'f': Msg(str, 'no')}
+        }
+        data = {'a': '1', 'b': 'x', 'd': [1, 2, '1'], 'e': {'f': 1}}
+        form = Form(schema)
+        expected = form.check(data)
+        result = asyncio.run(form.acheck(data))
+        self.assertEqual(result, expected)
+        self.assertEqual(result.errors.section_errors,
+                         expected.errors.section_errors)
+
+        async def anything(value):
+            return True
+        form = Form({And(isint): int, 'z': anything})
+        result = asyncio.run(form.acheck({'c': 1, 'z': 1}))
+        self.assertFalse(result.valid)
+        self.assertIn('isint did not match c', result.errors.section_errors)
+
+    def test_sync_validate_refuses_coroutines(self):
+        async def check(value):
+            return True
+        for engine in ['tree', 'codegen']:
+            form = Form({'a': check}, engine=engine)
+            self.assertRaises(TypeError, form.validate, {'a': 1})
+
+class TestBatchedValidator(unittest.TestCase):
+
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        self.db.execute('create table sku (code text primary key)')
+        self.db.executemany('insert into sku values (?)',
+                            [('a1',), ('b2',), ('c3',)])
+        self.calls = []
+
+    def tearDown(self):
+        self.db.close()
+
+    def sku_exists(self, codes):
+        self.calls.append(list(codes))
+        found = {
+            row[0] for row in self.db.execute(
+                'select code from sku where code in ({})'.format(
+                    ','.join('?' * len(codes))),
+                codes
+            )
+        }
+        return [code in found or 'Unknown sku {}'.format(code)
+                for code in codes]
+
+    def test_single_lookup(self):
+        form = Form({'items': [{'sku': Batched(self.sku_exists),
+                                'count': int}]})
+        data = {'items': [
+            {'sku': 'a1', 'count': 1},
+            {'sku': 'b2', 'count': 2},
+            {'sku': 'a1', 'count': 3},
+        ]}
+        self.assertTrue(form.validate(data))
+        self.assertEqual(form.cleaned, data)
+        self.assertEqual(self.calls, [['a1', 'b2']])
+
+    def test_error_paths(self):
+        form = Form({
+            'items': [{'sku': Batched(self.sku_exists)}],
+            'extra': Batched(self.sku_exists)
+        })
+        data = {
+            'items': [{'sku': 'a1'}, {'sku': 'zz'}, {'sku': 'c3'}],
+            'extra': 'yy'
+        }
+        self.assertFalse(form.validate(data))
+        self.assertEqual(self.calls[0], ['a1', 'zz', 'c3'])
+        self.assertEqual(self.calls[1], ['yy'])
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(form.errors['items'][1]['sku'], ['Unknown sku zz'])
+        self.assertEqual(list(form.errors['items']), [1])
+        self.assertEqual(form.errors['extra'], ['Unknown sku yy'])
+
+    def test_validate_many(self):
+        form = Form({'sku': Batched(self.sku_exists)})
+        records = [{'sku': code} for code in ['a1', 'xx', 'b2', 'a1']]
+        results = list(form.validate_many(records))
+        self.assertEqual(self.calls, [['a1', 'xx', 'b2']])
+        self.assertEqual([r.valid for r in results],
+                         [True, False, True, True])
+        self.assertEqual(results[1].errors['sku'], ['Unknown sku xx'])
+
+    def test_equal_values_of_other_types(self):
+        def ints_only(values):
+            self.calls.append(list(values))
+            return [type(value) is int for value in values]
+        form = Form([Batched(ints_only)])
+        result = form.check([1, True, 1.0, 1])
+        self.assertEqual(self.calls, [[1, True, 1.0]])
+        self.assertEqual(list(result.errors), [1, 2])
+
+    def test_none_verdict(self):
+        def undecided(values):
+            self.calls.append(list(values))
+            return [None] * len(values)
+        form = Form({'a': Batched(undecided), 'b': Batched(undecided)})
+        self.assertFalse(form.validate({'a': 1, 'b': 2}))
+        self.assertEqual(self.calls, [[1], [2]])
+        self.assertEqual(form.errors['a'], ['undecided did not match 1'])
+
+    def test_failing_lookup(self):
+        def broken(values):
+            raise ValueError('lookup failed')
+        form = Form({'a': Batched(broken), 'b': [Batched(broken)]})
+        self.assertFalse(form.validate({'a': 1, 'b': [2, 3]}))
+        self.assertEqual(form.errors['a'], ['lookup failed'])
+        self.assertEqual(form.errors['b'][1], ['lookup failed'])
+
+    def test_async_lookup(self):
+        async def sku_exists(codes):
+            await asyncio.sleep(0)
+            return self.sku_exists(codes)
+        form = Form({'items': [Batched(sku_exists)]})
+        result = asyncio.run(form.acheck({'items': ['a1', 'no', 'c3']}))
+        self.assertFalse(result.valid)
+        self.assertEqual(result.errors['items'][1], ['Unknown sku no'])
+        self.assertEqual(self.calls, [['a1', 'no', 'c3']])
+
+class TestCachedValidator(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def slow_int(self, value):
+        self.calls.append(value)
+        return int(value)
+
+    def test_hits_and_misses(self):
+        cached = Cached(Use(self.slow_int))
+        form = Form({'a': cached, 'b': cached, 'c': [cached]})
+        self.assertTrue(form.validate({'a': '1', 'b': '1', 'c': ['2', '1']}))
+        self.assertEqual(form.cleaned, {'a': 1, 'b': 1, 'c': [2, 1]})
+        self.assertEqual(self.calls, ['1', '2'])
+        info = cached.cache_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (2, 2, 2))
+
+    def test_errors_replayed(self):
+        cached = Cached(Msg(Use(self.slow_int), 'Not a number'))
+        form = Form({'a': cached, 'b': cached})
+        self.assertFalse(form.validate({'a': 'x', 'b': 'x'}))
+        self.assertEqual(form.errors['a'], ['Not a number'])
+        self.assertEqual(form.errors['b'], ['Not a number'])
+        self.assertEqual(self.calls, ['x'])
+
+    def test_lru_eviction(self):
+        cached = Cached(Use(self.slow_int), maxsize=2)
+        form = Form([cached])
+        form.validate(['1', '2', '1', '3', '2'])
+        self.assertEqual(self.calls, ['1', '2', '3', '2'])
+        self.assertEqual(cached.cache_info().currsize, 2)
+        cached.cache_clear()
+        self.assertEqual(cached.cache_info(), (0, 0, 2, 0))
+
+    def test_keyed_by_type(self):
+        form = Form([Cached(int)])
+        self.assertFalse(form.validate([1, True, 1.0]))
+        self.assertEqual(list(form.errors), [1, 2])
+
+    def test_unhashable_bypass(self):
+        cached = Cached(Use(self.slow_int))
+        form = Form({'a': Cached(And(list, lambda x: len(x) == 1))})
+        self.assertTrue(form.validate({'a': [1]}))
+        self.assertTrue(Form([cached]).validate(['5', '5']))
+        self.assertEqual(self.calls, ['5'])
+
+    def test_async(self):
+        async def double(x):
+            self.calls.append(x)
+            return x * 2
+        cached = Cached(Use(double))
+        result = asyncio.run(Form([cached]).acheck([1, 1, 2]))
+        self.assertEqual(result.cleaned, [2, 2, 4])
+        self.assertEqual(self.calls, [1, 2])
+
+class TestFailFast(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def counted(self, x):
+        self.calls.append(x)
+        return x
+
+    def test_stops_at_first_error(self):
+        form = Form({'a': int, 'b': Use(self.counted),
+                     'c': [Use(self.counted)]})
+        self.assertFalse(form.validate({'a': 'x', 'b': 1, 'c': [1, 2]},
+                                       fail_fast=True))
+        self.assertEqual(self.calls, [])
+        self.assertEqual(form.errors['a'], ["'x' must be of type int"])
+        self.assertEqual(list(form.errors), ['a'])
+
+    def test_sequence(self):
+        form = Form([And(int, self.counted)])
+        self.assertFalse(form.validate([1, 'x', 2, 'y'], fail_fast=True))
+        self.assertEqual(self.calls, [1])
+        self.assertEqual(list(form.errors), [1])
+
+    def test_keys(self):
+        form = Form({
+            Or: {'a': int, 'b': Use(self.counted)},
+            XOr: {'c': int, 'd': int, 'e': Use(self.counted)},
+            And(str, lambda k: k.startswith('x')): int
+        })
+        self.assertFalse(form.validate({'a': '1', 'b': 1}, fail_fast=True))
+        self.assertFalse(form.validate({'a': 1, 'c': 1, 'd': 2, 'e': 3},
+                                       fail_fast=True))
+        self.assertEqual(form.errors.section_errors,
+                         ["Only one of dict_keys(['c', 'd', 'e']) permitted"])
+        self.assertEqual(self.calls, [])
+
+    def test_same_verdict(self):
+        form = Form({'a': [Or(int, str)]})
+        for data in [{'a': [1, 'b']}, {'a': [1, None]}, {'b': 1}, {}]:
+            self.assertEqual(form.is_valid(data), form.validate(data))
+            self.assertEqual(form.validate(data, fail_fast=True),
+                             form.validate(data))
+
+    def test_is_valid_leaves_form_alone(self):
+        form = Form({'a': int})
+        self.assertTrue(form.validate({'a': 1}))
+        self.assertFalse(form.is_valid({'a': 'b'}))
+        self.assertEqual(form.cleaned, {'a': 1})
+        self.assertEqual(form.errors, {})
+
+    def test_codegen(self):
+        form = Form({'a': int, 'b': [Use(self.counted)]}, engine='codegen')
+        self.assertFalse(form.is_valid({'a': None, 'b': [1]}))
+        self.assertEqual(self.calls, [])
+        self.assertFalse(form.validate({'a': 1, 'b': [1, 2], 'c': 3},
+                                       fail_fast=True))
+        self.assertEqual(self.calls, [1, 2])
+        self.assertEqual(form.errors.section_errors, ['Unexpected key c'])
+
+    def test_batched_skips_failed(self):
+        looked_up = []
+        def exists(values):
+            looked_up.extend(values)
+            return [True for value in values]
+        form = Form({'a': int, 'sku': Batched(exists)})
+        self.assertFalse(form.is_valid({'a': 'x', 'sku': 'a1'}))
+        self.assertEqual(looked_up, [])
+        self.assertTrue(form.is_valid({'a': 1, 'sku': 'a1'}))
+        self.assertEqual(looked_up, ['a1'])
+
+class TestErrorRecords(unittest.TestCase):
+
+    def test_rendered_lazily(self):
+        class Loud:
+            renders = 0
+            def __repr__(self):
+                Loud.renders += 1
+                return 'loud'
+        form = Form({'a': int, 'b': Or(Loud(), 1)})
+        self.assertFalse(form.is_valid({'a': Loud(), 'b': 2}))
+        result = form.check({'a': Loud(), 'b': 2})
+        self.assertFalse(result.valid)
+        self.assertEqual(Loud.renders, 0)
+        error = result.errors['a'][0]
+        self.assertEqual(Loud.renders, 2)
+        self.assertEqual(error.code, 'type')
+        self.assertIsInstance(error.value, Loud)
+        self.assertEqual(error, 'loud must be of type int')
+        result.errors
+        self.assertEqual(Loud.renders, 2)
+
+    def test_plain_text(self):
+        form = Form({'a': int, 'b': [str], 'c': str})
+        self.assertFalse(form.validate({'a': 'x', 'b': [1]}))
+        error = form.errors['a'][0]
+        self.assertIsInstance(error, str)
+        self.assertEqual(error.code, 'type')
+        self.assertEqual(', '.join(form.errors['a']),
+                         "'x' must be of type int")
+        expected = {
+            'a': ["'x' must be of type int"],
+            'b': {'0': ['1 must be of type str']},
+            '__section_errors__': ['Missing c']
+        }
+        self.assertEqual(json.loads(json.dumps(form.errors)), expected)
+        result = form.check({'a': 'x', 'b': [1]})
+        self.assertEqual(json.loads(json.dumps(result.errors)), expected)
+        valid, cleaned, errors = form.check({'a': 'x', 'b': [1]})
+        self.assertEqual(json.loads(json.dumps(errors)), expected)
+        self.assertEqual(json.loads(json.dumps(form.errors.messages())),
+                         expected)
+        self.assertEqual(Form(int).check('x').errors.messages(),
+                         {'__section_errors__': ["'x' must be of type int"]})
+
+    def test_codes(self):
+        form = Form({
+            'a': 1,
+            'b': Or(1, 2),
+            'c': even,
+            'd': Use(int),
+            'e': Msg(int, 'Bad e'),
+            XOr: {'f': int, 'g': int}
+        })
+        form.validate({'a': 2, 'b': 3, 'c': 3, 'd': 'x', 'e': 'x', 'z': 1})
+        codes = {path: getattr(error, 'code', None)
+                 for path, error in form.errors.iter_errors()}
+        self.assertEqual(codes, {
+            ('a',): 'literal',
+            ('b',): 'or',
+            ('c',): 'match',
+            ('d',): 'error',
+            ('e',): None,
+            (): 'unexpected',
+        })
+        self.assertEqual(
+            [error.code for error in form.errors.section_errors],
+            ['missing_one', 'unexpected']
+        )
+
+    def test_behaves_like_text(self):
+        error = ErrorRecord('missing', 'a')
+        self.assertEqual(error, ErrorRecord('missing', 'a'))
+        self.assertIn(error, {'Missing a'})
+        self.assertTrue(error.startswith('Missing'))
+        self.assertIn('a', error)
+        self.assertEqual('! ' + error, '! Missing a')
+        self.assertEqual(', '.join(map(str, [error, error])),
+                         'Missing a, Missing a')
+        self.assertEqual('{}'.format(error), 'Missing a')
+        self.assertEqual(repr(error), "'Missing a'")
+
+    def test_paths_and_messages(self):
+        form = Form({'a': [{'b': int}], 'c': str})
+        form.validate({'a': [{'b': 1}, {'b': 'x'}, {}]})
+        self.assertEqual(
+            [(path, str(error)) for path, error in form.errors.iter_errors()],
+            [
+                ((), 'Missing c'),
+                (('a', 1, 'b'), "'x' must be of type int"),
+                (('a', 2), 'Missing b'),
+            ]
+        )
+        messages = form.errors.messages()
+        self.assertEqual(type(messages['a'][1]['b'][0]), str)
+        self.assertEqual(messages, form.errors)
+
+class TestFormErr(unittest.TestCase):
+
+    def test_reading_stores_nothing(self):
+        errors = FormErr()
+        self.assertEqual(errors['a'], [])
+        self.assertNotIn('a', errors)
+        self.assertEqual(errors.section_errors, [])
+        self.assertEqual(errors, {})
+
+    def test_writing_through_a_read(self):
+        errors = FormErr()
+        errors['a'].append('bad a')
+        errors['b'].extend(['bad b'])
+        errors['c'] += ['bad c']
+        errors.section_errors.append('bad section')
+        self.assertEqual(errors, {
+            'a': ['bad a'],
+            'b': ['bad b'],
+            'c': ['bad c'],
+            '__section_errors__': ['bad section']
+        })
+
+    def test_two_reads_of_one_key(self):
+        errors = FormErr()
+        first = errors['k']
+        second = errors['k']
+        first.append('1')
+        second.append('2')
+        self.assertEqual(errors['k'], ['1', '2'])
+        third = errors['j']
+        errors.add('j', 'one')
+        third += ['two']
+        third.insert(0, 'zero')
+        self.assertEqual(errors, {'k': ['1', '2'],
+                                  'j': ['zero', 'one', 'two']})
+
+    def test_add(self):
+        errors = FormErr()
+        errors.add('a', 'one')
+        errors.add('a', 'two')
+        self.assertEqual(errors['a'], ['one', 'two'])
+
+    def test_compact(self):
+        self.assertFalse(hasattr(FormErr(), '__dict__'))
+        self.assertIsNone(FormErr().sections)
+
+    def test_discard(self):
+        DISCARD['a'].append('x')
+        DISCARD.add('a', 'x')
+        DISCARD['b'] = FormErr()
+        DISCARD.section_errors.append('x')
+        self.assertEqual(DISCARD, {})
+        self.assertIs(DISCARD.child(), DISCARD)
+
+    def test_valid_form_has_no_errors(self):
+        form = Form({'a': Or(int, [str]), 'b': Msg(int, 'Bad b'),
+                     'c': [{'d': Or('x', 'y')}]})
+        self.assertTrue(form.validate({'a': ['s'], 'b': 1, 'c': [{'d': 'y'}]}))
+        self.assertEqual(form.errors, {})
+        self.assertIsNone(form.errors.sections)
+
+    def test_or_attempts_no_longer_collide(self):
+        #A failed nested attempt used to leave a FormErr where the next
+        #attempt appended its message.
+        form = Form([Or(['a', int], int)])
+        self.assertFalse(form.validate([['1']]))
+        self.assertEqual(form.errors[0],
+                         ["['1'] is not valid for any (['a', <class 'int'>], "
+                          "<class 'int'>)"])
+
+class TestLiteralAlternatives(unittest.TestCase):
+
+    codes = ['C{:03}'.format(i) for i in range(300)]
+
+    def test_enum(self):
+        for engine in ['tree', 'codegen']:
+            form = Form({'code': Or(*self.codes)}, engine=engine)
+            self.assertTrue(form.validate({'code': 'C299'}))
+            self.assertFalse(form.validate({'code': 'X'}))
+            self.assertEqual(
+                form.errors['code'],
+                ['X is not valid for any {}'.format(tuple(self.codes))]
+            )
+
+    def test_grouped(self):
+        form = Form(Or('a', 'b', Use(int), 1, 2.5, None))
+        nodes = form.node.conditions
+        self.assertEqual([type(node).__name__ for node in nodes],
+                         ['LiteralSetNode', 'UseNode', 'LiteralSetNode'])
+        self.assertEqual(nodes[0].lookup, frozenset(['a', 'b']))
+
+    def test_same_as_equality(self):
+        class Anything:
+            def __eq__(self, other):
+                return True
+        form = Form([Or(1, 'x', None)])
+        self.assertTrue(form.validate([1.0, True, 'x', None, Anything()]))
+        self.assertFalse(form.validate([[1], {'x': 1}, 2]))
+        self.assertEqual(list(form.errors), [0, 1, 2])
+        self.assertTrue(Form(Or(1, 2, Anything())).validate('z'))
+
+    def test_nan_not_grouped(self):
+        nan = float('nan')
+        form = Form(Or(nan, 1))
+        self.assertIsInstance(form.node.conditions[0], LiteralNode)
+        self.assertFalse(form.validate(nan))
+
+class TestSequenceDispatch(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def counted(self, x):
+        self.calls.append(x)
+        return x
+
+    def test_straight_to_the_right_alternative(self):
+        form = Form([{'a': int}, [int], str, int, Use(self.counted)])
+        self.assertTrue(form.validate([{'a': 1}, [2], 'x', 3, 4.5]))
+        self.assertEqual(form.cleaned, [{'a': 1}, [2], 'x', 3, 4.5])
+        #Only the float got as far as the Use.
+        self.assertEqual(self.calls, [4.5])
+
+    def test_candidates(self):
+        form = Form([int, Or('a', 'b'), And(str, len), {'a': int}, 1.5])
+        candidates = form.node.dispatch
+        names = lambda type_: [type(v).__name__ for v in candidates[type_]]
+        self.assertEqual(names(int), ['TypeNode', 'LiteralNode'])
+        self.assertEqual(names(str), ['OrNode', 'AndNode'])
+        self.assertEqual(names(dict), ['MapNode'])
+        self.assertEqual(names(list), [])
+
+    def test_errors_unchanged(self):
+        form = Form([int, Or('a', 'b'), None])
+        self.assertFalse(form.validate([1, 'c', [], None]))
+        self.assertEqual(form.errors[1], [
+            "'c' must be of type int",
+            "c is not valid for any ('a', 'b')",
+            "'c' should equal None",
+        ])
+        self.assertEqual(len(form.errors[2]), 3)
+        self.assertEqual(sorted(form.errors), [1, 2])
+
+    def test_one_clean_per_element(self):
+        form = Form([Use(int), str])
+        form.validate(['1', 'x', None])
+        self.assertEqual(form.cleaned, [1, 'x', None])
+
+    def test_engines_agree(self):
+        schema = [Or(1, 'x'), And(str, Use(int)), float, {'a': int}]
+        data = [{'a': 1}, 'x', '5', 1, 2.5, {'b': 2}, {'a': 'x'}]
+        tree = Form(schema)
+        codegen = Form(schema, engine='codegen')
+        self.assertEqual(tree.validate(data), codegen.validate(data))
+        self.assertEqual(tree.cleaned, codegen.cleaned)
+        self.assertEqual(tree.errors, codegen.errors)
+
+    def test_each_alternative_once(self):
+        def parse(value):
+            self.calls.append(value)
+            raise ValueError('bad')
+        for engine in ('tree', 'codegen'):
+            del self.calls[:]
+            form = Form([int, Use(parse)], engine=engine)
+            result = form.check(['x', 'y'])
+            self.assertEqual(self.calls, ['x', 'y'])
+            self.assertEqual(result.errors.messages(), {
+                0: ["'x' must be of type int", 'bad'],
+                1: ["'y' must be of type int", 'bad'],
+            })
+
+    def test_invalid_scalars(self):
+        for engine in ('tree', 'codegen'):
+            form = Form([{'a': int}, int], engine=engine)
+            result = form.check(['x', {'a': 'y'}])
+            self.assertFalse(result.valid)
+            self.assertEqual(result.errors.messages(), {
+                0: ["'x' must be of type dict", "'x' must be of type int"],
+                1: {'a': ["'y' must be of type int"]},
+            })
+            form = Form([[int], str], engine=engine)
+            self.assertEqual(form.check([None]).errors.messages(), {
+                0: ['None must be of type list', 'None must be of type str']
+            })
+
+class TestKeyIndexes(unittest.TestCase):
+
+    def test_large_or_group(self):
+        group = {'k{}'.format(i): Use(int) for i in range(50)}
+        for engine in ['tree', 'codegen']:
+            form = Form({Or: group}, engine=engine)
+            self.assertIsNotNone(form.node.keys[0].position)
+            self.assertTrue(form.validate({'k40': '1', 'k3': '2'}))
+            self.assertEqual(form.cleaned, {'k3': 2, 'k40': 1})
+            self.assertEqual(list(form.cleaned), ['k3', 'k40'])
+            self.assertFalse(form.validate({'k3': 'x'}))
+            self.assertEqual(list(form.errors), ['k3'])
+            self.assertFalse(form.validate({}))
+            self.assertEqual(form.errors.section_errors,
+                             ['Missing any of {}'.format(group.keys())])
+
+    def test_large_xor_group(self):
+        group = {'k{}'.format(i): int for i in range(50)}
+        form = Form({XOr: group})
+        self.assertTrue(form.validate({'k7': 1}))
+        self.assertFalse(form.validate({'k7': 1, 'k2': 2}))
+        self.assertEqual(form.errors.section_errors,
+                         ['Only one of {} permitted'.format(group.keys())])
+
+    def test_if_paths_shared(self):
+        lookups = []
+        class Watched(dict):
+            def __getitem__(self, key):
+                lookups.append(key)
+                return dict.__getitem__(self, key)
+        schema = {Optional('a'): int}
+        for i in range(5):
+            schema[If([['a'], ['b']], Optional('c{}'.format(i)))] = int
+            schema[If([['a']], Optional('d{}'.format(i)))] = int
+        form = Form(schema)
+        self.assertTrue(form.validate(Watched(a=1)))
+        self.assertEqual(lookups.count('a'), 2)
+        self.assertEqual(lookups.count('b'), 1)
+
+class TestAndKeyCache(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def locale(self, key):
+        self.calls.append(key)
+        return len(key) == 2
+
+    def test_keys_checked_once(self):
+        form = Form({And(str, self.locale, Use(str.upper)): str})
+        self.assertTrue(form.validate({'en': 'Hello', 'de': 'Hallo'}))
+        self.assertTrue(form.validate({'de': 'Hallo', 'fr': 'Bonjour'}))
+        self.assertEqual(form.cleaned, {'DE': 'Hallo', 'FR': 'Bonjour'})
+        self.assertEqual(self.calls, ['en', 'de', 'fr'])
+
+    def test_errors_replayed(self):
+        form = Form({And(str, self.locale): str})
+        for i in range(2):
+            self.assertFalse(form.validate({'english': 'Hello', 'en': 1}))
+            self.assertEqual(form.errors.section_errors,
+                             ['locale did not match english'])
+            self.assertEqual(form.errors['en'], ['1 must be of type str'])
+        self.assertEqual(self.calls, ['english', 'en'])
+
+    def test_bounded(self):
+        form = Form({And(int, self.locale): int})
+        node = form.node.keys[0]
+        self.assertEqual(node.cache.maxsize, 1024)
+        form.validate({i: i for i in range(2000)})
+        self.assertEqual(node.cache.info().currsize, 1024)
+
+    def test_batched_keys_not_cached(self):
+        def known(keys):
+            self.calls.append(list(keys))
+            return [True for key in keys]
+        form = Form({And(str, Batched(known)): int})
+        form.validate({'a': 1})
+        form.validate({'a': 1})
+        self.assertIsNone(form.node.keys[0].cache)
+        self.assertEqual(self.calls, [['a'], ['a']])
+
+class TestSharedCleaned(unittest.TestCase):
+
+    def test_map_returned_as_is(self):
+        for engine in ('tree', 'codegen'):
+            form = Form({
+                'name': str,
+                Optional('age'): int,
+                'role': Or('admin', 'user')
+            }, engine=engine)
+            data = {'name': 'Ann', 'role': 'user'}
+            self.assertTrue(form.validate(data))
+            self.assertIs(form.cleaned, data)
+
+    def test_list_returned_as_is(self):
+        for engine in ('tree', 'codegen'):
+            form = Form({'tags': [str, int]}, engine=engine)
+            data = {'tags': ['a', 1, 'b']}
+            self.assertTrue(form.validate(data))
+            self.assertEqual(form.cleaned, data)
+            self.assertIs(form.cleaned['tags'], data['tags'])
+
+    def test_map_holding_a_list(self):
+        for engine in ('tree', 'codegen'):
+            form = Form({'t': [int], 'name': str}, engine=engine)
+            data = {'t': [1, 2], 'name': 'a'}
+            self.assertIs(form.check(data).cleaned, data)
+            data = {'t': [1, '2'], 'name': 'a'}
+            self.assertEqual(form.check(data).cleaned, {'name': 'a'})
+
+    def test_nested_maps(self):
+        for engine in ('tree', 'codegen'):
+            form = Form({'a': {'b': {'c': int}}, 'd': [{'e': str}]},
+                        engine=engine)
+            data = {'a': {'b': {'c': 1}}, 'd': [{'e': 'x'}]}
+            self.assertIs(form.check(data).cleaned, data)
+            form = Form({'a': {'b': {'c': Use(int)}}, 'd': [{'e': str}]},
+                        engine=engine)
+            data = {'a': {'b': {'c': '1'}}, 'd': [{'e': 'x'}]}
+            cleaned = form.check(data).cleaned
+            self.assertEqual(cleaned['a'], {'b': {'c': 1}})
+            self.assertIsNot(cleaned, data)
+            self.assertIs(cleaned['d'], data['d'])
+
+    def test_transformed_values_copied(self):
+        for engine in ('tree', 'codegen'):
+            form = Form({'n': [Use(int)], 'tags': [str]}, engine=engine)
+            data = {'n': ['1', '2'], 'tags': ['a']}
+            self.assertTrue(form.validate(data))
+            self.assertEqual(form.cleaned, {'n': [1, 2], 'tags': ['a']})
+            self.assertIsNot(form.cleaned, data)
+            self.assertIsNot(form.cleaned['n'], data['n'])
+            self.assertIs(form.cleaned['tags'], data['tags'])
+            self.assertEqual(data['n'], ['1', '2'])
+
+    def test_list_copied_from_first_change(self):
+        form = Form([Or('a', Use(str.upper))])
+        data = ['a', 'a', 'b', 'a']
+        self.assertTrue(form.validate(data))
+        self.assertEqual(form.cleaned, ['a', 'a', 'B', 'a'])
+        self.assertEqual(data, ['a', 'a', 'b', 'a'])
+
+    def test_only_exact_types_shared(self):
+        class Ordered(dict):
+            pass
+        form = Form({'a': int, 'b': [int]})
+        data = Ordered(a=1, b=(1, 2))
+        self.assertTrue(form.validate(data))
+        self.assertEqual(form.cleaned, {'a': 1, 'b': [1, 2]})
+        self.assertIs(type(form.cleaned), dict)
+        self.assertIs(type(form.cleaned['b']), list)
+
+    def test_invalid_not_shared(self):
+        for engine in ('tree', 'codegen'):
+            form = Form({'a': int, 'b': [int]}, engine=engine)
+            data = {'a': 'x', 'b': [1, 'y']}
+            self.assertFalse(form.validate(data))
+            self.assertEqual(form.cleaned, {})
+            form = Form([int], engine=engine)
+            data = [1, 'y']
+            self.assertFalse(form.validate(data))
+            self.assertEqual(form.cleaned, [1, None])
+            self.assertIsNot(form.cleaned, data)
+
+class TestStream(unittest.TestCase):
+
+    def test_yields_each_element(self):
+        form = Form([int, Use(float)])
+        rows = (value for value in [1, '2.5', 'x', 4])
+        results = list(form.stream(rows))
+        self.assertEqual([r[:3] for r in results], [
+            (0, True, 1),
+            (1, True, 2.5),
+            (2, False, None),
+            (3, True, 4)
+        ])
+        self.assertIs(results[0][3], NO_ERRORS)
+        self.assertEqual(list(results[2][3]), [2])
+        self.assertEqual(results[2][3][2][0], "'x' must be of type int")
+
+    def test_lazy(self):
+        seen = []
+        def rows():
+            for i in itertools.count():
+                seen.append(i)
+                yield i
+        stream = Form([int]).stream(rows())
+        self.assertEqual(next(stream)[:3], (0, True, 0))
+        self.assertEqual(seen, [0])
+
+    def test_nested_path(self):
+        form = Form({'meta': str, Optional('events'): [{'id': int}]})
+        results = list(form.stream([{'id': 1}, {'id': 'a'}], ('events',)))
+        self.assertEqual([r[1] for r in results], [True, False])
+        self.assertEqual(results[1][3][1]['id'], ["'a' must be of type int"])
+        self.assertRaises(ValueError, form.stream, [], ('meta',))
+        self.assertRaises(ValueError, form.stream, [], ('missing',))
+        self.assertRaises(ValueError, Form({'a': int}).stream, [])
+        form = Form({'rows': [{Optional('a'): int, If([['a']], 'b'): int}]})
+        self.assertRaises(ValueError, form.stream, [], ('rows',))
+
+    def test_batched_in_chunks(self):
+        calls = []
+        def known(values):
+            calls.append(list(values))
+            return [value != 3 for value in values]
+        form = Form([Batched(known)])
+        results = list(form.stream(iter(range(5)), chunksize=2))
+        self.assertEqual(calls, [[0, 1], [2, 3], [4]])
+        self.assertEqual([r[1] for r in results],
+                         [True, True, True, False, True])
+        self.assertEqual(results[3][3][3], ['known did not match 3'])
+
+class FileField(io.BytesIO):
+    def __init__(self, data, content_type='image/png'):
+        io.BytesIO.__init__(self, data)
+        self.content_type = content_type
+        self.reads = 0
+
+    def read(self, size=-1):
+        self.reads += 1
+        return io.BytesIO.read(self, size)
+
+class Stream(FileField):
+    def seekable(self):
+        return False
+
+class TestUpload(unittest.TestCase):
+
+    png = b'\x89PNG\r\n\x1a\n' + b'x' * 100
+
+    def test_cleaned_is_spooled_copy(self):
+        for engine in ('tree', 'codegen'):
+            form = Form({'avatar': Upload(max_size=1000, magic=b'\x89PNG',
+                                          spool_size=10)}, engine=engine)
+            self.assertTrue(form.validate({'avatar': FileField(self.png)}))
+            cleaned = form.cleaned['avatar']
+            self.assertIsInstance(cleaned, tempfile.SpooledTemporaryFile)
+            self.assertEqual(cleaned.read(), self.png)
+            cleaned.close()
+
+    def test_stops_at_max_size(self):
+        upload = FileField(b'x' * 1000)
+        form = Form({'f': Upload(max_size=100, chunk_size=10)})
+        self.assertFalse(form.validate({'f': upload}))
+        self.assertEqual(form.errors['f'], ['File is larger than 100 bytes'])
+        self.assertEqual(form.errors['f'][0].code, 'too_large')
+        self.assertEqual(upload.reads, 11)
+
+    def test_content_type(self):
+        form = Form({'f': Upload(content_types=['image/png', 'image/gif'])})
+        upload = FileField(self.png, 'text/html')
+        self.assertFalse(form.validate({'f': upload}))
+        self.assertEqual(form.errors['f'],
+                         ['Content type text/html is not allowed'])
+        self.assertEqual(upload.reads, 0)
+
+    def test_magic(self):
+        form = Form({'f': Upload(magic=(b'GIF87a', b'\x89PNG'),
+                                 chunk_size=2)})
+        self.assertTrue(form.validate({'f': FileField(self.png)}))
+        form.cleaned['f'].close()
+        upload = FileField(b'<html>' + b'x' * 100)
+        self.assertFalse(form.validate({'f': upload}))
+        self.assertEqual(form.errors['f'][0].code, 'magic')
+        self.assertEqual(upload.reads, 3)
+        self.assertFalse(form.validate({'f': FileField(b'GIF')}))
+
+    def test_checksum(self):
+        digest = hashlib.sha256(self.png).hexdigest()
+        form = Form({'f': Upload(checksum=('sha256', digest.upper()))})
+        self.assertTrue(form.validate({'f': FileField(self.png)}))
+        form.cleaned['f'].close()
+        self.assertFalse(form.validate({'f': FileField(self.png + b'!')}))
+        self.assertEqual(form.errors['f'],
+                         ['File does not match its sha256 checksum'])
+
+    def test_not_a_file(self):
+        form = Form({'f': Or(Upload(), None)})
+        self.assertTrue(form.validate({'f': None}))
+        form = Form({'f': Upload()})
+        self.assertFalse(form.validate({'f': b'data'}))
+        self.assertEqual(form.errors['f'], ["b'data' is not a file"])
+
+    def test_batched_reads_once(self):
+        form = Form({'f': Upload(max_size=1000), 'g': Upload(max_size=10),
+                     'n': Batched(lambda ns: [False] * len(ns))})
+        data = {'f': Stream(self.png), 'g': Stream(self.png), 'n': 1}
+        self.assertFalse(form.validate(data))
+        self.assertEqual(data['f'].reads, 2)
+        self.assertEqual(form.cleaned['f'].read(), self.png)
+        form.cleaned['f'].close()
+        self.assertEqual(form.errors['g'], ['File is larger than 10 bytes'])
+
+class TestExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = ThreadPoolExecutor(4)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_sequence_in_chunks(self):
+        schema = {'items': [Use(int)], 'name': str}
+        data = {'items': [str(i) if i % 50 else 'x' for i in range(300)],
+                'name': 'a'}
+        serial = Form(schema).check(data)
+        threaded = Form(schema, executor=self.executor).check(data)
+        self.assertEqual(threaded, serial)
+        self.assertEqual(list(threaded.errors['items']),
+                         [0, 50, 100, 150, 200, 250])
+
+    def test_sibling_keys(self):
+        threads = set()
+        def track(value):
+            threads.add(threading.current_thread())
+            return value > 0
+        schema = {'a': track, 'b': [track], 'c': int, 'd': Use(str)}
+        form = Form(schema, executor=self.executor)
+        data = {'a': 1, 'b': [1, -1], 'c': 'x', 'd': 4}
+        result = form.check(data)
+        self.assertNotIn(threading.current_thread(), threads)
+        self.assertEqual(result, Form(schema).check(data))
+        self.assertEqual(list(result.errors), ['b', 'c'])
+        schema = {And(isint): int, 'z': track}
+        form = Form(schema, executor=self.executor)
+        data = {'c': 1, 'z': 1}
+        result = form.check(data)
+        self.assertFalse(result.valid)
+        self.assertEqual(result.errors.section_errors,
+                         Form(schema).check(data).errors.section_errors)
+        self.assertIn('isint did not match c', result.errors.section_errors)
+
+    def test_shares_cleaned(self):
+        data = [str(i) for i in range(200)]
+        form = Form([str.isdigit], executor=self.executor)
+        self.assertIs(form.check(data).cleaned, data)
+        self.assertEqual(form.check(tuple(data)).cleaned, data)
+        form = Form({'one': str.isdigit, 'two': str.isdigit},
+                    executor=self.executor)
+        data = {'one': '1', 'two': '2'}
+        self.assertIs(form.check(data).cleaned, data)
+
+    def test_fail_fast(self):
+        form = Form([Use(int)], executor=self.executor)
+        data = [str(i) for i in range(300)]
+        data[100] = data[200] = 'x'
+        self.assertFalse(form.validate(data, fail_fast=True))
+        self.assertEqual(list(form.errors), [100])
+        self.assertEqual(form.cleaned, list(range(100)) + [None])
+        self.assertFalse(form.is_valid(data))
+
+    def test_tree_engine_only(self):
+        self.assertRaises(ValueError, Form, [int], engine='codegen',
+                          executor=self.executor)
+
+    def test_batched_serial(self):
+        form = Form([Batched(lambda values: [v > 0 for v in values])],
+                    executor=self.executor)
+        result = form.check(list(range(-1, 200)))
+        self.assertEqual(list(result.errors), [0, 1])
+
+class TestLimits(unittest.TestCase):
+
+    def test_rejected_before_validators(self):
+        calls = []
+        def check(value):
+            calls.append(value)
+            return True
+        form = Form({'tags': [check], 'name': Use(check)}, max_length=3)
+        result = form.check({'tags': [1, 2, 3, 4], 'name': 'a'})
+        self.assertEqual(result, (False, None,
+                                  {'tags': ['Longer than 3 items']}))
+        self.assertEqual(calls, [])
+        self.assertTrue(form.check({'tags': [1, 2, 3], 'name': 'a'}).valid)
+
+    def test_each_limit(self):
+        schema = {Optional('a'): object, Optional('b'): object}
+        cases = [
+            ({'max_depth': 2}, {'a': {'b': [1]}},
+             {'a': {'b': ['Nested more than 2 levels deep']}}),
+            ({'max_keys': 1}, {'a': 1, 'b': 2},
+             {'__section_errors__': ['More than 1 keys']}),
+            ({'max_string': 2}, {'a': 'ab', 'b': b'abc'},
+             {'b': ['Longer than 2 bytes']}),
+            ({'max_nodes': 4}, {'a': [1, 2], 'b': 3},
+             {'__section_errors__': ['More than 4 values in total']}),
+        ]
+        for limits, data, messages in cases:
+            result = Form(schema, **limits).check(data)
+            self.assertFalse(result.valid)
+            self.assertEqual(result.errors.messages(), messages)
+
+    def test_keys(self):
+        calls = []
+        def check(value):
+            calls.append(value)
+            return value
+        form = Form({'a': {And(str, Use(check)): int}}, max_string=10)
+        result = form.check({'a': {'x' * 1000: 1}})
+        self.assertEqual(result.errors.messages(), {'a': {
+            '__section_errors__': ['Key longer than 10 characters']}})
+        self.assertEqual(result.errors['a'].section_errors[0].value,
+                         'x' * 1000)
+        self.assertEqual(calls, [])
+        self.assertTrue(form.check({'a': {'x' * 10: 1}}).valid)
+
+    def test_deep_nesting(self):
+        data = inner = []
+        for i in range(100000):
+            inner.append([])
+            inner = inner[0]
+        form = Form([object], max_depth=3)
+        self.assertFalse(form.is_valid(data))
+        errors = form.check(data).errors
+        self.assertEqual(list(errors.iter_errors()),
+                         [((0, 0, 0), 'Nested more than 3 levels deep')])
+
+    def test_every_entry_point(self):
+        form = Form({'name': str}, max_string=3)
+        data = {'name': 'abcd'}
+        self.assertFalse(form.validate(data))
+        self.assertIsNone(form.cleaned)
+        self.assertFalse(form.is_valid(data))
+        self.assertFalse(next(form.validate_many([data])).valid)
+        self.assertFalse(asyncio.run(form.acheck(data)).valid)
+        form = Form({'n': str}, max_string=3)
+        result = validate_json(form, '{"n": "abcd"}')
+        self.assertEqual(result.errors.messages(),
+                         {'n': ['Longer than 3 characters']})
+        result = validate_urlencoded(form, b'n=abcd')
+        self.assertEqual(result.errors.messages(),
+                         {'n': ['Longer than 3 characters']})
+        self.assertFalse(Form(str, max_string=3).check('abcd').valid)
+        form = Form([str], max_string=3, max_depth=1)
+        outcomes = list(form.stream(['abcdef', ['x'], 'ab']))
+        self.assertEqual([valid for i, valid, clean, err in outcomes],
+                         [False, False, True])
+        self.assertEqual(outcomes[0][3].messages(),
+                         {0: ['Longer than 3 characters']})
+        self.assertEqual(outcomes[1][3].messages(),
+                         {1: ['Nested more than 1 levels deep']})
+        exists = Batched(lambda values: [True for value in values])
+        form = Form({'rows': [[exists]]}, max_depth=3)
+        outcomes = list(form.stream([['a'], [['b']]], path=('rows',)))
+        self.assertEqual([valid for i, valid, clean, err in outcomes],
+                         [True, False])
+
+    def test_parsers_stop_early(self):
+        def body():
+            yield '{"tags": ['
+            for i in itertools.count():
+                if i > 100:
+                    self.fail('Read past the limit')
+                yield '1, '
+        form = Form({'tags': [int], 'name': str}, max_length=5,
+                    max_keys=2, max_depth=2, max_string=4)
+        result = validate_json(form, body())
+        self.assertEqual(result.errors.messages(),
+                         {'tags': ['Longer than 5 items']})
+        for text, messages in [
+            ('{"tags": [[1]]}',
+             {'tags': {0: ['Nested more than 2 levels deep']}}),
+            ('{"names": 1}',
+             {'__section_errors__': ['Key longer than 4 characters']}),
+        ]:
+            self.assertEqual(validate_json(form, text).errors.messages(),
+                             messages)
+        for body, messages in [
+            (b'name=a&' + b'&'.join(b'tags=1' for i in range(6)),
+             {'tags': ['Longer than 5 items']}),
+            (b'name=abcde', {'name': ['Longer than 4 characters']}),
+        ]:
+            result = validate_urlencoded(form, body)
+            self.assertEqual(result.errors.messages(), messages)
+        form = Form({'tags': [int]}, max_nodes=4)
+        self.assertEqual(
+            validate_json(form, '{"tags": [1, 2, 3, 4]}').errors.messages(),
+            {'__section_errors__': ['More than 4 values in total']})
+        self.assertEqual(
+            validate_urlencoded(form, b'tags=1&tags=2&tags=3&tags=4')
+            .errors.messages(),
+            {'__section_errors__': ['More than 4 values in total']})
+
+    def test_pickled(self):
+        form = pickle.loads(pickle.dumps(Form([int], max_length=1)))
+        self.assertFalse(form.check([1, 2]).valid)
+
+class TestValidateMany(unittest.TestCase):
+
+    def test_results(self):
+        form = Form({'a': Use(int), Optional('b'): str})
+        records = [{'a': '1'}, {'a': 'x'}, {'a': 2, 'b': 'c'}, {'b': 3}]
+        results = list(form.validate_many(records))
+        self.assertEqual([r.valid for r in results],
+                         [True, False, True, False])
+        self.assertEqual(results[0].cleaned, {'a': 1})
+        self.assertEqual(results[2].cleaned, {'a': 2, 'b': 'c'})
+        self.assertTrue(results[1].errors['a'])
+        self.assertTrue(results[3].errors['b'])
+        self.assertEqual(results[3].errors.section_errors, ['Missing a'])
+        self.assertFalse(hasattr(form, 'errors'))
+
+    def test_passing_records_share_errors(self):
+        form = Form([int])
+        results = list(form.validate_many([[1], [2, 3], ['4'], []]))
+        self.assertIs(results[0].errors, NO_ERRORS)
+        self.assertIs(results[1].errors, NO_ERRORS)
+        self.assertIs(results[3].errors, NO_ERRORS)
+        self.assertFalse(results[0].errors['missing'])
+        self.assertFalse(NO_ERRORS)
+        self.assertEqual(len(results[2].errors), 1)
+
+    def test_no_errors_read_only(self):
+        for write in [
+            lambda: NO_ERRORS.__setitem__('a', ['x']),
+            lambda: NO_ERRORS.add('a', 'x'),
+            lambda: NO_ERRORS.update(a=['x']),
+            lambda: NO_ERRORS.setdefault('a', ['x']),
+            lambda: NO_ERRORS.pop('a', None),
+            lambda: NO_ERRORS.popitem(),
+            lambda: NO_ERRORS.clear(),
+            lambda: NO_ERRORS.__delitem__('a'),
+            lambda: NO_ERRORS.__ior__({'a': ['x']}),
+            lambda: NO_ERRORS.section_errors.append('x'),
+            lambda: NO_ERRORS.section_errors.extend(['x']),
+            lambda: NO_ERRORS['a'].append('x'),
+        ]:
+            self.assertRaises(TypeError, write)
+        self.assertEqual(NO_ERRORS, {})
+        self.assertEqual(NO_ERRORS.section_errors, [])
+        self.assertEqual(NO_ERRORS['a'], [])
+
+    def test_worker_processes(self):
+        for engine in ['tree', 'codegen']:
+            form = Form({'n': Use(int), 'even': even}, engine=engine)
+            records = [{'n': str(i), 'even': i} for i in range(100)]
+            records.append({'n': 'x', 'even': 2})
+            results = list(form.validate_many(records, workers=2,
+                                              chunksize=7))
+            self.assertEqual(len(results), len(records))
+            for i, result in enumerate(results[:100]):
+                self.assertEqual(result.valid, i % 2 == 0)
+                if result.valid:
+                    self.assertEqual(result.cleaned, {'n': i, 'even': i})
+                    self.assertIs(result.errors, NO_ERRORS)
+            self.assertFalse(results[-1].valid)
+            self.assertTrue(results[-1].errors['n'])
+
+    def test_worker_processes_lambda(self):
+        form = Form({'n': lambda x: x > 3})
+        with self.assertRaises(TypeError) as context:
+            form.validate_many([{'n': 4}], workers=2)
+        self.assertIn('lambda', str(context.exception))
+
+    def test_codegen_engine(self):
+        form = Form({'a': int}, engine='codegen')
+        results = list(form.validate_many([{'a': 1}, {'a': '1'}]))
+        self.assertTrue(results[0].valid)
+        self.assertFalse(results[1].valid)
+        self.assertTrue(results[1].errors['a'])
+
 #TODO: make sure msg wrap doesn't screw up any nested validation.
 
 if __name__ == "__main__":
@@ -0,0 +1,153 @@
+import unittest
+from ceramic_forms.form import Form, Optional, Or, XOr, If, And, Use
+from ceramic_forms.form import Batched, NO_ERRORS
+
+class TestRevalidate(unittest.TestCase):
+
+    def test_only_changed_values(self):
+        seen = []
+        def check(value):
+            seen.append(value)
+            return isinstance(value, str)
+        form = Form({
+            'name': check,
+            'address': {'street': check, 'city': check},
+            'phones': [{'number': check}]
+        })
+        data = {
+            'name': 'a',
+            'address': {'street': 'b', 'city': 'c'},
+            'phones': [{'number': str(i)} for i in range(100)]
+        }
+        previous = form.check(data)
+        data['address']['city'] = 'd'
+        data['phones'][50]['number'] = 5
+        del seen[:]
+        result = form.revalidate(
+            previous, [('address', 'city'), ('phones', 50, 'number')], data)
+        self.assertEqual(seen, ['d', 5])
+        self.assertEqual(result, form.check(data))
+        self.assertFalse(result.valid)
+        self.assertEqual(list(result.errors['phones']), [50])
+
+    def test_reuses_errors(self):
+        form = Form({'a': int, 'b': {'c': int, 'd': int}})
+        data = {'a': 'x', 'b': {'c': 'y', 'd': 1}}
+        previous = form.check(data)
+        data['b']['c'] = 2
+        result = form.revalidate(previous, [('b', 'c')], data)
+        self.assertEqual(result.errors.messages(),
+                         {'a': ["'x' must be of type int"]})
+        self.assertIs(result.errors['a'], previous.errors['a'])
+        data['a'] = 1
+        result = form.revalidate(result, [('a',)], data)
+        self.assertEqual(result, (True, data, NO_ERRORS))
+
+    def test_key_errors(self):
+        form = Form({And(str, str.isidentifier): str, 'b': int})
+        previous = form.check({'b': 1})
+        data = {'b': 1, '1a': 'x'}
+        result = form.revalidate(previous, [('1a',)], data)
+        self.assertFalse(result.valid)
+        self.assertEqual(result.errors.section_errors,
+                         ['isidentifier did not match 1a'])
+
+    def test_added_and_removed_keys(self):
+        form = Form({'a': int, Optional('b'): str})
+        data = {'a': 1}
+        previous = form.check(data)
+        data['b'] = 2
+        data['c'] = 3
+        result = form.revalidate(previous, [('b',), ('c',)], data)
+        self.assertEqual(result, form.check(data))
+        del data['a'], data['b'], data['c']
+        result = form.revalidate(result, [('a',), ('b',), ('c',)], data)
+        self.assertEqual(result.errors.section_errors, ['Missing a'])
+
+    def test_key_groups(self):
+        form = Form({Or: {'email': str, 'phone': str},
+                     XOr: {'card': str, 'iban': str}, 'id': int})
+        data = {'email': 'a', 'card': 'b', 'id': 1}
+        previous = form.check(data)
+        self.assertTrue(previous.valid)
+        del data['email']
+        data['iban'] = 'c'
+        result = form.revalidate(previous, [('email',), ('iban',)], data)
+        self.assertEqual(result, form.check(data))
+        self.assertEqual(len(result.errors.section_errors), 2)
+
+    def test_if_paths(self):
+        schema = {
+            'shipping': bool,
+            'order': {
+                'item': str,
+                If([('shipping',)], 'address'): str
+            }
+        }
+        form = Form(schema)
+        data = {'order': {'item': 'x', 'address': 'y'}}
+        previous = form.check(data)
+        self.assertFalse(previous.valid)
+        data['shipping'] = True
+        result = form.revalidate(previous, [('shipping',)], data)
+        self.assertEqual(result, form.check(data))
+        self.assertTrue(result.valid)
+
+    def test_whole_structure(self):
+        form = Form([Use(int)])
+        previous = form.check(['1', '2'])
+        result = form.revalidate(previous, [()], ['3', 'x', '4'])
+        self.assertEqual(result, form.check(['3', 'x', '4']))
+
+    def test_matches_check(self):
+        form = Form({
+            'items': [And(str, Use(int))],
+            'meta': {Optional('tags'): [str], 'rank': Or(int, None)}
+        })
+        data = {'items': ['1', '2', 'x'],
+                'meta': {'tags': ['a', 1], 'rank': None}}
+        previous = form.check(data)
+        edits = [
+            (('items', 2), '3'),
+            (('meta', 'tags', 1), 'b'),
+            (('meta', 'rank'), 'high'),
+            (('items', 0), 4),
+        ]
+        for path, value in edits:
+            place = data
+            for key in path[:-1]:
+                place = place[key]
+            place[path[-1]] = value
+            previous = form.revalidate(previous, [path], data)
+            self.assertEqual(previous, form.check(data))
+
+    def test_batched_falls_back(self):
+        calls = []
+        def known(values):
+            calls.append(list(values))
+            return [True for value in values]
+        form = Form({'a': Batched(known), 'b': Batched(known)})
+        previous = form.check({'a': 1, 'b': 2})
+        del calls[:]
+        result = form.revalidate(previous, [('a',)], {'a': 3, 'b': 2})
+        self.assertTrue(result.valid)
+        self.assertEqual(calls, [[3], [2]])
+
+    def test_limits(self):
+        form = Form({'name': str, 'tags': [str]}, max_length=2, max_string=4)
+        data = {'name': 'a', 'tags': ['b']}
+        previous = form.check(data)
+        data['tags'].append('cdefg')
+        result = form.revalidate(previous, [('tags', 1)], data)
+        self.assertEqual(result, form.check(data))
+        self.assertEqual(result.errors.messages(),
+                         {'tags': {1: ['Longer than 4 characters']}})
+        data['tags'][1:] = ['c', 'd']
+        result = form.revalidate(previous, [('tags', 2)], data)
+        self.assertEqual(result, form.check(data))
+        data['tags'][1:] = []
+        data['long name'] = 'e'
+        result = form.revalidate(previous, [('long name',)], data)
+        self.assertEqual(result, form.check(data))
+        self.assertEqual(result.errors.section_errors,
+                         ['Key longer than 4 characters'])
@@ -0,0 +1,135 @@
+import io
+import json
+import unittest
+from ceramic_forms.form import Form, Optional, Or, Use, Batched, NO_ERRORS
+from ceramic_forms.jsonstream import iter_events, validate_json, JSONError
+
+class TestEvents(unittest.TestCase):
+
+    def test_events(self):
+        events = list(iter_events('{"a": [1, 2.5, "x"], "b": {}, "c": null}'))
+        self.assertEqual(events, [
+            ('start_map', None),
+            ('map_key', 'a'),
+            ('start_array', None),
+            ('number', 1),
+            ('number', 2.5),
+            ('string', 'x'),
+            ('end_array', None),
+            ('map_key', 'b'),
+            ('start_map', None),
+            ('end_map', None),
+            ('map_key', 'c'),
+            ('null', None),
+            ('end_map', None)
+        ])
+
+    def test_split_anywhere(self):
+        doc = {'name': 'caf\u00e9 \\"\u2603"', 'n': [-12, 1e-3, True, False]}
+        text = json.dumps(doc, ensure_ascii=False).encode()
+        for size in range(1, 8):
+            chunks = [text[i:i + size] for i in range(0, len(text), size)]
+            events = list(iter_events(chunks))
+            self.assertEqual(events[2], ('string', doc['name']))
+            self.assertEqual(events[-6:-1], [
+                ('number', -12),
+                ('number', 0.001),
+                ('boolean', True),
+                ('boolean', False),
+                ('end_array', None)
+            ])
+
+    def test_long_string(self):
+        value = 'ab\\"c' * 200000
+        text = json.dumps({'s': value, 't': value[:7]}).encode()
+        events = list(iter_events(io.BytesIO(text), chunk_size=1001))
+        self.assertEqual(events[2], ('string', value))
+        self.assertEqual(events[4], ('string', value[:7]))
+        self.assertRaises(JSONError, list, iter_events([text[:-20]]))
+
+    def test_file(self):
+        events = list(iter_events(io.BytesIO(b'[true]'), chunk_size=2))
+        self.assertEqual(events[1], ('boolean', True))
+
+    def test_malformed(self):
+        for text in ['', '{', '[1,]', '{"a" 1}', '01', '1 2', '"abc', 'nul',
+                     '{1: 2}', '[1 2]', 'NaN']:
+            with self.assertRaises(JSONError):
+                list(iter_events(text))
+
+    def test_fails_before_reading_the_rest(self):
+        chunks = iter([b'[1, ', b'}', b'never read'])
+        with self.assertRaises(JSONError):
+            list(iter_events(chunks))
+        self.assertEqual(list(chunks), [b'never read'])
+
+class TestValidateJSON(unittest.TestCase):
+
+    schema = {
+        'id': Use(int),
+        'kind': Or('a', 'b'),
+        Optional('tags'): [str],
+        Optional('owner'): {'name': str}
+    }
+
+    def test_same_as_check(self):
+        form = Form(self.schema)
+        for doc in [
+            {'id': '1', 'kind': 'a', 'tags': ['x']},
+            {'id': 'x', 'kind': 'a'},
+            {'id': 1, 'kind': 'c', 'owner': {'name': 'Ann'}},
+            {'kind': 'b'}
+        ]:
+            result = validate_json(form, json.dumps(doc), chunk_size=3)
+            self.assertEqual(result, form.check(doc))
+        result = validate_json(form, '{"id": 1, "kind": "a"}')
+        self.assertIs(result.errors, NO_ERRORS)
+
+    def test_rejects_early(self):
+        form = Form(self.schema)
+        chunks = iter(['{"id": 1, "tags": ["a", 2', ', "b"]', 'never read'])
+        result = validate_json(form, chunks)
+        self.assertFalse(result.valid)
+        self.assertIsNone(result.cleaned)
+        self.assertEqual(result.errors,
+                         {'tags': {1: ['2 must be of type str']}})
+        self.assertEqual(list(chunks), ['never read'])
+
+    def test_unexpected_key(self):
+        form = Form(self.schema)
+        result = validate_json(form, '{"owner": {"name": "a", "age": 3}}')
+        self.assertEqual(result.errors['owner'].section_errors,
+                         ['Unexpected key age'])
+        self.assertEqual(validate_json(form, '{"extra": 1}').errors,
+                         {'__section_errors__': ['Unexpected key extra']})
+
+    def test_scalar_for_container(self):
+        result = validate_json(Form({'a': {'b': int}}), '{"a": 5}')
+        self.assertFalse(result.valid)
+        self.assertEqual(result.errors.messages(),
+                         {'a': ['5 must be of type dict']})
+        result = validate_json(Form({'a': [{'b': int}]}), '{"a": [5, {}]}')
+        self.assertEqual(result.errors.messages(),
+                         {'a': {0: ['5 must be of type dict']}})
+        result = validate_json(Form([[int], str]), '[null]')
+        self.assertEqual(result.errors.messages(), {
+            0: ['None must be of type list', 'None must be of type str']
+        })
+
+    def test_scalar_schema(self):
+        result = validate_json(Form(int), '"x"')
+        self.assertFalse(result.valid)
+        self.assertEqual(result.errors.section_errors,
+                         ["'x' must be of type int"])
+
+    def test_malformed(self):
+        result = validate_json(Form(self.schema), b'{"id": 1,,')
+        self.assertFalse(result.valid)
+        self.assertEqual(result.errors.section_errors,
+                         ['Expecting property name enclosed in double quotes '
+                          'at character 9'])
+
+    def test_batched_parsed_in_full(self):
+        form = Form({'a': Batched(lambda values: [True for v in values])})
+        result = validate_json(form, '{"a": 1, "b": 2}')
+        self.assertEqual(result, form.check({'a': 1, 'b': 2}))
@@ -0,0 +1,108 @@
+import unittest
+from ceramic_forms.form import Form, Optional, Or, And, Use, NO_ERRORS
+from ceramic_forms.urlencoded import (
+    iter_fields, split_name, validate_urlencoded
+)
+
+class TestFields(unittest.TestCase):
+
+    def test_iter_fields(self):
+        body = bytearray(b'a=1&b%5B0%5D=x+y&&c&d=caf%C3%A9')
+        self.assertEqual(list(iter_fields(memoryview(body))), [
+            ('a', '1'),
+            ('b[0]', 'x y'),
+            ('c', ''),
+            ('d', 'café')
+        ])
+
+    def test_split_name(self):
+        self.assertEqual(split_name('phone_numbers[0][number]'),
+                         ['phone_numbers', '0', 'number'])
+        self.assertEqual(split_name('tags[]'), ['tags', ''])
+        self.assertEqual(split_name('a[b'), ['a[b'])
+
+class TestValidateUrlencoded(unittest.TestCase):
+
+    schema = {
+        'name': str,
+        Optional('age'): Use(int),
+        Optional('phone_numbers'): [
+            {'number': str, 'type': Or('cell', 'home')}
+        ],
+        Optional('tags'): [str]
+    }
+
+    def test_nested(self):
+        body = (b'name=Ann&age=31'
+                b'&phone_numbers[1][number]=555&phone_numbers[1][type]=cell'
+                b'&phone_numbers[0][number]=123&phone_numbers[0][type]=home'
+                b'&tags=a&tags=b&tags[]=c')
+        result = validate_urlencoded(Form(self.schema), body)
+        self.assertTrue(result.valid)
+        self.assertIs(result.errors, NO_ERRORS)
+        self.assertEqual(result.cleaned, {
+            'name': 'Ann',
+            'age': 31,
+            'phone_numbers': [
+                {'number': '123', 'type': 'home'},
+                {'number': '555', 'type': 'cell'}
+            ],
+            'tags': ['a', 'b', 'c']
+        })
+
+    def test_errors(self):
+        body = b'name=Ann&age=x&phone_numbers[0][type]=fax'
+        result = validate_urlencoded(Form(self.schema), body)
+        self.assertFalse(result.valid)
+        self.assertEqual(result.errors['phone_numbers'][0].section_errors,
+                         ['Missing number'])
+        self.assertTrue(result.errors['age'])
+
+    def test_reject_unknown(self):
+        form = Form(self.schema)
+        for body, errors in [
+            (b'name=a&admin=1',
+             {'__section_errors__': ['Unexpected key admin']}),
+            (b'phone_numbers[0][ext]=1',
+             {'phone_numbers': {0: {'__section_errors__':
+                                    ['Unexpected key ext']}}}),
+            (b'tags[x]=1', {'tags': {'__section_errors__':
+                                     ['Unexpected key x']}})
+        ]:
+            result = validate_urlencoded(form, body)
+            self.assertFalse(result.valid)
+            self.assertIsNone(result.cleaned)
+            self.assertEqual(result.errors, errors)
+
+    def test_ignore_unknown(self):
+        body = b'name=a&admin=1&phone_numbers[0][ext]=1'
+        result = validate_urlencoded(Form(self.schema), body,
+                                     unknown='ignore')
+        self.assertTrue(result.valid)
+        self.assertEqual(result.cleaned, {'name': 'a'})
+        self.assertRaises(ValueError, validate_urlencoded,
+                          Form(self.schema), body, unknown='keep')
+
+    def test_repeated_fields(self):
+        body = b'name=a&' + b'&'.join(b'tags=%d' % i for i in range(50000))
+        result = validate_urlencoded(Form(self.schema), body)
+        self.assertTrue(result.valid)
+        self.assertEqual(result.cleaned['tags'],
+                         [str(i) for i in range(50000)])
+        body = (b'name=a&phone_numbers[][ext]=1&phone_numbers[][number]=1'
+                b'&phone_numbers[0][type]=home')
+        result = validate_urlencoded(Form(self.schema), body,
+                                     unknown='ignore')
+        self.assertEqual(result.cleaned['phone_numbers'],
+                         [{'number': '1', 'type': 'home'}])
+
+    def test_open_maps(self):
+        form = Form({And(str, str.isidentifier): str})
+        result = validate_urlencoded(form, b'a=1&b[c]=2')
+        self.assertFalse(result.valid)
+        self.assertEqual(result.errors['b'],
+                         ["{'c': '2'} must be of type str"])
+        result = validate_urlencoded(form, b'1a=1')
+        self.assertFalse(result.valid)
+        self.assertEqual(result.errors.section_errors,
+                         ['isidentifier did not match 1a'])
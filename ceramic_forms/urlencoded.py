@@ -0,0 +1,237 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import re
+from urllib.parse import unquote_to_bytes
+
+from ceramic_forms.form import (
+    ErrorRecord,
+    FormErr,
+    Result,
+    result_errors,
+    MapNode,
+    SequenceNode,
+    KeyNode,
+    OptionalKeyNode,
+    OrKeyNode,
+    XOrKeyNode,
+    IfKeyNode,
+    MsgKeyNode,
+)
+
+FIELD = re.compile(rb'[^&]+')
+NAME = re.compile(r'([^\[\]]*)((?:\[[^\[\]]*\])*)')
+SEGMENT = re.compile(r'\[([^\[\]]*)\]')
+
+def decode(raw, encoding):
+    if b'+' in raw:
+        raw = raw.replace(b'+', b' ')
+    if b'%' in raw:
+        raw = unquote_to_bytes(raw)
+    return raw.decode(encoding, 'replace')
+
+def iter_fields(body, encoding='utf-8'):
+    #The (name, value) pairs of a urlencoded body, scanned in place so only
+    #the fields themselves are copied out.
+    for match in FIELD.finditer(body):
+        name, sep, value = match.group().partition(b'=')
+        yield decode(name, encoding), decode(value, encoding)
+
+def split_name(name):
+    #'phone_numbers[0][number]' is ['phone_numbers', '0', 'number']. Names
+    #that aren't made of brackets this way are taken whole.
+    match = NAME.fullmatch(name)
+    if match is None:
+        return [name]
+    return [match.group(1)] + SEGMENT.findall(match.group(2))
+
+class Items(dict):
+    #A list being filled in by index, made a list once the body is read.
+    #It keeps the index after the highest one so far for name[] to use.
+
+    def __init__(self):
+        self.next = 0
+
+    def __setitem__(self, index, value):
+        dict.__setitem__(self, index, value)
+        if index >= self.next:
+            self.next = index + 1
+
+    def next_index(self):
+        return self.next
+
+def finish(value):
+    if isinstance(value, Items):
+        return [finish(value[i]) for i in sorted(value)]
+    if type(value) is dict:
+        for key in value:
+            value[key] = finish(value[key])
+    return value
+
+def named_fields(node):
+    #Every key a map schema names, with the node for its value. None when
+    #any key could be accepted.
+    fields = {}
+    for key_node in node.keys:
+        if not add_names(key_node, fields):
+            return None
+    return fields
+
+def add_names(key_node, fields):
+    if isinstance(key_node, KeyNode):
+        fields.setdefault(key_node.key, key_node.value)
+    elif isinstance(key_node, (OptionalKeyNode, IfKeyNode, MsgKeyNode)):
+        return add_names(key_node.inner, fields)
+    elif isinstance(key_node, (OrKeyNode, XOrKeyNode)):
+        for orkey, alternative in key_node.alternatives:
+            if not add_names(alternative, fields):
+                return False
+    else:
+        return False
+    return True
+
+class Builder:
+    #Puts each field straight into its place in the nested structure the
+    #schema describes.
+
+    def __init__(self, form, unknown, errors):
+        if unknown not in ('reject', 'ignore'):
+            raise ValueError("unknown must be 'reject' or 'ignore'")
+        self.unknown = unknown
+        self.root = form.node
+        self.errors = errors
+        self.limits = form.limits
+        #Values in the document so far, counted as Limits.allow does.
+        self.nodes = 1
+        self.document = {}
+        self.fields = {}
+
+    def fields_of(self, node):
+        fields = self.fields.get(node, False)
+        if fields is False:
+            fields = self.fields[node] = named_fields(node)
+        return fields
+
+    def place(self, container, node, segment):
+        #The key segment stands for in container and the node for the
+        #value there, or None for the key if it has no place.
+        if isinstance(container, Items):
+            if segment == '':
+                key = container.next_index()
+            elif segment.isascii() and segment.isdigit():
+                key = int(segment)
+            else:
+                return None, None
+            if isinstance(node, SequenceNode) and len(node.validators) == 1:
+                return key, node.validators[0]
+            return key, None
+        if isinstance(node, MapNode):
+            fields = self.fields_of(node)
+            if fields is not None:
+                if segment not in fields:
+                    return None, None
+                return segment, fields[segment]
+        return segment, None
+
+    def add(self, name, value):
+        segments = split_name(name)
+        container = self.document
+        node = self.root
+        path = []
+        created = None
+        for depth, segment in enumerate(segments):
+            key, child = self.place(container, node, segment)
+            if key is None:
+                if self.unknown == 'reject':
+                    return self.reject(path, segment)
+                if created is not None:
+                    #Leave no trace of an ignored field.
+                    outer, key, last = created
+                    del outer[key]
+                    if isinstance(outer, Items):
+                        outer.next = last
+                return True
+            if self.limits is not None and \
+                    self.limits.key_exceeded(key) is not None:
+                return self.limits.reject_key(self.errors, tuple(path), key)
+            if depth == len(segments) - 1:
+                if isinstance(child, SequenceNode):
+                    #Repeated names for a list field each add an item.
+                    items = container.get(key)
+                    if not isinstance(items, Items):
+                        if not self.put(container, key, Items(), path,
+                                        depth + 1):
+                            return False
+                        items = container[key]
+                    return self.put(items, items.next_index(), value,
+                                    path + [key], depth + 2)
+                return self.put(container, key, value, path, depth + 1)
+            if isinstance(child, SequenceNode) or (
+                    child is None and segments[depth + 1] == ''):
+                kind = Items
+            else:
+                kind = dict
+            inner = container.get(key)
+            if type(inner) is not kind:
+                if created is None:
+                    created = (container, key, getattr(container, 'next',
+                                                       None))
+                if not self.put(container, key, kind(), path, depth + 1):
+                    return False
+                inner = container[key]
+            container = inner
+            node = child
+            path.append(key)
+        return True
+
+    def put(self, container, key, value, path, depth):
+        #Stores value under key in container, which is at depth in the
+        #document, unless that takes it over one of the form's limits.
+        grows = key not in container
+        container[key] = value
+        limits = self.limits
+        if limits is None:
+            return True
+        if grows:
+            self.nodes += 1
+            if limits.max_nodes is not None and self.nodes > limits.max_nodes:
+                self.errors.section_errors.append(ErrorRecord(
+                    'too_many_values', None, (limits.max_nodes,)))
+                return False
+            if isinstance(container, Items):
+                found = None
+                if limits.max_length is not None and \
+                        len(container) > limits.max_length:
+                    found = ('too_long', limits.max_length, 'items')
+            else:
+                found = limits.exceeded(container, depth)
+            if found is not None:
+                return limits.reject(self.errors, tuple(path), container,
+                                     found)
+        found = limits.exceeded(value, depth + 1)
+        if found is not None:
+            return limits.reject(self.errors, tuple(path) + (key,), value,
+                                 found)
+        return True
+
+    def reject(self, path, segment):
+        errors = self.errors
+        for key in path:
+            child = errors.child()
+            errors[key] = child
+            errors = child
+        errors.section_errors.append(ErrorRecord('unexpected', segment))
+        return False
+
+def validate_urlencoded(form, body, unknown='reject', encoding='utf-8'):
+    #Validates a urlencoded body, putting bracketed names straight into the
+    #nested structure the schema describes. A name the schema has no place for
+    #is an error when unknown is 'reject' and left out when it is 'ignore'.
+    errors = FormErr()
+    builder = Builder(form, unknown, errors)
+    for name, value in iter_fields(body, encoding):
+        if not builder.add(name, value):
+            return Result(False, None, errors)
+    valid, clean = form.run(finish(builder.document), errors)
+    return Result(valid, clean, result_errors(errors))
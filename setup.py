@@ -17,4 +17,7 @@ setup(
     packages=['ceramic_forms'],
     include_package_data=True,
     install_requires=requires,
+    extras_require={
+        'columnar': ['numpy'],
+    },
 )